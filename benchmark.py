@@ -0,0 +1,369 @@
+"""Benchmark the classification pipeline without QGIS.
+
+Generates synthetic rasters and label polygons, runs pipeline.train_and_predict,
+the same function the dialog runs, for a grid of compute modes, chunk sizes,
+overlaps, feature types and feature precisions, and writes wall time, throughput and peak memory of
+each run to a JSON results file. Each run is done in a fresh Python process, so
+the peak memory and the dask settings of one run do not affect the next.
+
+Run with the Python environment that has pycoeus installed, e.g.:
+
+    python benchmark.py --sizes 1024 4096 --output results.json
+"""
+
+import argparse
+import configparser
+import importlib
+import itertools
+import json
+import logging
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import types
+from datetime import datetime, timezone
+from importlib import metadata
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SIZES = (1024, 4096)  # Width and height of the synthetic rasters, in pixels
+DEFAULT_BANDS = 3  # Number of bands of the synthetic rasters
+DEFAULT_COMPUTE_MODES = ("normal", "parallel", "safe")
+DEFAULT_CHUNK_SIZES = (512, 1024, 2048)  # Chunk sizes for "parallel" and "safe" mode
+DEFAULT_OVERLAPS = (0, 25)
+DEFAULT_FEATURE_TYPES = ("IDENTITY", "FLAIR")
+DEFAULT_FEATURE_PRECISIONS = ("float32",)  # Add "float16" and "uint8" to compare them
+N_LABELS = 20  # Number of positive and of negative label polygons per raster
+LABEL_SIZE = 16  # Width and height of the label polygons, in pixels
+PATTERN_CELL_SIZE = 100  # Size of the cells of positive and negative areas, in pixels
+WRITE_BLOCK_ROWS = 1024  # Rows of the synthetic raster generated at once
+CRS = "EPSG:28992"
+# Keys of a case that are only needed to run it, not to compare results
+RUN_KEYS = ("raster_path", "pos_labels_path", "neg_labels_path", "workdir")
+# Versions of the packages that affect the results
+PACKAGES = ("pycoeus", "dask", "numpy", "rasterio", "rioxarray", "scikit-learn", "torch")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--output", type=Path, default=Path("benchmark_results.json"))
+    parser.add_argument("--sizes", type=int, nargs="+", default=DEFAULT_SIZES)
+    parser.add_argument("--bands", type=int, default=DEFAULT_BANDS)
+    parser.add_argument("--compute-modes", nargs="+", default=DEFAULT_COMPUTE_MODES)
+    parser.add_argument("--chunk-sizes", type=int, nargs="+", default=DEFAULT_CHUNK_SIZES)
+    parser.add_argument("--overlaps", type=int, nargs="+", default=DEFAULT_OVERLAPS)
+    parser.add_argument("--feature-types", nargs="+", default=DEFAULT_FEATURE_TYPES)
+    parser.add_argument(
+        "--feature-precisions", nargs="+", default=DEFAULT_FEATURE_PRECISIONS
+    )
+    parser.add_argument("--repeat", type=int, default=1, help="Runs per case")
+    parser.add_argument("--timeout", type=float, default=None, help="Seconds per run")
+    parser.add_argument(
+        "--workdir", type=Path, default=None, help="Folder for the data, a temporary one by default"
+    )
+    parser.add_argument("--case", help=argparse.SUPPRESS)  # Used to run one case in a child process
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(message)s")
+
+    if args.case is not None:
+        print(json.dumps(run_case(json.loads(args.case))))
+        return
+
+    workdir = args.workdir or Path(tempfile.mkdtemp(prefix="coeusai_benchmark_"))
+    workdir.mkdir(parents=True, exist_ok=True)
+    report = {
+        "started": datetime.now(timezone.utc).isoformat(),
+        "versions": get_versions(),
+        "machine": get_machine(),
+        "results": [],
+    }
+    try:
+        for size in args.sizes:
+            raster_path, pos_path, neg_path = make_dataset(workdir, size, args.bands)
+            for case in get_cases(
+                args.compute_modes,
+                args.chunk_sizes,
+                args.overlaps,
+                args.feature_types,
+                args.feature_precisions,
+            ):
+                case.update(
+                    raster_path=str(raster_path),
+                    pos_labels_path=str(pos_path),
+                    neg_labels_path=str(neg_path),
+                    size=size,
+                    bands=args.bands,
+                    workdir=str(workdir),
+                )
+                for i_repeat in range(args.repeat):
+                    result = run_case_in_process(case, args.timeout)
+                    result["repeat"] = i_repeat
+                    report["results"].append(result)
+                    _log_result(result)
+                    # Write after every run, so an interrupted benchmark keeps its results
+                    _write_report(report, args.output)
+    finally:
+        if args.workdir is None:
+            shutil.rmtree(workdir, ignore_errors=True)
+    _write_report(report, args.output)
+    logger.info(f"Wrote {len(report['results'])} results to {args.output}")
+
+
+def get_cases(
+    compute_modes, chunk_sizes, overlaps, feature_types, feature_precisions=("float32",)
+):
+    """Cases of the benchmark grid.
+
+    "normal" mode does not use a chunk size, IDENTITY features are only run in
+    float32 since they are the raster itself.
+    """
+    cases = []
+    for feature_type, compute_mode, overlap, feature_precision in itertools.product(
+        feature_types, compute_modes, overlaps, feature_precisions
+    ):
+        if feature_type == "IDENTITY" and feature_precision != "float32":
+            continue
+        for chunk_size in [None] if compute_mode == "normal" else chunk_sizes:
+            cases.append(
+                {
+                    "feature_type": feature_type,
+                    "compute_mode": compute_mode,
+                    "chunk_size": chunk_size,
+                    "chunk_overlap": overlap,
+                    "feature_precision": feature_precision,
+                }
+            )
+    return cases
+
+
+def make_dataset(workdir, size, n_bands):
+    """Write a synthetic raster with positive and negative areas, and label polygons on them.
+
+    The raster is a checkerboard of bright positive and dark negative cells,
+    with noise. The labels are squares in the middle of random cells.
+    """
+    import geopandas as gpd
+    import numpy as np
+    import rasterio
+    from rasterio.transform import from_origin
+    from rasterio.windows import Window
+    from shapely.geometry import box
+
+    raster_path = workdir / f"raster_{size}_{n_bands}.tif"
+    pos_path = workdir / f"pos_{size}.gpkg"
+    neg_path = workdir / f"neg_{size}.gpkg"
+    if raster_path.exists() and pos_path.exists() and neg_path.exists():
+        return raster_path, pos_path, neg_path
+
+    logger.info(f"Writing synthetic raster of {size} x {size} pixels with {n_bands} bands")
+    rng = np.random.default_rng(0)
+    transform = from_origin(0, size, 1, 1)
+    with rasterio.open(
+        raster_path,
+        "w",
+        driver="GTiff",
+        height=size,
+        width=size,
+        count=n_bands,
+        dtype="uint8",
+        crs=CRS,
+        transform=transform,
+        tiled=True,
+    ) as dst:
+        for row in range(0, size, WRITE_BLOCK_ROWS):
+            n_rows = min(WRITE_BLOCK_ROWS, size - row)
+            rows, cols = np.mgrid[row : row + n_rows, 0:size] // PATTERN_CELL_SIZE
+            positive = rows % 2 == cols % 2
+            data = np.where(positive, 170, 80)[None] + rng.normal(0, 25, (n_bands, n_rows, size))
+            dst.write(np.clip(data, 0, 255).astype("uint8"), window=Window(0, row, size, n_rows))
+
+    # Label squares in the middle of random cells
+    n_cells = size // PATTERN_CELL_SIZE
+    labels = {True: [], False: []}
+    for i_cell in rng.permutation(n_cells**2):
+        i_row, i_col = divmod(int(i_cell), n_cells)
+        positive = i_row % 2 == i_col % 2
+        if len(labels[positive]) < N_LABELS:
+            x = (i_col + 0.5) * PATTERN_CELL_SIZE
+            y = size - (i_row + 0.5) * PATTERN_CELL_SIZE
+            half = LABEL_SIZE / 2
+            labels[positive].append(box(x - half, y - half, x + half, y + half))
+    gpd.GeoDataFrame(geometry=labels[True], crs=CRS).to_file(pos_path)
+    gpd.GeoDataFrame(geometry=labels[False], crs=CRS).to_file(neg_path)
+    return raster_path, pos_path, neg_path
+
+
+def run_case_in_process(case, timeout=None):
+    """Run a case in a fresh Python process and get its result."""
+    result = {key: value for key, value in case.items() if key not in RUN_KEYS}
+    try:
+        completed = subprocess.run(
+            [sys.executable, str(Path(__file__).resolve()), "--case", json.dumps(case)],
+            capture_output=True,
+            text=True,
+            timeout=timeout,
+        )
+    except subprocess.TimeoutExpired:
+        result["error"] = f"Timed out after {timeout} seconds"
+        return result
+    if completed.returncode != 0:
+        # The last lines of the log hold the exception
+        result["error"] = "\n".join(completed.stderr.strip().splitlines()[-5:])
+        return result
+    result.update(json.loads(completed.stdout.strip().splitlines()[-1]))
+    return result
+
+
+def run_case(case):
+    """Run train_and_predict for one case and measure it, in this process."""
+    package = _import_plugin_package()
+    pipeline = importlib.import_module(f"{package}.pipeline")
+    progress_module = importlib.import_module(f"{package}.progress")
+    feature_cache_module = importlib.import_module(f"{package}.feature_cache")
+    from pycoeus.features import FeatureType
+
+    # Time the stages reported by the pipeline
+    stages = {}
+    stage_start = [None, time.perf_counter()]
+
+    def on_progress(stage, done, total, pixels_per_second, eta):
+        if stage != stage_start[0]:
+            now = time.perf_counter()
+            if stage_start[0] is not None:
+                stages[stage_start[0]] = stages.get(stage_start[0], 0.0) + now - stage_start[1]
+            stage_start[:] = [stage, now]
+
+    run_dir = Path(tempfile.mkdtemp(prefix="run_", dir=case["workdir"]))
+    try:
+        # An empty cache, so features are extracted in every run
+        feature_cache = feature_cache_module.FeatureCache(run_dir / "feature_cache", 0)
+        rss_before = _current_rss()
+        start = time.perf_counter()
+        cpu_start = time.process_time()
+        pipeline.train_and_predict(
+            case["raster_path"],
+            case["pos_labels_path"],
+            case["neg_labels_path"],
+            run_dir / "prediction.tif",
+            feature_type=FeatureType[case["feature_type"]],
+            compute_mode=case["compute_mode"],
+            chunks=case["chunk_size"],
+            chunk_overlap=case["chunk_overlap"],
+            feature_cache=feature_cache,
+            feature_precision=case["feature_precision"],
+            progress=progress_module.Progress(on_progress),
+        )
+        wall_time = time.perf_counter() - start
+        cpu_time = time.process_time() - cpu_start
+        on_progress(None, 0, 0, 0.0, -1.0)
+    finally:
+        shutil.rmtree(run_dir, ignore_errors=True)
+
+    return {
+        "wall_time": wall_time,
+        "cpu_time": cpu_time,
+        "pixels_per_second": case["size"] ** 2 / wall_time,
+        "rss_before": rss_before,
+        "peak_rss": _peak_rss(),
+        "stages": stages,
+    }
+
+
+def get_versions():
+    """Versions of the plugin, Python and the packages that affect the results."""
+    versions = {"python": platform.python_version()}
+    plugin_metadata = configparser.ConfigParser()
+    plugin_metadata.read(Path(__file__).with_name("metadata.txt"))
+    versions["coeusai"] = plugin_metadata.get("general", "version", fallback=None)
+    for name in PACKAGES:
+        try:
+            versions[name] = metadata.version(name)
+        except metadata.PackageNotFoundError:
+            versions[name] = None
+    return versions
+
+
+def get_machine():
+    """Description of the machine the benchmark runs on."""
+    machine = {
+        "platform": platform.platform(),
+        "processor": platform.processor(),
+        "cpu_count": os.cpu_count(),
+    }
+    try:
+        import psutil
+
+        machine["memory"] = psutil.virtual_memory().total
+    except ImportError:
+        machine["memory"] = None
+    return machine
+
+
+def _peak_rss():
+    """Peak resident memory of this process in bytes, or None if it cannot be read."""
+    try:
+        import resource
+
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Linux reports kilobytes, macOS bytes
+        return peak if sys.platform == "darwin" else peak * 1024
+    except ImportError:
+        pass
+    try:
+        import psutil
+
+        return psutil.Process().memory_info().peak_wset  # Windows
+    except (ImportError, AttributeError):
+        return None
+
+
+def _current_rss():
+    """Resident memory of this process in bytes, or None if it cannot be read."""
+    try:
+        import psutil
+
+        return psutil.Process().memory_info().rss
+    except ImportError:
+        return None
+
+
+def _import_plugin_package():
+    """Register the plugin folder as a package without running its __init__, which needs QGIS."""
+    plugin_dir = Path(__file__).resolve().parent
+    if plugin_dir.name not in sys.modules:
+        package = types.ModuleType(plugin_dir.name)
+        package.__path__ = [str(plugin_dir)]
+        sys.modules[plugin_dir.name] = package
+    return plugin_dir.name
+
+
+def _log_result(result):
+    chunk_text = "" if result["chunk_size"] is None else f", chunk size {result['chunk_size']}"
+    case_text = (
+        f"{result['size']} px, {result['feature_type']}, {result['compute_mode']}{chunk_text}, "
+        f"overlap {result['chunk_overlap']}, {result['feature_precision']}"
+    )
+    if "error" in result:
+        logger.warning(f"{case_text}: failed, {result['error']}")
+        return
+    peak_text = ""
+    if result["peak_rss"] is not None:
+        peak_text = f", peak {result['peak_rss'] / 1024**3:.2f} GB"
+    logger.info(
+        f"{case_text}: {result['wall_time']:.1f} s, "
+        f"{result['pixels_per_second'] / 1e6:.2f} Mpixels/s{peak_text}"
+    )
+
+
+def _write_report(report, output_path):
+    with open(output_path, "w") as f:
+        json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
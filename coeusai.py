@@ -1,30 +1,131 @@
+import importlib
 import os
 import inspect
-from .coeusai_dialog import CoeusAIDialog
+import sys
+from qgis.core import QgsApplication, QgsMessageLog, QgsProject, QgsSettings, Qgis
+from qgis.PyQt.QtCore import QThread, QTimer, Qt
+from qgis.PyQt.QtWidgets import QProgressDialog
+from .processing_provider import CoeusAIProvider
+from .utils import remove_raster_copies
+from .worker import stop_worker
 from PyQt5.QtWidgets import QAction
 from PyQt5.QtGui import QIcon
 
 
 cmd_folder = os.path.split(inspect.getfile(inspect.currentframe()))[0]
 
+# The dialog imports pycoeus and its deep-learning stack, which takes seconds,
+# so it is imported when the plugin is first used, not when QGIS starts
+DIALOG_MODULE = f"{__package__}.coeusai_dialog"
+WARM_UP_SETTING = "coeusai/warm_up"  # QGIS setting: import the dialog in the background
+WARM_UP_DELAY = 10000  # Milliseconds after QGIS started before the background import
+
 
 class CoeusAIPlugin:
     def __init__(self, iface):
         self.iface = iface
+        self.provider = None
+        self.loader = None
+        self.loading_dialog = None
+        self.warm_up_timer = None
+
+    def initProcessing(self):
+        # Makes the algorithms available in the Processing toolbox, batch mode and qgis_process
+        self.provider = CoeusAIProvider()
+        QgsApplication.processingRegistry().addProvider(self.provider)
 
     def initGui(self):
+        self.initProcessing()
         icon = os.path.join(os.path.join(cmd_folder, "icon.png"))
         self.action = QAction(QIcon(icon), "CoeusAI", self.iface.mainWindow())
         self.iface.addToolBarIcon(self.action)
         self.action.triggered.connect(self.run)
+        # Copies of raster layers without a file are kept while the layer is in the project
+        QgsProject.instance().layersRemoved.connect(remove_raster_copies)
+
+        # Import the dialog once QGIS has started, so it opens right away when it is used
+        if QgsSettings().value(WARM_UP_SETTING, True, type=bool):
+            self.warm_up_timer = QTimer()
+            self.warm_up_timer.setSingleShot(True)
+            self.warm_up_timer.timeout.connect(self._load)
+            self.warm_up_timer.start(WARM_UP_DELAY)
 
     def unload(self):
+        if self.warm_up_timer is not None:
+            self.warm_up_timer.stop()
+        if self.loader is not None:
+            # An import cannot be interrupted
+            self.loader.wait()
         self.iface.removeToolBarIcon(self.action)
         del self.action
+        QgsApplication.processingRegistry().removeProvider(self.provider)
+        stop_worker()
+        QgsProject.instance().layersRemoved.disconnect(remove_raster_copies)
+        remove_raster_copies()
 
     def run(self):
+        if DIALOG_MODULE in sys.modules:
+            self._show_dialog()
+            return
+        if self.loading_dialog is not None:
+            return
+
+        # Show that the plugin is loading, and open the dialog when it is loaded
+        self.loading_dialog = QProgressDialog(
+            "Loading CoeusAI...", "Cancel", 0, 0, self.iface.mainWindow()
+        )
+        self.loading_dialog.setWindowTitle("CoeusAI Plugin")
+        self.loading_dialog.setWindowModality(Qt.WindowModal)
+        self.loading_dialog.canceled.connect(self._cancel_loading)
+        self.loading_dialog.show()
+        self._load()
+
+    def _load(self):
+        """Import the dialog in a background thread, unless it is imported or importing."""
+        if self.loader is not None or DIALOG_MODULE in sys.modules:
+            return
+        self.loader = _DialogLoader()
+        self.loader.finished.connect(self._loaded)
+        self.loader.start()
+
+    def _loaded(self):
+        error, self.loader = self.loader.error, None
+        if error is not None:
+            QgsMessageLog.logMessage(
+                f"Failed to load CoeusAI: {error}", "CoeusAI", level=Qgis.Critical
+            )
+            self.iface.messageBar().pushCritical("CoeusAI", f"Failed to load: {error}")
+        if self.loading_dialog is not None:
+            self._cancel_loading()
+            if error is None:
+                self._show_dialog()
+
+    def _cancel_loading(self):
+        """Close the loading dialog, the import goes on but the dialog is not opened."""
+        loading_dialog, self.loading_dialog = self.loading_dialog, None
+        if loading_dialog is not None:
+            loading_dialog.canceled.disconnect(self._cancel_loading)
+            loading_dialog.close()
+
+    def _show_dialog(self):
+        from .coeusai_dialog import CoeusAIDialog
+
         # Instantiate the dialog
-        self.dlg = CoeusAIDialog()
+        self.dlg = CoeusAIDialog(iface=self.iface)
 
         # Show the dialog
         self.dlg.show()
+
+
+class _DialogLoader(QThread):
+    """Import the dialog, and with it pycoeus, without blocking QGIS."""
+
+    def __init__(self):
+        super().__init__()
+        self.error = None
+
+    def run(self):
+        try:
+            importlib.import_module(DIALOG_MODULE)
+        except Exception as e:
+            self.error = e
@@ -2,24 +2,82 @@ import logging
 from pathlib import Path
 import os
 import inspect
+import shutil
+import time
+from typing import NamedTuple, Optional, Union
 from qgis.PyQt import QtWidgets, QtCore, QtGui
 from qgis.PyQt.QtCore import QThread
-from qgis.core import QgsRasterLayer, QgsVectorLayer, QgsProject
-from pycoeus.main import read_input_and_labels_and_save_predictions
+from qgis.core import (
+    Qgis,
+    QgsCoordinateTransform,
+    QgsMessageLog,
+    QgsRasterLayer,
+    QgsVectorLayer,
+    QgsProject,
+    QgsSettings,
+)
 from pycoeus.features import FeatureType
+from .feature_cache import FeatureCache, DEFAULT_CACHE_SIZE_GB
+from . import pipeline
+from .pipeline import (
+    get_batch_output_paths,
+    get_model_path,
+    load_model,
+    MODEL_SUFFIX,
+    DEFAULT_PREVIEW_DECIMATION,
+    DEFAULT_MAX_SAMPLES_PER_CLASS,
+)
+from .planner import plan_compute, largest_raster, AUTO_CHUNK_OVERLAP
+from .prefetch import DEFAULT_QUEUE_DEPTH
+from .progress import Progress, ClassificationCancelled
+from .run_logging import run_logging, LOG_FORMAT
+from .run_report import get_report_path, read_report, format_summary
+from .scheduler import SchedulerSettings, SETTINGS_GROUP
+from .worker import get_worker, WorkerError
 from .utils import (
     HTEXT_OUTPUT_PATH,
+    HTEXT_OUTPUT_FORMAT,
+    HTEXT_OUTPUT_FORMAT_GEOTIFF,
+    HTEXT_OUTPUT_FORMAT_COG_PROBABILITY,
+    HTEXT_OUTPUT_FORMAT_COG_CLASS,
+    HTEXT_OUTPUT_FORMAT_COG_CLASS_PROBABILITY,
+    HTEXT_MODEL_PATH,
     HTEXT_INPUT_RSASTER,
     HTEXT_INPUT_POS_VEC,
     HTEXT_INPUT_NEG_VEC,
+    HTEXT_MULTI_CLASS,
+    HTEXT_CLASS_LAYERS,
+    HTEXT_CLASS_FIELD,
+    HTEXT_SELECTED_FEATURES,
+    HTEXT_AOI,
+    HTEXT_SKIP_NODATA,
     HTEXT_FEATURE_TYPE,
     HTEXT_COMPUTE_MODE,
+    HTEXT_COMPUTE_MODE_AUTO,
     HTEXT_COMPUTE_MODE_NORMAL,
     HTEXT_COMPUTE_MODE_PARALLEL,
     HTEXT_COMPUTE_MODE_SAFE,
+    HTEXT_MAP_VIEW_FIRST,
+    HTEXT_PREVIEW,
     HTEXT_CHUNK_SIZE,
     HTEXT_OVERLAP_SIZE,
+    HTEXT_FEATURE_CACHE,
+    HTEXT_FEATURE_PRECISION,
+    HTEXT_QUEUE_DEPTH,
+    HTEXT_MAX_SAMPLES,
+    HTEXT_SCHEDULER,
+    HTEXT_SCHEDULER_WORKERS,
+    HTEXT_MEMORY_LIMIT,
+    HTEXT_SPILL_DIRECTORY,
+    HTEXT_BATCH_RASTERS,
+    HTEXT_BATCH_FOLDER,
+    HTEXT_CANCEL,
+    HTEXT_WORKER,
     QgisLogHandler,
+    get_class_geometries,
+    get_label_geometries,
+    get_plugin_data_dir,
+    get_raster_path,
 )
 
 # Constants
@@ -28,22 +86,47 @@ LABEL_HEIGHT = 20  # Height of the labels
 WIDGET_WIDTH = 600  # Width of all the widgets
 WIDGET_HEIGHT = 20  # Height of all non-label widgets
 HELP_ICON_SIZE = 12  # Size of the help icon
+REPORT_HEIGHT = 110  # Height of the run report summary
+PREVIEW_DIR = "preview"  # Folder in the plugin data folder of the last preview
+DEFAULT_USE_WORKER = True  # Run the pipeline in a separate worker process by default
+# Output format options of the dialog and the output format names of the pipeline
+OUTPUT_FORMAT_OPTIONS = {
+    "GeoTIFF": "geotiff",
+    "COG probability": "cog_probability",
+    "COG class": "cog_class",
+    "COG class + probability": "cog_class_probability",
+}
+# Feature precision options of the dialog and the feature precisions of the pipeline
+FEATURE_PRECISION_OPTIONS = {
+    "Float32": "float32",
+    "Float16 (half the memory)": "float16",
+    "Uint8 (a quarter of the memory)": "uint8",
+}
+# Scheduler options of the dialog and the scheduler types of Parallel mode
+SCHEDULER_OPTIONS = {
+    "Threads": "threads",
+    "Processes": "processes",
+}
 
 # Get current folder
 cmd_folder = os.path.split(inspect.getfile(inspect.currentframe()))[0]
 
 
 class CoeusAIDialog(QtWidgets.QDialog):
-    def __init__(self, parent=None):
+    def __init__(self, parent=None, iface=None):
         """Constructor."""
         super(CoeusAIDialog, self).__init__(parent)
 
-        # Init a logger
-        self.logger = None
+        # QGIS interface, to read the map view
+        self.iface = iface
+
+        # Use the plugin package logger, so that records of all plugin modules are handled.
+        # Its handlers are added for each run, see ClassificationJob
+        self.logger = logging.getLogger(__package__)
 
         # Set up the dialog window properties
         self.setWindowTitle("CoeusAI Plugin")
-        self.resize(800, 700)
+        self.resize(800, 900)
 
         # Get Qgis Layers
         self.qgis_layers = QgsProject.instance().mapLayers().values()
@@ -65,6 +148,38 @@ class CoeusAIDialog(QtWidgets.QDialog):
         self.output_path_layout.setAlignment(QtCore.Qt.AlignLeft)
         self.layout.addLayout(self.output_path_layout)
 
+        # Add radio buttons for output format
+        output_format_label_layout, self.output_format_group, self.output_format_layout = (
+            self._get_radio_buttons_with_helptext(
+                "Output format:",
+                HTEXT_OUTPUT_FORMAT,
+                list(OUTPUT_FORMAT_OPTIONS),
+                [
+                    HTEXT_OUTPUT_FORMAT_GEOTIFF,
+                    HTEXT_OUTPUT_FORMAT_COG_PROBABILITY,
+                    HTEXT_OUTPUT_FORMAT_COG_CLASS,
+                    HTEXT_OUTPUT_FORMAT_COG_CLASS_PROBABILITY,
+                ],
+                "GeoTIFF",
+            )
+        )
+        self.layout.addLayout(output_format_label_layout)
+        self.layout.addLayout(self.output_format_layout)
+
+        # Add a separator
+        self._add_separator()
+
+        # Add input for predicting with a saved model instead of training
+        model_label_layout, self.model_path_line_edit, self.model_browse_button = (
+            self._get_model_path_input_elements(HTEXT_MODEL_PATH)
+        )
+        self.layout.addLayout(model_label_layout)
+        self.model_path_layout = QtWidgets.QHBoxLayout()
+        self.model_path_layout.addWidget(self.model_path_line_edit)
+        self.model_path_layout.addWidget(self.model_browse_button)
+        self.model_path_layout.setAlignment(QtCore.Qt.AlignLeft)
+        self.layout.addLayout(self.model_path_layout)
+
         # Add a separator
         self._add_separator()
 
@@ -95,6 +210,43 @@ class CoeusAIDialog(QtWidgets.QDialog):
         self.layout.addLayout(neg_label_layout)
         self.layout.addWidget(self.vec_negative_combo)
 
+        # Add the labels of several classes, instead of positive and negative labels
+        self._add_multi_class_options()
+
+        # Add checkbox to only use the selected label features
+        self.selected_features_checkbox = QtWidgets.QCheckBox("Selected features only")
+        self.selected_features_checkbox.setStyleSheet(f"font-size: {FONTSIZE}px;")
+        self.selected_features_checkbox.setFixedHeight(LABEL_HEIGHT)
+        help_icon = _get_help_icon(HTEXT_SELECTED_FEATURES)
+        help_icon.setFixedSize(HELP_ICON_SIZE, HELP_ICON_SIZE)
+        selected_features_layout = QtWidgets.QHBoxLayout()
+        selected_features_layout.addWidget(self.selected_features_checkbox)
+        selected_features_layout.addWidget(help_icon)
+        selected_features_layout.setAlignment(QtCore.Qt.AlignLeft)
+        self.layout.addLayout(selected_features_layout)
+
+        # Add area of interest vector layer combo box, the first option is no area of interest
+        aoi_label_layout, self.aoi_combo = self._get_combo_box(
+            "Area of interest (optional):",
+            HTEXT_AOI,
+            self._populate_aoi_combo,
+        )
+        self.layout.addLayout(aoi_label_layout)
+        self.layout.addWidget(self.aoi_combo)
+
+        # Add checkbox to skip the chunks without data
+        self.skip_nodata_checkbox = QtWidgets.QCheckBox("Skip areas without data")
+        self.skip_nodata_checkbox.setChecked(True)
+        self.skip_nodata_checkbox.setStyleSheet(f"font-size: {FONTSIZE}px;")
+        self.skip_nodata_checkbox.setFixedHeight(LABEL_HEIGHT)
+        help_icon = _get_help_icon(HTEXT_SKIP_NODATA)
+        help_icon.setFixedSize(HELP_ICON_SIZE, HELP_ICON_SIZE)
+        skip_nodata_layout = QtWidgets.QHBoxLayout()
+        skip_nodata_layout.addWidget(self.skip_nodata_checkbox)
+        skip_nodata_layout.addWidget(help_icon)
+        skip_nodata_layout.setAlignment(QtCore.Qt.AlignLeft)
+        self.layout.addLayout(skip_nodata_layout)
+
         # Add radio buttons for feature type
         feature_label_layout, self.feature_type_group, self.feature_type_layout = (
             self._get_radio_buttons(
@@ -109,35 +261,96 @@ class CoeusAIDialog(QtWidgets.QDialog):
             self._get_radio_buttons_with_helptext(
                 "Compute mode:",
                 HTEXT_COMPUTE_MODE,
-                ["Normal", "Parallel", "Safe"],
+                ["Auto", "Normal", "Parallel", "Safe"],
                 [
+                    HTEXT_COMPUTE_MODE_AUTO,
                     HTEXT_COMPUTE_MODE_NORMAL,
                     HTEXT_COMPUTE_MODE_PARALLEL,
                     HTEXT_COMPUTE_MODE_SAFE,
                 ],
-                "Normal",
+                "Auto",
             )
         )
         self.layout.addLayout(compute_label_layout)
         self.layout.addLayout(self.compute_mode_layout)
 
+        # Add checkbox to predict the map view first
+        self.map_view_first_checkbox = QtWidgets.QCheckBox("Predict the map view first")
+        self.map_view_first_checkbox.setStyleSheet(f"font-size: {FONTSIZE}px;")
+        self.map_view_first_checkbox.setFixedHeight(LABEL_HEIGHT)
+        self.map_view_first_checkbox.setEnabled(self.iface is not None)
+        help_icon = _get_help_icon(HTEXT_MAP_VIEW_FIRST)
+        help_icon.setFixedSize(HELP_ICON_SIZE, HELP_ICON_SIZE)
+        map_view_first_layout = QtWidgets.QHBoxLayout()
+        map_view_first_layout.addWidget(self.map_view_first_checkbox)
+        map_view_first_layout.addWidget(help_icon)
+        map_view_first_layout.setAlignment(QtCore.Qt.AlignLeft)
+        self.layout.addLayout(map_view_first_layout)
+        # A Cloud-Optimized GeoTIFF is only written at the end, it cannot be shown earlier
+        self.output_format_group.buttonToggled.connect(self._toggle_output_format)
+
+        # Add checkbox and factor for a low resolution preview
+        self.preview_checkbox = QtWidgets.QCheckBox("Preview at lower resolution, 1 /")
+        self.preview_checkbox.setStyleSheet(f"font-size: {FONTSIZE}px;")
+        self.preview_checkbox.setFixedHeight(LABEL_HEIGHT)
+        self.preview_spinbox = QtWidgets.QSpinBox()
+        self.preview_spinbox.setRange(2, 64)
+        self.preview_spinbox.setValue(DEFAULT_PREVIEW_DECIMATION)
+        self.preview_spinbox.setStyleSheet(f"font-size: {FONTSIZE}px;")
+        help_icon = _get_help_icon(HTEXT_PREVIEW)
+        help_icon.setFixedSize(HELP_ICON_SIZE, HELP_ICON_SIZE)
+        preview_layout = QtWidgets.QHBoxLayout()
+        preview_layout.addWidget(self.preview_checkbox)
+        preview_layout.addWidget(self.preview_spinbox)
+        preview_layout.addWidget(help_icon)
+        preview_layout.setAlignment(QtCore.Qt.AlignLeft)
+        self.layout.addLayout(preview_layout)
+
+        # Labels, feature type and preview are not used when predicting with a saved model
+        self._toggle_predict_only(False)
+
         # Add a separator
         self._add_separator()
 
+        # Add batch options
+        self._add_batch_options()
+
         # Add advanced options
         self._add_advanced_options()
 
-        # Add run button
-       
+        # Add run and cancel buttons
         self.button_layout = QtWidgets.QHBoxLayout()
         self.run_button = QtWidgets.QPushButton("run")
         self.run_button.clicked.connect(self.start_classification)
         self.run_button.setFixedSize(64, 32)
         self.button_layout.addWidget(self.run_button)
+        self.cancel_button = QtWidgets.QPushButton("cancel")
+        self.cancel_button.clicked.connect(self.cancel_classification)
+        self.cancel_button.setFixedSize(64, 32)
+        self.cancel_button.setEnabled(False)
+        self.cancel_button.setToolTip(HTEXT_CANCEL)
+        self.button_layout.addWidget(self.cancel_button)
 
         # Add the button layout to the main layout
         self.layout.addLayout(self.button_layout)
 
+        # Add progress bar and progress text
+        self.progress_bar = QtWidgets.QProgressBar()
+        self.progress_bar.setFixedWidth(WIDGET_WIDTH)
+        self.progress_bar.setValue(0)
+        self.layout.addWidget(self.progress_bar, alignment=QtCore.Qt.AlignCenter)
+        self.progress_label = QtWidgets.QLabel("")
+        self.progress_label.setStyleSheet(f"font-size: {FONTSIZE}px;")
+        self.progress_label.setFixedHeight(LABEL_HEIGHT)
+        self.progress_label.setAlignment(QtCore.Qt.AlignCenter)
+        self.layout.addWidget(self.progress_label)
+        self.report_text = QtWidgets.QPlainTextEdit()
+        self.report_text.setReadOnly(True)
+        self.report_text.setFixedWidth(WIDGET_WIDTH)
+        self.report_text.setFixedHeight(REPORT_HEIGHT)
+        self.report_text.setPlaceholderText("Time and memory per stage of the last run")
+        self.layout.addWidget(self.report_text, alignment=QtCore.Qt.AlignCenter)
+
         # Add help text for the run button
         text_runbutton = "Hint: Check View -> Panels -> Log Messages for the classification progress."
         label_runbutton = QtWidgets.QLabel(text_runbutton)
@@ -152,6 +365,13 @@ class CoeusAIDialog(QtWidgets.QDialog):
 
         # Initialize the job thread
         self.job = None
+        self._partial_layers = {}  # Layer ids of outputs shown while being written
+        self._settings = None  # RunSettings of the last run, read when it started
+        self._new_layers = []  # Outputs of the last run to add to QGIS, as paths and names
+        self._preview_layer_id = None  # Layer of the last preview, replaced by the next one
+        # Model a cancelled run can be resumed with and the time it must be saved after
+        self._resume_model = None
+        self._run_summary = ""  # Summary of the run report of the last run
 
     def _add_separator(self):
         """Add a separator to the layout."""
@@ -198,6 +418,73 @@ class CoeusAIDialog(QtWidgets.QDialog):
 
         return label_layout, output_path_line_edit, browse_button
 
+    def _browse_model_path(self):
+        """Browse for a saved model."""
+        model_path = QtWidgets.QFileDialog.getOpenFileName(
+            self, "Open Model", "", f"CoeusAI Model (*{MODEL_SUFFIX})"
+        )
+        if model_path[0]:
+            self.model_path_line_edit.setText(model_path[0])
+
+    def _get_model_path_input_elements(self, help_text):
+        """Elements for predicting with a saved model."""
+        # Checkbox to enable predict only mode
+        self.predict_only_checkbox = QtWidgets.QCheckBox(
+            "Predict only, with a saved model:"
+        )
+        self.predict_only_checkbox.setStyleSheet(f"font-size: {FONTSIZE}px;")
+        self.predict_only_checkbox.setFixedHeight(LABEL_HEIGHT)
+        self.predict_only_checkbox.toggled.connect(self._toggle_predict_only)
+        help_icon = _get_help_icon(help_text)
+        help_icon.setFixedSize(HELP_ICON_SIZE, HELP_ICON_SIZE)
+        label_layout = QtWidgets.QHBoxLayout()
+        label_layout.addWidget(self.predict_only_checkbox)
+        label_layout.addWidget(help_icon)
+        label_layout.setAlignment(QtCore.Qt.AlignLeft)
+
+        # Get model path
+        model_path_line_edit = QtWidgets.QLineEdit()
+        model_path_line_edit.setFixedSize(WIDGET_WIDTH, WIDGET_HEIGHT)
+        model_path_line_edit.setStyleSheet(f"font-size: {FONTSIZE}px;")
+
+        # Add a button to browse for the model
+        browse_button = QtWidgets.QPushButton("...")
+        browse_button.clicked.connect(self._browse_model_path)
+        browse_button.setFixedSize(32, WIDGET_HEIGHT)
+
+        return label_layout, model_path_line_edit, browse_button
+
+    def _toggle_predict_only(self, predict_only):
+        """Enable the model input in predict only mode, and the training inputs otherwise."""
+        self.model_path_line_edit.setEnabled(predict_only)
+        self.model_browse_button.setEnabled(predict_only)
+        self.multi_class_group_box.setEnabled(not predict_only)
+        self._toggle_multi_class()
+        self.selected_features_checkbox.setEnabled(not predict_only)
+        for button in self.feature_type_group.buttons():
+            button.setEnabled(not predict_only)
+        self.preview_checkbox.setEnabled(not predict_only)
+        self.preview_spinbox.setEnabled(not predict_only)
+
+    def _toggle_multi_class(self):
+        """Enable the positive and negative label inputs when not training on several classes."""
+        binary = (
+            not self.predict_only_checkbox.isChecked()
+            and not self.multi_class_group_box.isChecked()
+        )
+        self.vec_positive_combo.setEnabled(binary)
+        self.vec_negative_combo.setEnabled(binary)
+
+    def _toggle_output_format(self):
+        """Enable predicting the map view first only for outputs that can be shown while written."""
+        self.map_view_first_checkbox.setEnabled(
+            self.iface is not None and self._get_output_format() == "geotiff"
+        )
+
+    def _get_output_format(self):
+        """The output format name of the pipeline for the checked option."""
+        return OUTPUT_FORMAT_OPTIONS[self.output_format_group.checkedButton().text()]
+
     def _get_combo_box(self, label_text, help_text, populate_function):
         """Add a combo box with a label to the layout."""
         label = QtWidgets.QLabel(label_text)
@@ -267,134 +554,697 @@ class CoeusAIDialog(QtWidgets.QDialog):
             layout.addWidget(radio_button_with_help)
         return label_layout, button_group, layout
 
+    def _get_spinbox(self, label_text, help_text, minimum, maximum, value):
+        """Add a spin box with a label to the layout."""
+        label = QtWidgets.QLabel(label_text)
+        label.setStyleSheet(f"font-size: {FONTSIZE}px;")
+        label.setFixedHeight(LABEL_HEIGHT)
+        help_icon = _get_help_icon(help_text)
+        help_icon.setFixedSize(HELP_ICON_SIZE, HELP_ICON_SIZE)
+        label_layout = QtWidgets.QHBoxLayout()
+        label_layout.addWidget(label)
+        label_layout.addWidget(help_icon)
+        label_layout.setAlignment(QtCore.Qt.AlignLeft)
+
+        spinbox = QtWidgets.QSpinBox()
+        spinbox.setRange(minimum, maximum)
+        spinbox.setValue(value)
+        spinbox.setStyleSheet(f"font-size: {FONTSIZE}px;")
+
+        return label_layout, spinbox
+
+    def _add_multi_class_options(self):
+        """Add multi-class section to the layout."""
+        self.multi_class_group_box = QtWidgets.QGroupBox("Multi-class")
+        self.multi_class_group_box.setCheckable(True)
+        self.multi_class_group_box.setChecked(False)
+        self.multi_class_group_box.setToolTip(HTEXT_MULTI_CLASS)
+        self.multi_class_group_box.setMaximumHeight(200)
+        self.multi_class_layout = QtWidgets.QVBoxLayout()
+
+        # Vector layers with the labels of the classes
+        class_layers_label = QtWidgets.QLabel("Vector layers of the classes:")
+        class_layers_label.setStyleSheet(f"font-size: {FONTSIZE}px;")
+        class_layers_label.setFixedHeight(LABEL_HEIGHT)
+        help_icon = _get_help_icon(HTEXT_CLASS_LAYERS)
+        help_icon.setFixedSize(HELP_ICON_SIZE, HELP_ICON_SIZE)
+        class_layers_label_layout = QtWidgets.QHBoxLayout()
+        class_layers_label_layout.addWidget(class_layers_label)
+        class_layers_label_layout.addWidget(help_icon)
+        class_layers_label_layout.setAlignment(QtCore.Qt.AlignLeft)
+        self.class_layer_list = QtWidgets.QListWidget()
+        self.class_layer_list.setSelectionMode(QtWidgets.QAbstractItemView.MultiSelection)
+        self.class_layer_list.setFixedWidth(WIDGET_WIDTH)
+        self.class_layer_list.setStyleSheet(f"font-size: {FONTSIZE}px;")
+        for layer in self.qgis_layers:
+            if isinstance(layer, QgsVectorLayer):
+                self.class_layer_list.addItem(layer.name())
+        self.multi_class_layout.addLayout(class_layers_label_layout)
+        self.multi_class_layout.addWidget(self.class_layer_list)
+
+        # Field with the class of each label
+        class_field_label = QtWidgets.QLabel("Class field (optional):")
+        class_field_label.setStyleSheet(f"font-size: {FONTSIZE}px;")
+        class_field_label.setFixedHeight(LABEL_HEIGHT)
+        help_icon = _get_help_icon(HTEXT_CLASS_FIELD)
+        help_icon.setFixedSize(HELP_ICON_SIZE, HELP_ICON_SIZE)
+        class_field_label_layout = QtWidgets.QHBoxLayout()
+        class_field_label_layout.addWidget(class_field_label)
+        class_field_label_layout.addWidget(help_icon)
+        class_field_label_layout.setAlignment(QtCore.Qt.AlignLeft)
+        self.class_field_line_edit = QtWidgets.QLineEdit()
+        self.class_field_line_edit.setFixedSize(WIDGET_WIDTH, WIDGET_HEIGHT)
+        self.class_field_line_edit.setStyleSheet(f"font-size: {FONTSIZE}px;")
+        self.multi_class_layout.addLayout(class_field_label_layout)
+        self.multi_class_layout.addWidget(self.class_field_line_edit)
+
+        self.multi_class_group_box.setLayout(self.multi_class_layout)
+        self.multi_class_group_box.toggled.connect(self._toggle_multi_class)
+        self.layout.addWidget(self.multi_class_group_box)
+
+    def _add_batch_options(self):
+        """Add batch mode section to the layout."""
+        self.batch_group_box = QtWidgets.QGroupBox("Batch Mode")
+        self.batch_group_box.setCheckable(True)
+        self.batch_group_box.setChecked(False)
+        self.batch_group_box.setMaximumHeight(200)
+        self.batch_layout = QtWidgets.QVBoxLayout()
+
+        # Raster layers to predict after the training raster
+        batch_label = QtWidgets.QLabel("Raster layers to predict with the same model:")
+        batch_label.setStyleSheet(f"font-size: {FONTSIZE}px;")
+        batch_label.setFixedHeight(LABEL_HEIGHT)
+        help_icon = _get_help_icon(HTEXT_BATCH_RASTERS)
+        help_icon.setFixedSize(HELP_ICON_SIZE, HELP_ICON_SIZE)
+        batch_label_layout = QtWidgets.QHBoxLayout()
+        batch_label_layout.addWidget(batch_label)
+        batch_label_layout.addWidget(help_icon)
+        batch_label_layout.setAlignment(QtCore.Qt.AlignLeft)
+        self.batch_raster_list = QtWidgets.QListWidget()
+        self.batch_raster_list.setSelectionMode(
+            QtWidgets.QAbstractItemView.MultiSelection
+        )
+        self.batch_raster_list.setFixedWidth(WIDGET_WIDTH)
+        self.batch_raster_list.setStyleSheet(f"font-size: {FONTSIZE}px;")
+        for layer in self.qgis_layers:
+            if isinstance(layer, QgsRasterLayer):
+                self.batch_raster_list.addItem(layer.name())
+        self.batch_layout.addLayout(batch_label_layout)
+        self.batch_layout.addWidget(self.batch_raster_list)
+
+        # Folder with more rasters to predict
+        folder_label = QtWidgets.QLabel("Folder with rasters to predict (optional):")
+        folder_label.setStyleSheet(f"font-size: {FONTSIZE}px;")
+        folder_label.setFixedHeight(LABEL_HEIGHT)
+        help_icon = _get_help_icon(HTEXT_BATCH_FOLDER)
+        help_icon.setFixedSize(HELP_ICON_SIZE, HELP_ICON_SIZE)
+        folder_label_layout = QtWidgets.QHBoxLayout()
+        folder_label_layout.addWidget(folder_label)
+        folder_label_layout.addWidget(help_icon)
+        folder_label_layout.setAlignment(QtCore.Qt.AlignLeft)
+        self.batch_folder_line_edit = QtWidgets.QLineEdit()
+        self.batch_folder_line_edit.setFixedSize(WIDGET_WIDTH, WIDGET_HEIGHT)
+        self.batch_folder_line_edit.setStyleSheet(f"font-size: {FONTSIZE}px;")
+        browse_button = QtWidgets.QPushButton("...")
+        browse_button.clicked.connect(self._browse_batch_folder)
+        browse_button.setFixedSize(32, WIDGET_HEIGHT)
+        folder_layout = QtWidgets.QHBoxLayout()
+        folder_layout.addWidget(self.batch_folder_line_edit)
+        folder_layout.addWidget(browse_button)
+        folder_layout.setAlignment(QtCore.Qt.AlignLeft)
+        self.batch_layout.addLayout(folder_label_layout)
+        self.batch_layout.addLayout(folder_layout)
+
+        self.batch_group_box.setLayout(self.batch_layout)
+        self.layout.addWidget(self.batch_group_box)
+
+    def _browse_batch_folder(self):
+        """Browse for a folder with rasters to predict."""
+        folder = QtWidgets.QFileDialog.getExistingDirectory(self, "Select Folder")
+        if folder:
+            self.batch_folder_line_edit.setText(folder)
+
+    def _get_batch_raster_paths(self, raster_path):
+        """Get the paths of the rasters to predict in batch mode, except the training raster."""
+        raster_paths = [
+            get_raster_path(QgsProject.instance().mapLayersByName(item.text())[0])
+            for item in self.batch_raster_list.selectedItems()
+        ]
+        folder = self.batch_folder_line_edit.text()
+        if folder:
+            raster_paths += sorted(
+                p for p in Path(folder).iterdir() if p.suffix.lower() in (".tif", ".tiff")
+            )
+
+        # Remove duplicates and the raster that is already predicted
+        unique_paths = []
+        for path in raster_paths:
+            if path != raster_path and path not in unique_paths:
+                unique_paths.append(path)
+        return unique_paths
+
     def _add_advanced_options(self):
         """Add advanced options section to the layout."""
         self.advanced_group_box = QtWidgets.QGroupBox("Advanced Options")
         self.advanced_group_box.setCheckable(True)
         self.advanced_group_box.setChecked(False)
-        self.advanced_group_box.setMaximumHeight(150)
+        self.advanced_group_box.setMaximumHeight(620)
         self.advanced_layout = QtWidgets.QVBoxLayout()
 
         # Chunk size
-        chunk_size_label = QtWidgets.QLabel("Chunk size:")
-        chunk_size_label.setStyleSheet(f"font-size: {FONTSIZE}px;")
-        chunk_size_label.setFixedHeight(LABEL_HEIGHT)
-        help_icon = _get_help_icon(HTEXT_CHUNK_SIZE)
-        help_icon.setFixedSize(HELP_ICON_SIZE, HELP_ICON_SIZE)
-        chunk_size_label_layout = QtWidgets.QHBoxLayout()
-        chunk_size_label_layout.addWidget(chunk_size_label)
-        chunk_size_label_layout.addWidget(help_icon)
-        chunk_size_label_layout.setAlignment(QtCore.Qt.AlignLeft)
-        self.chunk_size_spinbox = QtWidgets.QSpinBox()
-        self.chunk_size_spinbox.setRange(500, 10000)
-        self.chunk_size_spinbox.setValue(100)
-        self.chunk_size_spinbox.setStyleSheet(f"font-size: {FONTSIZE}px;")
+        chunk_size_label_layout, self.chunk_size_spinbox = self._get_spinbox(
+            "Chunk size:", HTEXT_CHUNK_SIZE, 500, 10000, 1024
+        )
         self.advanced_layout.addLayout(chunk_size_label_layout)
         self.advanced_layout.addWidget(self.chunk_size_spinbox)
 
         # Overlap size
-        overlap_size_label = QtWidgets.QLabel("Overlap size:")
-        overlap_size_label.setStyleSheet(f"font-size: {FONTSIZE}px;")
-        overlap_size_label.setFixedHeight(LABEL_HEIGHT)
-        help_icon = _get_help_icon(HTEXT_OVERLAP_SIZE)
-        help_icon.setFixedSize(HELP_ICON_SIZE, HELP_ICON_SIZE)
-        overlap_size_label_layout = QtWidgets.QHBoxLayout()
-        overlap_size_label_layout.addWidget(overlap_size_label)
-        overlap_size_label_layout.addWidget(help_icon)
-        overlap_size_label_layout.setAlignment(QtCore.Qt.AlignLeft)
-        self.overlap_size_spinbox = QtWidgets.QSpinBox()
-        self.overlap_size_spinbox.setRange(0, 1000)
-        self.overlap_size_spinbox.setValue(25)
-        self.overlap_size_spinbox.setStyleSheet(f"font-size: {FONTSIZE}px;")
+        overlap_size_label_layout, self.overlap_size_spinbox = self._get_spinbox(
+            "Overlap size:", HTEXT_OVERLAP_SIZE, -1, 1000, 25
+        )
+        # The minimum is shown as "Auto"
+        self.overlap_size_spinbox.setSpecialValueText("Auto")
         self.advanced_layout.addLayout(overlap_size_label_layout)
         self.advanced_layout.addWidget(self.overlap_size_spinbox)
 
-        self.advanced_group_box.setLayout(self.advanced_layout)
-        self.layout.addWidget(self.advanced_group_box)
+        # Feature cache size
+        cache_size_label_layout, self.cache_size_spinbox = self._get_spinbox(
+            "Feature cache size (GB):", HTEXT_FEATURE_CACHE, 0, 10000, DEFAULT_CACHE_SIZE_GB
+        )
+        self.advanced_layout.addLayout(cache_size_label_layout)
+        self.advanced_layout.addWidget(self.cache_size_spinbox)
+
+        # Feature precision
+        precision_label_layout, self.feature_precision_combo = self._get_combo_box(
+            "Feature precision:",
+            HTEXT_FEATURE_PRECISION,
+            lambda combo_box: combo_box.addItems(list(FEATURE_PRECISION_OPTIONS)),
+        )
+        self.advanced_layout.addLayout(precision_label_layout)
+        self.advanced_layout.addWidget(self.feature_precision_combo)
 
-    def run_classification(self):
-        """Run the classification algorithm."""
+        # Prefetch queue depth
+        queue_depth_label_layout, self.queue_depth_spinbox = self._get_spinbox(
+            "Prefetch queue depth:", HTEXT_QUEUE_DEPTH, 0, 16, DEFAULT_QUEUE_DEPTH
+        )
+        self.advanced_layout.addLayout(queue_depth_label_layout)
+        self.advanced_layout.addWidget(self.queue_depth_spinbox)
+
+        # Training sample
+        max_samples_label_layout, self.max_samples_spinbox = self._get_spinbox(
+            "Training pixels per class (0 for all):",
+            HTEXT_MAX_SAMPLES,
+            0,
+            100_000_000,
+            DEFAULT_MAX_SAMPLES_PER_CLASS,
+        )
+        self.max_samples_spinbox.setSingleStep(10000)
+        self.advanced_layout.addLayout(max_samples_label_layout)
+        self.advanced_layout.addWidget(self.max_samples_spinbox)
+
+        # Scheduler of Parallel mode, remembered between sessions
+        self._add_scheduler_options()
+
+        # Worker process
+        self.worker_checkbox = QtWidgets.QCheckBox("Run in a separate worker process")
+        self.worker_checkbox.setChecked(DEFAULT_USE_WORKER)
+        self.worker_checkbox.setStyleSheet(f"font-size: {FONTSIZE}px;")
+        self.worker_checkbox.setFixedHeight(LABEL_HEIGHT)
+        help_icon = _get_help_icon(HTEXT_WORKER)
+        help_icon.setFixedSize(HELP_ICON_SIZE, HELP_ICON_SIZE)
+        worker_layout = QtWidgets.QHBoxLayout()
+        worker_layout.addWidget(self.worker_checkbox)
+        worker_layout.addWidget(help_icon)
+        worker_layout.setAlignment(QtCore.Qt.AlignLeft)
+        self.advanced_layout.addLayout(worker_layout)
 
-        # Configure logger
-        self.logger = self._get_logger()
+        self.advanced_group_box.setLayout(self.advanced_layout)
+        self.layout.addWidget(self.advanced_group_box)
 
-        # Get the output path
-        output_path = Path(self.output_path_line_edit.text())
+    def _add_scheduler_options(self):
+        """Add the options of the Parallel mode scheduler, with their last values."""
+        settings = QgsSettings()
+        settings.beginGroup(SETTINGS_GROUP)
 
-        # Get file paths of the selected layers
-        raster_path = Path(
-            QgsProject.instance()
-            .mapLayersByName(self.raster_combo.currentText())[0]
-            .source()
+        scheduler_label_layout, self.scheduler_combo = self._get_combo_box(
+            "Parallel scheduler:",
+            HTEXT_SCHEDULER,
+            lambda combo_box: combo_box.addItems(list(SCHEDULER_OPTIONS)),
         )
-        pos_labels_path = Path(
-            QgsProject.instance()
-            .mapLayersByName(self.vec_positive_combo.currentText())[0]
-            .source()
+        scheduler_type = settings.value("scheduler_type", "threads")
+        for option, value in SCHEDULER_OPTIONS.items():
+            if value == scheduler_type:
+                self.scheduler_combo.setCurrentText(option)
+        self.advanced_layout.addLayout(scheduler_label_layout)
+        self.advanced_layout.addWidget(self.scheduler_combo)
+
+        workers_label_layout, self.scheduler_workers_spinbox = self._get_spinbox(
+            "Workers (0 for auto):",
+            HTEXT_SCHEDULER_WORKERS,
+            0,
+            256,
+            settings.value("n_workers", 0, type=int),
         )
-        neg_labels_path = Path(
-            QgsProject.instance()
-            .mapLayersByName(self.vec_negative_combo.currentText())[0]
-            .source()
+        self.advanced_layout.addLayout(workers_label_layout)
+        self.advanced_layout.addWidget(self.scheduler_workers_spinbox)
+
+        memory_label_layout, self.memory_limit_spinbox = self._get_spinbox(
+            "Memory limit per worker (GB, 0 for none):",
+            HTEXT_MEMORY_LIMIT,
+            0,
+            10000,
+            settings.value("memory_limit_gb", 0, type=int),
         )
+        self.advanced_layout.addLayout(memory_label_layout)
+        self.advanced_layout.addWidget(self.memory_limit_spinbox)
+
+        spill_label = QtWidgets.QLabel("Spill directory (optional):")
+        spill_label.setStyleSheet(f"font-size: {FONTSIZE}px;")
+        spill_label.setFixedHeight(LABEL_HEIGHT)
+        help_icon = _get_help_icon(HTEXT_SPILL_DIRECTORY)
+        help_icon.setFixedSize(HELP_ICON_SIZE, HELP_ICON_SIZE)
+        spill_label_layout = QtWidgets.QHBoxLayout()
+        spill_label_layout.addWidget(spill_label)
+        spill_label_layout.addWidget(help_icon)
+        spill_label_layout.setAlignment(QtCore.Qt.AlignLeft)
+        self.spill_directory_line_edit = QtWidgets.QLineEdit(
+            settings.value("spill_directory", "")
+        )
+        self.spill_directory_line_edit.setFixedSize(WIDGET_WIDTH, WIDGET_HEIGHT)
+        self.spill_directory_line_edit.setStyleSheet(f"font-size: {FONTSIZE}px;")
+        browse_button = QtWidgets.QPushButton("...")
+        browse_button.clicked.connect(self._browse_spill_directory)
+        browse_button.setFixedSize(32, WIDGET_HEIGHT)
+        spill_layout = QtWidgets.QHBoxLayout()
+        spill_layout.addWidget(self.spill_directory_line_edit)
+        spill_layout.addWidget(browse_button)
+        spill_layout.setAlignment(QtCore.Qt.AlignLeft)
+        self.advanced_layout.addLayout(spill_label_layout)
+        self.advanced_layout.addLayout(spill_layout)
+
+        settings.endGroup()
+
+    def _browse_spill_directory(self):
+        """Browse for the spill directory of the Parallel mode scheduler."""
+        folder = QtWidgets.QFileDialog.getExistingDirectory(self, "Select Folder")
+        if folder:
+            self.spill_directory_line_edit.setText(folder)
+
+    def _get_scheduler_settings(self):
+        """Get the Parallel mode scheduler settings of the dialog, and remember them."""
+        memory_limit_gb = self.memory_limit_spinbox.value()
+        scheduler = SchedulerSettings(
+            scheduler_type=SCHEDULER_OPTIONS[self.scheduler_combo.currentText()],
+            n_workers=self.scheduler_workers_spinbox.value() or None,
+            memory_limit=memory_limit_gb * 1024**3 or None,
+            spill_directory=self.spill_directory_line_edit.text() or None,
+        )
+
+        settings = QgsSettings()
+        settings.beginGroup(SETTINGS_GROUP)
+        settings.setValue("scheduler_type", scheduler.scheduler_type)
+        settings.setValue("n_workers", self.scheduler_workers_spinbox.value())
+        settings.setValue("memory_limit_gb", memory_limit_gb)
+        settings.setValue("spill_directory", self.spill_directory_line_edit.text())
+        settings.endGroup()
+        return scheduler
+
+    def run_classification(self, progress=None):
+        """Run the classification algorithm, with the settings read when the run started.
+
+        Runs in the ClassificationJob thread, so it reads no widgets or layers, see
+        RunSettings.
+
+        :param progress: optional Progress to report progress and check for cancellation
+        """
+        settings = self._settings
+        output_path = settings.output_path
+        self._resume_model = None
+        self.logger.info(f"Output Format: {settings.output_format}")
+
+        raster_path = settings.raster_path
         self.logger.info(f"Raster Layer: {raster_path}")
-        self.logger.info(f"Positive Vector Layer: {pos_labels_path}")
-        self.logger.info(f"Negative Vector Layer: {neg_labels_path}")
-
-        # Get Feature Type
-        feature_type = (
-            FeatureType.FLAIR
-            if self.feature_type_group.buttons()[0].isChecked()
-            else FeatureType.IDENTITY
-        )
-        self.logger.info(f"Feature Type: {feature_type}")
-
-        # Get Compute Mode
-        if self.compute_mode_group.buttons()[0].isChecked():
-            compute_mode = "normal"
-        elif self.compute_mode_group.buttons()[1].isChecked():
-            compute_mode = "parallel"
+        predict_only = settings.predict_only
+        if predict_only:
+            model_path = settings.model_path
+            self.logger.info(f"Model: {model_path}")
+            self._resume_model = (model_path, 0)
+        elif settings.class_labels is not None:
+            pos_labels, neg_labels, class_labels = None, None, settings.class_labels
+            classes = ", ".join(
+                f"{name} {len(labels)} features" for name, labels in class_labels.items()
+            )
+            self.logger.info(f"Classes: {classes}")
         else:
-            compute_mode = "safe"
+            pos_labels, neg_labels, class_labels = *settings.labels, None
+            pos_name, neg_name = settings.label_layer_names
+            self.logger.info(f"Positive Vector Layer: {pos_name}, {len(pos_labels)} features")
+            self.logger.info(f"Negative Vector Layer: {neg_name}, {len(neg_labels)} features")
+
+        # In predict only mode the feature type is read from the model
+        feature_type = settings.feature_type
+        if feature_type is not None:
+            self.logger.info(f"Feature Type: {feature_type}")
+        aoi = settings.aoi
+        if aoi is not None:
+            self.logger.info(f"Area of Interest: {settings.aoi_layer_name}, {len(aoi)} features")
+        skip_nodata = settings.skip_nodata
+        self.logger.info(f"Skip Nodata: {skip_nodata}")
+        compute_mode = settings.compute_mode
         self.logger.info(f"Compute Mode: {compute_mode}")
+        priority_bounds = settings.priority_bounds
+        if priority_bounds is not None:
+            self.logger.info(f"Map View First: {priority_bounds}")
 
-        # Get chunk size and overlap size
-        if self.advanced_group_box.isChecked():
-            chunk_size = self.chunk_size_spinbox.value()
-            overlap_size = self.overlap_size_spinbox.value()
+        chunk_size = settings.chunk_size
+        overlap_size = settings.overlap_size
+        if chunk_size is not None:
             self.logger.info(f"Chunk Size: {chunk_size}")
             self.logger.info(f"Overlap Size: {overlap_size}")
+        use_worker = settings.use_worker
+        feature_precision = settings.feature_precision
+        queue_depth = settings.queue_depth
+        max_samples_per_class = settings.max_samples_per_class
+        scheduler = settings.scheduler
+        self.logger.info(f"Feature Precision: {feature_precision}")
+        self.logger.info(f"Prefetch Queue Depth: {queue_depth}")
+        self.logger.info(f"Training Pixels per Class: {max_samples_per_class or 'all'}")
+        self.logger.info(f"Worker Process: {use_worker}")
+        if scheduler is not None:
+            self.logger.info(f"Parallel Scheduler: {scheduler}")
+
+        # Train and predict at a lower resolution only, as a temporary layer
+        if not predict_only and settings.preview_decimation is not None:
+            decimation = settings.preview_decimation
+            self.logger.info(f"Preview: 1/{decimation}")
+            preview_tif = self._run_pipeline(
+                "train_and_predict_preview",
+                progress,
+                use_worker,
+                raster_path=raster_path,
+                pos_labels_path=pos_labels,
+                neg_labels_path=neg_labels,
+                output_path=settings.preview_path,
+                feature_type=feature_type,
+                decimation=decimation,
+                chunk_overlap=overlap_size,
+                class_labels=class_labels,
+                max_samples_per_class=max_samples_per_class,
+            )
+            self._new_layers.append((preview_tif, f"{output_path.stem} preview 1/{decimation}"))
+            self._read_run_summary(preview_tif)
+            self.logger.info("Preview completed successfully!")
+            return
+
+        # Rasters to predict in batch mode
+        batch_raster_paths = settings.batch_raster_paths
+        if batch_raster_paths:
+            self.logger.info(f"Batch Rasters: {[p.as_posix() for p in batch_raster_paths]}")
+
+        # Plan compute mode, chunk size and workers for the largest raster
+        num_workers = None
+        if compute_mode == "auto":
+            if predict_only:
+                feature_type = load_model(model_path)[1]
+            plan = plan_compute(
+                largest_raster([raster_path] + batch_raster_paths),
+                feature_type,
+                chunk_overlap=overlap_size,
+                feature_precision=feature_precision,
+            )
+            compute_mode = plan.compute_mode
+            chunk_size = plan.chunk_size
+            num_workers = plan.num_workers
+
+        # Reuse extracted features from the on-disk cache
+        feature_cache = None
+        if settings.cache_size_gb > 0:
+            feature_cache = FeatureCache(
+                get_plugin_data_dir() / "feature_cache", settings.cache_size_gb * 1024**3
+            )
+
+        if predict_only:
+            prediction_tif = self._run_pipeline(
+                "predict_with_model",
+                progress,
+                use_worker,
+                raster_path=raster_path,
+                model_path=model_path,
+                output_path=output_path,
+                compute_mode=compute_mode,
+                chunks=chunk_size,
+                chunk_overlap=overlap_size,
+                feature_cache=feature_cache,
+                num_workers=num_workers,
+                priority_bounds=priority_bounds,
+                output_format=settings.output_format,
+                feature_precision=feature_precision,
+                queue_depth=queue_depth,
+                aoi=aoi,
+                skip_nodata=skip_nodata,
+                scheduler=scheduler,
+            )
         else:
-            chunk_size = None
-            overlap_size = None
+            # The model is saved when training is done, before the prediction starts
+            self._resume_model = (get_model_path(output_path), time.time())
+            prediction_tif = self._run_pipeline(
+                "train_and_predict",
+                progress,
+                use_worker,
+                raster_path=raster_path,
+                pos_labels_path=pos_labels,
+                neg_labels_path=neg_labels,
+                output_path=output_path,
+                feature_type=feature_type,
+                compute_mode=compute_mode,
+                chunks=chunk_size,
+                chunk_overlap=overlap_size,
+                feature_cache=feature_cache,
+                num_workers=num_workers,
+                priority_bounds=priority_bounds,
+                output_format=settings.output_format,
+                feature_precision=feature_precision,
+                queue_depth=queue_depth,
+                aoi=aoi,
+                skip_nodata=skip_nodata,
+                class_labels=class_labels,
+                max_samples_per_class=max_samples_per_class,
+                scheduler=scheduler,
+            )
+            model_path = get_model_path(output_path)
+        self._read_run_summary(prediction_tif)
+        # A prediction of the map view first was added while it was written
+        prediction_tifs = [prediction_tif] if priority_bounds is None else []
+
+        # Predict the other rasters with the same model
+        if batch_raster_paths:
+            prediction_tifs += self._run_pipeline(
+                "predict_batch",
+                progress,
+                use_worker,
+                raster_paths=batch_raster_paths,
+                model_path=model_path,
+                output_paths=get_batch_output_paths(output_path, batch_raster_paths),
+                compute_mode=compute_mode,
+                chunks=chunk_size,
+                chunk_overlap=overlap_size,
+                feature_cache=feature_cache,
+                num_workers=num_workers,
+                output_format=settings.output_format,
+                feature_precision=feature_precision,
+                queue_depth=queue_depth,
+                aoi=aoi,
+                skip_nodata=skip_nodata,
+                scheduler=scheduler,
+            )
+
+        # The new raster layers are added to QGIS in the GUI thread when the run finishes
+        self._new_layers += [(tif, tif.stem) for tif in prediction_tifs]
 
-        prediction_tif = read_input_and_labels_and_save_predictions(
-            raster_path,
-            pos_labels_path,
-            neg_labels_path,
+        self.logger.info("Classification completed successfully!")
+
+    def _get_run_settings(self):
+        """Read the settings of a run from the dialog and its layers, see RunSettings.
+
+        Widgets and layers can only be read safely in the GUI thread, so this is
+        called when the run starts.
+        """
+        raster_layers = QgsProject.instance().mapLayersByName(self.raster_combo.currentText())
+        if not raster_layers:
+            raise ValueError("Select a raster layer")
+        raster_layer = raster_layers[0]
+        # Writes a raster without a file to a GeoTIFF, which reads the layer
+        raster_path = get_raster_path(raster_layer)
+        predict_only = self.predict_only_checkbox.isChecked()
+        labels, class_labels, feature_type = None, None, None
+        if not predict_only:
+            if self.multi_class_group_box.isChecked():
+                class_labels = self._get_class_labels()
+            else:
+                labels = self._get_labels()
+            feature_type = (
+                FeatureType.FLAIR
+                if self.feature_type_group.buttons()[0].isChecked()
+                else FeatureType.IDENTITY
+            )
+
+        if self.advanced_group_box.isChecked():
+            overlap_size = self.overlap_size_spinbox.value()
+            advanced = dict(
+                chunk_size=self.chunk_size_spinbox.value(),
+                overlap_size=AUTO_CHUNK_OVERLAP if overlap_size < 0 else overlap_size,
+                cache_size_gb=self.cache_size_spinbox.value(),
+                use_worker=self.worker_checkbox.isChecked(),
+                feature_precision=FEATURE_PRECISION_OPTIONS[
+                    self.feature_precision_combo.currentText()
+                ],
+                queue_depth=self.queue_depth_spinbox.value(),
+                max_samples_per_class=self.max_samples_spinbox.value() or None,
+                # Also saves the scheduler settings, which is only safe in the GUI thread
+                scheduler=self._get_scheduler_settings(),
+            )
+        else:
+            advanced = dict(
+                chunk_size=None,
+                overlap_size=None,
+                cache_size_gb=DEFAULT_CACHE_SIZE_GB,
+                use_worker=DEFAULT_USE_WORKER,
+                feature_precision="float32",
+                queue_depth=DEFAULT_QUEUE_DEPTH,
+                max_samples_per_class=DEFAULT_MAX_SAMPLES_PER_CLASS,
+                scheduler=None,
+            )
+
+        output_path = Path(self.output_path_line_edit.text())
+        preview_decimation = (
+            self.preview_spinbox.value()
+            if not predict_only and self.preview_checkbox.isChecked()
+            else None
+        )
+        return RunSettings(
             output_path=output_path,
+            output_format=self._get_output_format(),
+            raster_path=raster_path,
+            predict_only=predict_only,
+            model_path=Path(self.model_path_line_edit.text()) if predict_only else None,
+            labels=labels,
+            label_layer_names=(
+                self.vec_positive_combo.currentText(),
+                self.vec_negative_combo.currentText(),
+            ),
+            class_labels=class_labels,
             feature_type=feature_type,
-            compute_mode=compute_mode,
-            chunks=chunk_size,
-            chunk_overlap=overlap_size,
-            logger_root=self.logger,
+            aoi=self._get_aoi(),
+            aoi_layer_name=self.aoi_combo.currentText(),
+            skip_nodata=self.skip_nodata_checkbox.isChecked(),
+            compute_mode=self.compute_mode_group.checkedButton().text().lower(),
+            priority_bounds=self._get_priority_bounds(raster_layer),
+            preview_decimation=preview_decimation,
+            preview_path=(
+                get_plugin_data_dir() / PREVIEW_DIR / f"{output_path.stem}_preview.tif"
+                if preview_decimation is not None
+                else None
+            ),
+            batch_raster_paths=(
+                self._get_batch_raster_paths(raster_path)
+                if self.batch_group_box.isChecked()
+                else []
+            ),
+            **advanced,
         )
 
-        # Add the new raster layer to QGIS
-        new_raster_layer = QgsRasterLayer(prediction_tif.as_posix(), "prediction")
-        if not new_raster_layer.isValid():
-            self.logger.error("Failed to load the raster layer!")
-        else:
-            QgsProject.instance().addMapLayer(new_raster_layer)
-
-        self.logger.info("Classification completed successfully!")
+    def _get_labels(self):
+        """Positive and negative label geometries in the CRS of the raster layer."""
+        project = QgsProject.instance()
+        raster_layers = project.mapLayersByName(self.raster_combo.currentText())
+        pos_layers = project.mapLayersByName(self.vec_positive_combo.currentText())
+        neg_layers = project.mapLayersByName(self.vec_negative_combo.currentText())
+        if not raster_layers or not pos_layers or not neg_layers:
+            raise ValueError("Select a raster layer and the vector layers with the labels")
+        if pos_layers[0].id() == neg_layers[0].id():
+            raise ValueError("Positive and negative labels must be different layers")
+        selected_only = self.selected_features_checkbox.isChecked()
+        return tuple(
+            get_label_geometries(layer, raster_layers[0].crs(), selected_only)
+            for layer in (pos_layers[0], neg_layers[0])
+        )
 
-    def _get_logger(self):
-        # Configure logger
-        logger = logging.getLogger(__name__)
-        formatter = logging.Formatter(
-            "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+    def _get_class_labels(self):
+        """Label geometries of each class in the CRS of the raster layer, in multi-class mode."""
+        project = QgsProject.instance()
+        raster_layers = project.mapLayersByName(self.raster_combo.currentText())
+        # In the order of the list, not of selection
+        items = sorted(self.class_layer_list.selectedItems(), key=self.class_layer_list.row)
+        class_layers = [project.mapLayersByName(item.text())[0] for item in items]
+        if not raster_layers or not class_layers:
+            raise ValueError("Select a raster layer and the vector layers of the classes")
+        class_labels = get_class_geometries(
+            class_layers,
+            raster_layers[0].crs(),
+            self.class_field_line_edit.text().strip(),
+            self.selected_features_checkbox.isChecked(),
+        )
+        if len(class_labels) < 2:
+            raise ValueError("Select the labels of at least two classes")
+        return class_labels
+
+    def _get_aoi(self):
+        """Area of interest geometries in the CRS of the raster layer, or None for no area."""
+        if self.aoi_combo.currentIndex() == 0:
+            return None
+        project = QgsProject.instance()
+        raster_layers = project.mapLayersByName(self.raster_combo.currentText())
+        aoi_layers = project.mapLayersByName(self.aoi_combo.currentText())
+        if not raster_layers or not aoi_layers:
+            raise ValueError("Select a raster layer and the vector layer of the area of interest")
+        aoi = get_label_geometries(aoi_layers[0], raster_layers[0].crs())
+        if not len(aoi):
+            raise ValueError("The area of interest layer has no features")
+        return aoi
+
+    def _read_run_summary(self, prediction_tif):
+        """Log the summary of the run report saved next to a prediction, and keep it to show."""
+        report_path = get_report_path(prediction_tif)
+        try:
+            self._run_summary = format_summary(read_report(report_path))
+        except (OSError, ValueError, KeyError) as e:
+            self.logger.warning(f"Could not read the run report {report_path}: {e}")
+            return
+        self.logger.info(f"Run report, saved to {report_path}:\n{self._run_summary}")
+
+    def _get_priority_bounds(self, raster_layer):
+        """Bounds of the map view in the CRS of the raster, or None to predict in order."""
+        if not (
+            self.map_view_first_checkbox.isEnabled() and self.map_view_first_checkbox.isChecked()
+        ):
+            return None
+        canvas = self.iface.mapCanvas()
+        extent, crs = canvas.extent(), canvas.mapSettings().destinationCrs()
+        transform = QgsCoordinateTransform(crs, raster_layer.crs(), QgsProject.instance())
+        extent = transform.transformBoundingBox(extent)
+        return (
+            extent.xMinimum(),
+            extent.yMinimum(),
+            extent.xMaximum(),
+            extent.yMaximum(),
         )
+
+    def _run_pipeline(self, function_name, progress, use_worker, **kwargs):
+        """Run a pipeline function in the worker process, or in this process."""
+        if use_worker:
+            worker = get_worker(get_plugin_data_dir() / "worker.log")
+            try:
+                if not worker.is_alive():
+                    worker.start()
+            except WorkerError as e:
+                self.logger.warning(f"{e}. Running in the QGIS process instead.")
+            else:
+                return worker.run(function_name, progress=progress, **kwargs)
+        return getattr(pipeline, function_name)(progress=progress, **kwargs)
+
+    def _get_log_handlers(self):
+        """Handlers of the log records of a run: the QGIS log and log files next to the output."""
+        formatter = logging.Formatter(LOG_FORMAT)
         # QGIS log handler
         qgis_handler = QgisLogHandler()
         qgis_handler.setLevel(logging.INFO)
@@ -403,49 +1253,137 @@ class CoeusAIDialog(QtWidgets.QDialog):
         # Get the output path
         output_path = Path(self.output_path_line_edit.text())
 
+        # File handlers open their file when the first record is written, in the listener thread
         # File handler INFO
         file_handler_info = logging.FileHandler(
-            f"{output_path.with_suffix('.info.log')}"
+            f"{output_path.with_suffix('.info.log')}", delay=True
         )
         file_handler_info.setLevel(logging.INFO)
         file_handler_info.setFormatter(formatter)
 
         # File handler DEBUG
         file_handler_debug = logging.FileHandler(
-            f"{output_path.with_suffix('.debug.log')}"
+            f"{output_path.with_suffix('.debug.log')}", delay=True
         )
         file_handler_debug.setLevel(logging.DEBUG)
         file_handler_debug.setFormatter(formatter)
 
-        # Add the handlers to the logger
-        logger.addHandler(qgis_handler)
-        logger.addHandler(file_handler_info)
-        logger.addHandler(file_handler_debug)
+        return [qgis_handler, file_handler_info, file_handler_debug]
 
-        return logger
+    def get_resume_model(self):
+        """Path of the model a cancelled run can be resumed with, None if it was not saved yet."""
+        if self._resume_model is None:
+            return None
+        model_path, saved_after = self._resume_model
+        # A model of an earlier run with the same output path cannot resume this run
+        if not model_path.exists() or model_path.stat().st_mtime < saved_after:
+            return None
+        return model_path
 
     def start_classification(self):
         """Start the classification process in a separate thread."""
+        try:
+            self._settings = self._get_run_settings()
+        except ValueError as e:
+            self.progress_label.setText(str(e))
+            return
+
         self.run_button.setEnabled(False)  # Set the run button to be disabled
+        self.cancel_button.setEnabled(True)
+        self.progress_bar.setValue(0)
+        self.progress_label.setText("Starting...")
         self.repaint()
 
-        self.job = ClassificationJob(self)
+        self._partial_layers = {}
+        self._new_layers = []
+        self._run_summary = ""
+        self.report_text.clear()
+        if self._settings.preview_path is not None:
+            self._remove_preview()
+
+        self.job = ClassificationJob(self, self._get_log_handlers())
+        self.job.progress_changed.connect(self._update_progress)
+        self.job.output_updated.connect(self._show_partial_output)
+        self.job.finished.connect(self._classification_finished)
         self.job.start()
 
+    def cancel_classification(self):
+        """Stop the classification at the next chunk boundary."""
+        if self.job and self.job.isRunning():
+            self.job.cancel()
+            self.cancel_button.setEnabled(False)
+            self.progress_label.setText("Cancelling after the current chunk...")
+
+    def _update_progress(self, stage, done, total, pixels_per_second, eta):
+        """Show the progress reported by the classification job."""
+        if total:
+            self.progress_bar.setRange(0, total)
+            self.progress_bar.setValue(done)
+            text = f"{stage}: {done}/{total} chunks"
+        else:
+            # Busy indicator for stages without chunks
+            self.progress_bar.setRange(0, 0)
+            text = f"{stage}..."
+        if pixels_per_second > 0:
+            text += f", {pixels_per_second / 1e6:.2f} Mpixels/s"
+        if eta >= 0:
+            text += f", {_format_duration(eta)} left"
+        self.progress_label.setText(text)
+
+    def _show_partial_output(self, path):
+        """Add an output that is being written to QGIS, or refresh it."""
+        path = Path(path)
+        if path in self._partial_layers:
+            layer = QgsProject.instance().mapLayer(self._partial_layers[path])
+            if layer is not None:  # None if the layer was removed from the project
+                layer.dataProvider().reloadData()
+                layer.triggerRepaint()
+            return
+        layer = QgsRasterLayer(path.as_posix(), path.stem)
+        if layer.isValid():
+            QgsProject.instance().addMapLayer(layer)
+            self._partial_layers[path] = layer.id()
+
+    def _remove_preview(self):
+        """Remove the last preview from the project and from disk, before a new one is written."""
+        if self._preview_layer_id is not None:
+            if QgsProject.instance().mapLayer(self._preview_layer_id) is not None:
+                QgsProject.instance().removeMapLayer(self._preview_layer_id)
+            self._preview_layer_id = None
+        shutil.rmtree(self._settings.preview_path.parent, ignore_errors=True)
+        self._settings.preview_path.parent.mkdir(parents=True, exist_ok=True)
+
+    def _add_new_layers(self):
+        """Add the outputs of the run to QGIS."""
+        for path, name in self._new_layers:
+            layer = QgsRasterLayer(path.as_posix(), name)
+            if not layer.isValid():
+                QgsMessageLog.logMessage(
+                    f"Failed to load the raster layer {path}!", "CoeusAI", Qgis.Critical
+                )
+                continue
+            QgsProject.instance().addMapLayer(layer)
+            if path == self._settings.preview_path:
+                self._preview_layer_id = layer.id()
+        self._new_layers = []
+
+    def _classification_finished(self):
+        """Reset the buttons when the classification job ends, and add its outputs to QGIS."""
+        self._add_new_layers()
+        self.run_button.setEnabled(True)
+        self.cancel_button.setEnabled(False)
+        self.progress_bar.setRange(0, 1)
+        self.progress_bar.setValue(1 if self.job.succeeded else 0)
+        self.progress_label.setText(self.job.status)
+        self.report_text.setPlainText(self._run_summary)
+
     def closeEvent(self, event):
         """Handle the dialog close event."""
+        # Stop at a chunk boundary, so the output is not left half-written
         if self.job and self.job.isRunning():
-            self.job.terminate()
+            self.job.cancel()
             self.job.wait()
         event.accept()
-        
-        # Close the logger
-        if self.logger is not None:
-            handlers = self.logger.handlers[:]
-            for handler in handlers:
-                handler.close()
-                self.logger.removeHandler(handler)
-            del self.logger # Delete the logger, pycoeus made it global
 
     def _populate_raster_combo(self, combo_box):
         """Populate the raster combo box with the loaded raster layers."""
@@ -459,6 +1397,11 @@ class CoeusAIDialog(QtWidgets.QDialog):
             if isinstance(layer, QgsVectorLayer):
                 combo_box.addItem(layer.name())
 
+    def _populate_aoi_combo(self, combo_box):
+        """Populate the area of interest combo box with no area and the loaded vector layers."""
+        combo_box.addItem("None")
+        self._populate_vector_combo(combo_box)
+
 
 def _get_help_icon(text: str):
     """Create a help button with the given text."""
@@ -475,6 +1418,15 @@ def _get_help_icon(text: str):
     return help_icon
 
 
+def _format_duration(seconds):
+    """Format a duration in seconds as text."""
+    if seconds < 60:
+        return f"{seconds:.0f} s"
+    if seconds < 3600:
+        return f"{seconds / 60:.0f} min"
+    return f"{seconds / 3600:.1f} h"
+
+
 def _sort_layers(layers):
     """Get all layers sorted by active layers first."""
     layer_tree_root = QgsProject.instance().layerTreeRoot()
@@ -510,14 +1462,72 @@ class RadioButtonWithHelp(QtWidgets.QWidget):
         self.setFixedHeight(LABEL_HEIGHT)
 
 
+class RunSettings(NamedTuple):
+    """Settings of a run, read from the dialog in the GUI thread when the run starts."""
+
+    output_path: Path
+    output_format: str  # One of the output format names of the pipeline
+    raster_path: Path  # A raster layer without a file is written to a GeoTIFF, see get_raster_path
+    predict_only: bool
+    model_path: Optional[Path]  # Model to predict with in predict only mode
+    labels: Optional[tuple]  # Positive and negative label geometries, in two-class mode
+    label_layer_names: tuple  # Names of the positive and negative label layers
+    class_labels: Optional[dict]  # Label geometries of each class, in multi-class mode
+    feature_type: Optional[FeatureType]  # None in predict only mode, it is read from the model
+    aoi: object  # GeoSeries of the area of interest, None for the whole raster
+    aoi_layer_name: str
+    skip_nodata: bool
+    compute_mode: str  # "auto", "normal", "parallel" or "safe"
+    priority_bounds: Optional[tuple]  # Map view to predict first, in the CRS of the raster
+    preview_decimation: Optional[int]  # Only train and predict a preview at 1/decimation
+    preview_path: Optional[Path]  # Path of the preview, which replaces the last preview
+    batch_raster_paths: list  # Other rasters to predict with the model
+    chunk_size: Optional[int]
+    overlap_size: Union[int, str, None]  # Pixels, AUTO_CHUNK_OVERLAP, or None for the default
+    cache_size_gb: int
+    use_worker: bool
+    feature_precision: str
+    queue_depth: int
+    max_samples_per_class: Optional[int]  # None for all labelled pixels
+    scheduler: Optional[SchedulerSettings]
+
+
 class ClassificationJob(QThread):
+    # Stage, chunks done, total chunks, pixels per second, seconds left
+    progress_changed = QtCore.pyqtSignal(str, int, int, float, float)
+    # Path of an output that is being written
+    output_updated = QtCore.pyqtSignal(str)
 
-    def __init__(self, dialog):
+    def __init__(self, dialog, log_handlers):
         super().__init__()
         self.dialog = dialog
+        # Handle the log records of this run only, see run_logging
+        self.log_handlers = log_handlers
+        # The progress callback is called from this thread, the signal is handled in the GUI thread
+        self.progress = Progress(self.progress_changed.emit, self.output_updated.emit)
+        self.succeeded = False
+        self.status = ""
+
+    def cancel(self):
+        """Request the job to stop at the next chunk boundary."""
+        self.progress.cancel()
 
     def run(self):
-        try:
-            self.dialog.run_classification()
-        except Exception as e:
-           self.dialog.logger.error(f"Error: {str(e)}")
+        with run_logging(self.log_handlers):
+            try:
+                self.dialog.run_classification(self.progress)
+                self.succeeded = True
+                self.status = "Classification completed"
+            except ClassificationCancelled:
+                self.status = "Classification cancelled"
+                model_path = self.dialog.get_resume_model()
+                if model_path is None:
+                    self.dialog.logger.info("Classification cancelled.")
+                else:
+                    self.dialog.logger.info(
+                        "Classification cancelled. The chunks written so far are kept, "
+                        f"run again in predict only mode with the model {model_path} to resume."
+                    )
+            except Exception as e:
+                self.status = "Classification failed, see the log messages"
+                self.dialog.logger.error(f"Error: {str(e)}")
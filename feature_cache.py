@@ -0,0 +1,159 @@
+import hashlib
+import logging
+import os
+from contextlib import contextmanager
+from pathlib import Path
+
+from .feature_store import FEATURE_STORE_SUFFIX, PARTIAL_SUFFIX
+
+try:
+    import fcntl
+except ImportError:  # Windows, which does not remove files that are open
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CACHE_SIZE_GB = 20  # Default size limit of the feature cache
+CACHE_SUFFIX = ".tif"  # pycoeus writes the features as GeoTIFF
+LOCK_SUFFIX = ".lock"  # Lock file of an entry, held by the runs that use it
+
+
+class FeatureCache:
+    """On-disk cache of extracted features with a size limit and LRU eviction.
+
+    Each entry is a feature GeoTIFF written by pycoeus, or a FeatureStore in
+    Safe mode. The file name is a hash of
+    the raster path, its modification time and size, the feature type, the chunk
+    size and the overlap, so a changed raster or changed settings never hit a stale
+    entry. The modification time of an entry is used as its last access time.
+
+    Several runs, also in other processes, may share a cache. An entry that a run
+    uses, see use, is not evicted: on Windows because an open file cannot be
+    removed, elsewhere because the run holds a shared lock on its lock file.
+    Partially written entries of runs that failed are removed on eviction.
+    """
+
+    def __init__(self, cache_dir, max_size_bytes):
+        self.cache_dir = Path(cache_dir)
+        self.max_size_bytes = max_size_bytes
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+
+    def get_path(
+        self, raster_path, feature_type, chunk_size=None, chunk_overlap=None, suffix=CACHE_SUFFIX
+    ):
+        """Get the cache path of the features of a raster.
+
+        The entry is marked as recently used if it exists. pycoeus extracts and
+        saves the features to this path if it does not.
+
+        :param suffix: CACHE_SUFFIX for a feature GeoTIFF, FEATURE_STORE_SUFFIX for a FeatureStore
+        """
+        path = self.cache_dir / (
+            _cache_key(raster_path, feature_type, chunk_size, chunk_overlap) + suffix
+        )
+        if path.exists():
+            logger.info(f"Feature cache hit: {path}")
+            os.utime(path)
+        else:
+            logger.info(f"Feature cache miss, features will be saved to: {path}")
+        return path
+
+    def add(self, path):
+        """Register a newly written entry and evict old entries if over the size limit."""
+        if Path(path).exists():
+            os.utime(path)
+        self.evict(keep=path)
+
+    @contextmanager
+    def use(self, path):
+        """Keep other runs from evicting an entry while the block uses or writes it."""
+        if fcntl is None:
+            yield
+            return
+        with open(_lock_path(path), "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_SH)
+            yield
+
+    def discard(self, path):
+        """Remove an entry, e.g. one that was only partially written."""
+        Path(path).unlink(missing_ok=True)
+
+    def size(self):
+        """Total size of the cache in bytes."""
+        return sum(entry.stat().st_size for entry in self._entries())
+
+    def evict(self, keep=None):
+        """Remove least recently used entries until the cache fits in the size limit.
+
+        Partially written entries are removed too, unless a run is still writing them.
+        Entries in use by a run are skipped.
+        """
+        entries = sorted(
+            ((entry, entry.stat()) for entry in self._entries()), key=lambda e: e[1].st_mtime
+        )
+        total_size = sum(stat.st_size for _, stat in entries)
+        for entry, stat in entries:
+            partial = entry.name.endswith(PARTIAL_SUFFIX)
+            if not partial and total_size <= self.max_size_bytes:
+                continue
+            if keep is not None and entry == Path(keep):
+                continue
+            if _remove_unused(entry):
+                total_size -= stat.st_size
+                logger.info(f"Evicted from feature cache: {entry}")
+            else:
+                logger.info(f"Not evicted from feature cache, in use: {entry}")
+        # Lock files of entries that were discarded
+        for lock_path in self.cache_dir.glob(f"*{LOCK_SUFFIX}"):
+            entry = lock_path.with_name(lock_path.name[: -len(LOCK_SUFFIX)])
+            partial = entry.with_name(entry.name + PARTIAL_SUFFIX)
+            if not entry.exists() and not partial.exists():
+                _remove_unused(entry)
+
+    def _entries(self):
+        suffixes = (CACHE_SUFFIX, FEATURE_STORE_SUFFIX, FEATURE_STORE_SUFFIX + PARTIAL_SUFFIX)
+        return [p for suffix in suffixes for p in self.cache_dir.glob(f"*{suffix}") if p.is_file()]
+
+
+def _remove_unused(entry):
+    """Remove an entry and its lock file, return False if a run uses it."""
+    try:
+        if fcntl is None:
+            entry.unlink(missing_ok=True)
+            return True
+        lock_path = _lock_path(entry)
+        with open(lock_path, "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            entry.unlink(missing_ok=True)
+            lock_path.unlink(missing_ok=True)
+        return True
+    except OSError:
+        # Locked by a run, or open in a run on Windows
+        return False
+
+
+def _lock_path(path):
+    """Lock file of an entry, the same for the entry and its partially written file."""
+    name = Path(path).name
+    if name.endswith(PARTIAL_SUFFIX):
+        name = name[: -len(PARTIAL_SUFFIX)]
+    return Path(path).with_name(name + LOCK_SUFFIX)
+
+
+def _cache_key(raster_path, feature_type, chunk_size, chunk_overlap):
+    """Hash the raster identity and the feature settings into a file name."""
+    raster_path = Path(raster_path).resolve()
+    stat = raster_path.stat()
+    key = "|".join(
+        str(part)
+        for part in (
+            raster_path.as_posix(),
+            stat.st_mtime_ns,
+            stat.st_size,
+            feature_type.name,
+            chunk_size,
+            chunk_overlap,
+        )
+    )
+    digest = hashlib.sha1(key.encode("utf-8")).hexdigest()[:16]
+    return f"{raster_path.stem}_{feature_type.name}_{digest}"
@@ -0,0 +1,278 @@
+import logging
+import math
+import os
+from pathlib import Path
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+FEATURE_STORE_SUFFIX = ".npy"  # The feature store is a NumPy file that can be memory-mapped
+PARTIAL_SUFFIX = ".partial"  # Added to the path of a feature store while it is written
+# Precisions features can be stored in: uint8 is quantized per tile and feature
+FEATURE_PRECISIONS = ("float32", "float16", "uint8")
+UINT8_LEVELS = 255  # Quantized features range from 0 to 255
+
+
+class FeatureStore:
+    """Features of a raster in a memory-mapped file on disk, stored tile by tile.
+
+    The file is a .npy array with shape [tile rows, tile columns, features, tile
+    size, tile size], so the features of a tile are contiguous on disk. Tiles at
+    the right and bottom edge of the raster are padded. Reading a tile gives a
+    view of the memory map without copying, and the OS page cache decides which
+    tiles stay in memory, so memory use does not grow with the raster size.
+
+    Features are stored in one of FEATURE_PRECISIONS. In uint8 each tile is a
+    record of the quantized features with the offset and scale of each feature
+    in the tile, see quantize, and reading a tile gives a float32 copy.
+
+    A store is written to a partial file that is renamed when all tiles are
+    written, so a store that exists is complete.
+    """
+
+    def __init__(self, path, data, height, width):
+        self.path = Path(path)
+        self.data = data
+        self.height = height
+        self.width = width
+        self.tile_size = self._codes.shape[-1]
+
+    @classmethod
+    def create(
+        cls, path, n_features, height, width, tile_size, feature_precision="float32"
+    ):
+        """Create an empty store, at the partial path of path until it is completed."""
+        n_tiles = (math.ceil(height / tile_size), math.ceil(width / tile_size))
+        if feature_precision == "uint8":
+            dtype = np.dtype(
+                [
+                    ("offset", np.float32, (n_features,)),
+                    ("scale", np.float32, (n_features,)),
+                    ("codes", np.uint8, (n_features, tile_size, tile_size)),
+                ]
+            )
+            shape = n_tiles
+        else:
+            dtype = np.dtype(feature_precision)
+            shape = (*n_tiles, n_features, tile_size, tile_size)
+        partial_path = _partial_path(path)
+        data = np.lib.format.open_memmap(partial_path, mode="w+", dtype=dtype, shape=shape)
+        logger.info(
+            f"Created feature store {partial_path} of {data.nbytes / 1024**3:.2f} GB "
+            f"for {n_features} features in {feature_precision}"
+        )
+        return cls(path, data, height, width)
+
+    @classmethod
+    def open(cls, path, height, width):
+        """Open a completed store read-only."""
+        return cls(path, np.load(path, mmap_mode="r"), height, width)
+
+    @property
+    def shape(self):
+        """Shape of the features, [features, y, x]."""
+        return (self._codes.shape[2], self.height, self.width)
+
+    @property
+    def dtype(self):
+        """Type of the features as read, quantized features are read as float32."""
+        return np.dtype(np.float32) if self.quantized else self.data.dtype
+
+    @property
+    def ndim(self):
+        return 3
+
+    @property
+    def quantized(self):
+        return self.data.dtype.names is not None
+
+    @property
+    def feature_precision(self):
+        return "uint8" if self.quantized else self.data.dtype.name
+
+    @property
+    def n_tiles(self):
+        """Number of tile rows and tile columns."""
+        return self._codes.shape[:2]
+
+    @property
+    def _codes(self):
+        """The stored features, quantized or not, as [tile rows, tile columns, features, y, x]."""
+        return self.data["codes"] if self.quantized else self.data
+
+    def tile_window(self, i_row, i_col):
+        """Row and column offset, height and width of a tile within the raster."""
+        row, col = i_row * self.tile_size, i_col * self.tile_size
+        return (
+            row,
+            col,
+            min(self.tile_size, self.height - row),
+            min(self.tile_size, self.width - col),
+        )
+
+    def write(self, features, row=0, col=0, bands=slice(None)):
+        """Write [features, y, x] features at a tile corner, they may cover several tiles.
+
+        :param bands: the features of the store that are written, e.g. the features of
+            one band of the raster
+        """
+        size = self.tile_size
+        if row % size or col % size:
+            msg = f"Features must be written at a tile corner, not at row {row}, column {col}."
+            raise ValueError(msg)
+        row_stop, col_stop = row + features.shape[1], col + features.shape[2]
+        for i_row in range(row // size, math.ceil(row_stop / size)):
+            for i_col in range(col // size, math.ceil(col_stop / size)):
+                top, left = i_row * size - row, i_col * size - col
+                tile_features = features[:, top : top + size, left : left + size]
+                height, width = tile_features.shape[1:]
+                if self.quantized:
+                    codes, offset, scale = quantize(tile_features)
+                    self.data["codes"][i_row, i_col, bands, :height, :width] = codes
+                    self.data["offset"][i_row, i_col, bands] = offset
+                    self.data["scale"][i_row, i_col, bands] = scale
+                else:
+                    self.data[i_row, i_col, bands, :height, :width] = tile_features
+
+    def write_tile(self, i_row, i_col, tile_data):
+        """Write the [features, y, x] features of a tile."""
+        self.write(tile_data, i_row * self.tile_size, i_col * self.tile_size)
+
+    def complete(self):
+        """Flush a new store to disk and move it from the partial path to its path."""
+        self.data.flush()
+        # The memory map is closed before the file is moved, which Windows requires
+        self.data = None
+        os.replace(_partial_path(self.path), self.path)
+        self.data = np.load(self.path, mmap_mode="r")
+
+    def __getstate__(self):
+        # Worker processes map a completed store themselves, instead of receiving a copy of it
+        state = dict(self.__dict__)
+        state["data"] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.data = np.load(self.path, mmap_mode="r")
+
+    def discard(self):
+        """Remove a new store that was not completed, e.g. after a cancelled run."""
+        self.data = None
+        _partial_path(self.path).unlink(missing_ok=True)
+
+    def __getitem__(self, key):
+        """Features of [features, y, x] slices, as a view when they are within one tile."""
+        bands, rows, cols = key
+        row_start, row_stop, _ = rows.indices(self.height)
+        col_start, col_stop, _ = cols.indices(self.width)
+        n_bands = len(range(*bands.indices(self.shape[0])))
+        if row_stop <= row_start or col_stop <= col_start:
+            return np.empty((n_bands, 0, 0), dtype=self.dtype)
+
+        size = self.tile_size
+        i_row, i_col = row_start // size, col_start // size
+        if row_stop <= (i_row + 1) * size and col_stop <= (i_col + 1) * size:
+            return self._read_tile(
+                i_row,
+                i_col,
+                bands,
+                slice(row_start - i_row * size, row_stop - i_row * size),
+                slice(col_start - i_col * size, col_stop - i_col * size),
+            )
+
+        result = np.empty((n_bands, row_stop - row_start, col_stop - col_start), self.dtype)
+        for i_row in range(row_start // size, math.ceil(row_stop / size)):
+            for i_col in range(col_start // size, math.ceil(col_stop / size)):
+                top, bottom = max(row_start, i_row * size), min(row_stop, (i_row + 1) * size)
+                left, right = max(col_start, i_col * size), min(col_stop, (i_col + 1) * size)
+                tile_rows = slice(top - i_row * size, bottom - i_row * size)
+                tile_cols = slice(left - i_col * size, right - i_col * size)
+                result_rows = slice(top - row_start, bottom - row_start)
+                result_cols = slice(left - col_start, right - col_start)
+                result[:, result_rows, result_cols] = self._read_tile(
+                    i_row, i_col, bands, tile_rows, tile_cols
+                )
+        return result
+
+    def to_dask(self):
+        """The features as a dask array with one chunk per tile."""
+        # Imported on first use, dask.array takes a second to import and the plugin
+        # imports this module when QGIS starts
+        import dask.array as da
+
+        n_rows, n_cols = self.n_tiles
+        chunks = (
+            (self.shape[0],),
+            tuple(self.tile_window(i_row, 0)[2] for i_row in range(n_rows)),
+            tuple(self.tile_window(0, i_col)[3] for i_col in range(n_cols)),
+        )
+        return da.from_array(
+            self,
+            chunks=chunks,
+            name=f"feature-store-{self.path.as_posix()}",
+            lock=False,
+            meta=np.empty((0, 0, 0), dtype=self.dtype),
+        )
+
+    def _read_tile(self, i_row, i_col, bands, rows, cols):
+        """Features of a part of a tile, a view unless they are quantized."""
+        if not self.quantized:
+            return self.data[i_row, i_col, bands, rows, cols]
+        return dequantize(
+            self.data["codes"][i_row, i_col, bands, rows, cols],
+            self.data["offset"][i_row, i_col, bands],
+            self.data["scale"][i_row, i_col, bands],
+        )
+
+
+def quantize(features):
+    """Quantize [features, y, x] features to uint8, with an offset and scale per feature.
+
+    Each feature is mapped linearly from its minimum and maximum to 0 and
+    UINT8_LEVELS, so the error is at most half a step of its range.
+
+    :return: uint8 codes, float32 offsets and float32 scales
+    """
+    flat = features.reshape(features.shape[0], -1)
+    if flat.shape[1] == 0:
+        offset = np.zeros(features.shape[0], dtype=np.float32)
+        return features.astype(np.uint8), offset, np.ones_like(offset)
+    offset = flat.min(axis=1).astype(np.float32)
+    scale = ((flat.max(axis=1) - offset) / UINT8_LEVELS).astype(np.float32)
+    # Constant features are all 0
+    scale[scale == 0] = 1
+    codes = np.rint((features - offset[:, None, None]) / scale[:, None, None])
+    return np.clip(codes, 0, UINT8_LEVELS).astype(np.uint8), offset, scale
+
+
+def dequantize(codes, offset, scale):
+    """Features in float32 from uint8 codes, see quantize."""
+    return codes * scale[:, None, None] + offset[:, None, None]
+
+
+def reduce_precision(features, feature_precision):
+    """Features with the loss of precision of storing them, as read from a store."""
+    match feature_precision:
+        case "float32":
+            return features
+        case "float16":
+            return features.astype(np.float16)
+        case "uint8":
+            return dequantize(*quantize(features))
+        case _:
+            msg = f"Invalid feature precision: {feature_precision}"
+            raise ValueError(msg)
+
+
+def get_store_suffix(feature_precision):
+    """Suffix of the file of a store, with the precision in it unless it is float32."""
+    if feature_precision == "float32":
+        return FEATURE_STORE_SUFFIX
+    return f".{feature_precision}{FEATURE_STORE_SUFFIX}"
+
+
+def _partial_path(path):
+    path = Path(path)
+    return path.with_name(path.name + PARTIAL_SUFFIX)
@@ -0,0 +1,2045 @@
+import json
+import logging
+import math
+import os
+import pickle
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, ExitStack
+from pathlib import Path
+
+import dask
+import dask.array as da
+import geopandas as gpd
+import numpy as np
+import rasterio
+import rasterio.shutil
+import xarray as xr
+from rasterio.enums import Resampling
+from rasterio.features import geometry_mask, rasterize
+from rasterio.windows import Window, from_bounds
+from rioxarray.rioxarray import affine_to_coords
+from shapely.geometry import box
+from pycoeus.features import (
+    get_features,
+    get_features_path,
+    extract_flair_features,
+    FeatureType,
+    DEFAULT_CHUNK_OVERLAP,
+    NUM_FLAIR_CLASSES,
+)
+from pycoeus.logging_config import log_duration
+from pycoeus.main import get_classifier
+from pycoeus.utils.io import read_geotiff
+
+from .feature_cache import CACHE_SUFFIX
+from .feature_store import (
+    FeatureStore,
+    FEATURE_PRECISIONS,
+    get_store_suffix,
+    reduce_precision,
+)
+from .planner import resolve_chunk_overlap
+from .prefetch import AsyncWriter, ThreadLocalRaster, prefetch, DEFAULT_QUEUE_DEPTH
+from .progress import Progress, ClassificationCancelled
+from .region import ValidRegion
+from .scheduler import scheduler_active, use_scheduler
+from .run_logging import submit
+from .run_report import RunReport, get_report_path
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CHUNKS = {"band": 1, "x": 1024, "y": 1024}  # Same default as pycoeus
+MODEL_SUFFIX = ".model.pkl"  # Suffix of the model file saved next to the prediction
+RESUME_SUFFIX = ".resume.json"  # Suffix of the file with the chunks written so far
+OUTPUT_BLOCK_SIZE = 256  # Tile size of the prediction GeoTIFF
+REFRESH_INTERVAL = 2.0  # Minimum seconds between updates of a progressively written output
+DEFAULT_PREVIEW_DECIMATION = 8  # A preview is made at 1/8 of the resolution of the raster
+# Output formats: float64 probabilities in a GeoTIFF, uint8 probabilities and classes in a COG
+OUTPUT_FORMATS = ("geotiff", "cog_probability", "cog_class", "cog_class_probability")
+PARTIAL_SUFFIX = ".partial.tif"  # Suffix of the GeoTIFF a COG is streamed to before conversion
+UINT8_NODATA = 255  # Nodata value of uint8 outputs
+MAX_CLASSES = UINT8_NODATA  # Classes 0 to 254 fit in uint8 outputs, next to the nodata value
+BINARY_CLASSES = ("negative", "positive")  # Class names of negative and positive labels, 0 and 1
+PROBABILITY_SCALE = 254  # A probability of 1 is stored as 254 in uint8 outputs
+COG_BLOCK_SIZE = 512  # Tile size of COG outputs
+PRECISION_CHECK_PIXELS = 20000  # Labelled pixels sampled to compare reduced and full precision
+PRECISION_TEST_FRACTION = 0.25  # Fraction of the sampled pixels held out to test on
+PRECISION_CHECK_SEED = 0  # Seed of the sample, so runs compare on the same pixels
+TRAINING_SEED = 0  # Seed of the training sample and classifier, so runs are reproducible
+# Labelled pixels per class a classifier is trained on at most, as pycoeus prepare_training_data
+DEFAULT_MAX_SAMPLES_PER_CLASS = 10000
+
+
+@contextmanager
+def _run_compute_config():
+    """Restore the dask scheduler and number of workers set during a run when it ends.
+
+    set_compute_mode sets them without a with block, as a run switches between
+    modes, e.g. to read a feature store in parallel after writing it in safe mode.
+    Entering dask.config.set with their current values restores them on exit.
+    """
+    with dask.config.set(
+        scheduler=dask.config.get("scheduler", None),
+        num_workers=dask.config.get("num_workers", None),
+    ):
+        yield
+
+
+@_run_compute_config()
+def train_and_predict(
+    raster_path,
+    pos_labels_path,
+    neg_labels_path,
+    output_path,
+    feature_type=FeatureType.FLAIR,
+    compute_mode="normal",
+    chunks=None,
+    chunk_overlap=None,
+    feature_cache=None,
+    model_path=None,
+    num_workers=None,
+    priority_bounds=None,
+    output_format="geotiff",
+    feature_precision="float32",
+    queue_depth=DEFAULT_QUEUE_DEPTH,
+    aoi=None,
+    skip_nodata=False,
+    class_labels=None,
+    max_samples_per_class=DEFAULT_MAX_SAMPLES_PER_CLASS,
+    scheduler=None,
+    progress=None,
+):
+    """Train a classifier on the labels, predict the raster and save the model.
+
+    Follows the same steps as pycoeus.main.read_input_and_labels_and_save_predictions,
+    but keeps training and prediction apart so that the trained model can be saved.
+    Training only reads the raster under the labels, see train_on_label_windows,
+    the whole raster is only read to predict it, see predict_with_model. In
+    "safe" mode, or with a reduced feature precision, the features are extracted
+    once into a FeatureStore, and training and prediction both read them from it,
+    unless the prediction is restricted to a ValidRegion: the store then only
+    has the tiles of the region, and training extracts the label windows itself.
+
+    With class_labels, one classifier is trained on all classes, on a single
+    pass of feature extraction, see get_class_labels.
+
+    :param raster_path: path to the input raster
+    :param pos_labels_path: path to the vector file with positive labels, or a GeoSeries,
+        None with class_labels
+    :param neg_labels_path: path to the vector file with negative labels, or a GeoSeries,
+        None with class_labels
+    :param output_path: path of the prediction GeoTIFF, the run report is saved next to it,
+        see get_report_path
+    :param feature_type: See pycoeus FeatureType enum for options
+    :param compute_mode: one of "normal", "parallel" or "safe"
+    :param chunks: chunk size used in "parallel" and "safe" mode
+    :param chunk_overlap: overlap between chunks for feature extraction, or "auto" to derive it
+        from the receptive field of the features, see planner.get_min_chunk_overlap
+    :param feature_cache: optional FeatureCache to reuse extracted features
+    :param model_path: path of the saved model, defaults to next to the prediction
+    :param num_workers: number of parallel chunks in "parallel" mode, defaults to dask's default
+    :param priority_bounds: optional (left, bottom, right, top) in the raster CRS to predict
+        first, the output is then updated while it is written, see save_prediction
+    :param output_format: one of OUTPUT_FORMATS, see save_prediction
+    :param feature_precision: one of FEATURE_PRECISIONS to store the features in, a reduced
+        precision is compared to float32 in the run report, see train_on_label_windows
+    :param queue_depth: number of chunks read ahead, and of computed chunks waiting to be
+        written, in the background, see prefetch
+    :param aoi: optional area of interest to predict, a path to a vector file or a GeoSeries,
+        see ValidRegion
+    :param skip_nodata: skip the chunks without data and write nodata where the raster has none
+    :param class_labels: optional labels of several classes instead of positive and negative
+        labels, a dict of class name to a path to a vector file or a GeoSeries
+    :param max_samples_per_class: maximum number of labelled pixels per class to train on,
+        None for all, see train_on_label_windows
+    :param scheduler: optional SchedulerSettings of the local scheduler in "parallel" mode,
+        see use_scheduler
+    :param progress: optional Progress to report progress and check for cancellation
+    :return: path of the prediction GeoTIFF
+    """
+    class_labels = get_class_labels(pos_labels_path, neg_labels_path, class_labels)
+    _check_feature_precision(feature_precision)
+
+    if progress is None:
+        progress = Progress()
+    chunk_overlap = resolve_chunk_overlap(chunk_overlap, feature_type, chunks)
+
+    with use_scheduler(scheduler if compute_mode == "parallel" else None, progress, num_workers):
+        with _get_region(raster_path, aoi, skip_nodata) as region:
+            restricted = region.restricted
+        with ExitStack() as stack:
+            features = None
+            use_store = _uses_feature_store(compute_mode, feature_type, feature_precision)
+            if use_store and not restricted:
+                _, features, cache_stack = _prepare_features(
+                    raster_path,
+                    feature_type,
+                    None,
+                    compute_mode,
+                    chunks,
+                    chunk_overlap,
+                    feature_cache,
+                    num_workers,
+                    progress,
+                    feature_precision=feature_precision,
+                    queue_depth=queue_depth,
+                )
+                stack.enter_context(cache_stack)
+            classifier, n_bands = train_on_label_windows(
+                raster_path,
+                None,
+                None,
+                feature_type,
+                chunks,
+                chunk_overlap,
+                progress,
+                features=features,
+                feature_precision=feature_precision,
+                queue_depth=queue_depth,
+                class_labels=class_labels,
+                max_samples_per_class=max_samples_per_class,
+            )
+        if model_path is None:
+            model_path = get_model_path(output_path)
+        with progress.measure("Write"):
+            save_model(classifier, model_path, feature_type, n_bands, list(class_labels))
+
+        # Reads the features from the FeatureStore, if training used one
+        predict_with_model(
+            raster_path,
+            model_path,
+            output_path,
+            compute_mode=compute_mode,
+            chunks=chunks,
+            chunk_overlap=chunk_overlap,
+            feature_cache=feature_cache,
+            num_workers=num_workers,
+            priority_bounds=priority_bounds,
+            output_format=output_format,
+            feature_precision=feature_precision,
+            queue_depth=queue_depth,
+            aoi=aoi,
+            skip_nodata=skip_nodata,
+            scheduler=scheduler,
+            progress=progress,
+        )
+    # Replaces the report of predict_with_model, with the training stages added
+    _write_report(
+        progress,
+        output_path,
+        "train_and_predict",
+        raster_path,
+        feature_type=feature_type,
+        compute_mode=compute_mode,
+        chunks=chunks,
+        chunk_overlap=chunk_overlap,
+        num_workers=num_workers,
+        output_format=output_format,
+        feature_precision=feature_precision,
+        queue_depth=queue_depth,
+        aoi=aoi is not None,
+        skip_nodata=skip_nodata,
+        classes=list(class_labels),
+        max_samples_per_class=max_samples_per_class,
+    )
+    return Path(output_path)
+
+
+@_run_compute_config()
+def predict_with_model(
+    raster_path,
+    model_path,
+    output_path,
+    compute_mode="normal",
+    chunks=None,
+    chunk_overlap=None,
+    feature_cache=None,
+    num_workers=None,
+    priority_bounds=None,
+    output_format="geotiff",
+    feature_precision="float32",
+    queue_depth=DEFAULT_QUEUE_DEPTH,
+    aoi=None,
+    skip_nodata=False,
+    scheduler=None,
+    progress=None,
+):
+    """Predict a raster with a saved model, without reading labels or training.
+
+    With priority_bounds, features that are not cached are extracted chunk by
+    chunk as the prediction is written, so the first chunks are ready without
+    waiting for the features of the whole raster. With an area of interest or
+    skip_nodata, the chunks outside the ValidRegion are skipped, and features
+    that are not cached are only extracted for the other chunks.
+
+    :param raster_path: path to the input raster
+    :param model_path: path of a model saved by train_and_predict
+    :param output_path: path of the prediction GeoTIFF, the run report is saved next to it
+    :param compute_mode: one of "normal", "parallel" or "safe"
+    :param chunks: chunk size used in "parallel" and "safe" mode
+    :param chunk_overlap: overlap between chunks for feature extraction, or "auto" to derive it
+        from the receptive field of the features, see planner.get_min_chunk_overlap
+    :param feature_cache: optional FeatureCache to reuse extracted features
+    :param num_workers: number of parallel chunks in "parallel" mode, defaults to dask's default
+    :param priority_bounds: optional (left, bottom, right, top) in the raster CRS to predict
+        first, the output is then updated while it is written, see save_prediction
+    :param output_format: one of OUTPUT_FORMATS, see save_prediction
+    :param feature_precision: one of FEATURE_PRECISIONS to store the features in
+    :param queue_depth: number of chunks read ahead, and of computed chunks waiting to be
+        written, in the background, see prefetch
+    :param aoi: optional area of interest to predict, a path to a vector file or a GeoSeries,
+        see ValidRegion
+    :param skip_nodata: skip the chunks without data and write nodata where the raster has none
+    :param scheduler: optional SchedulerSettings of the local scheduler in "parallel" mode,
+        see use_scheduler
+    :param progress: optional Progress to report progress and check for cancellation
+    :return: path of the prediction GeoTIFF
+    """
+    _check_feature_precision(feature_precision)
+    if progress is None:
+        progress = Progress()
+    classifier, feature_type, n_bands, class_names = load_model(model_path)
+    chunk_overlap = resolve_chunk_overlap(chunk_overlap, feature_type, chunks)
+
+    with use_scheduler(scheduler if compute_mode == "parallel" else None, progress, num_workers):
+        region = _get_region(raster_path, aoi, skip_nodata)
+        raster, features, cache_stack = _prepare_features(
+            raster_path,
+            feature_type,
+            n_bands,
+            compute_mode,
+            chunks,
+            chunk_overlap,
+            feature_cache,
+            num_workers,
+            progress,
+            lazy=priority_bounds is not None,
+            feature_precision=feature_precision,
+            queue_depth=queue_depth,
+            region=region,
+        )
+        with cache_stack:
+            prediction = predict(classifier, features, output_format)
+            save_prediction(
+                raster,
+                prediction,
+                output_path,
+                progress=progress,
+                resume_key=_resume_key(raster_path, model_path),
+                priority_bounds=priority_bounds,
+                output_format=output_format,
+                queue_depth=queue_depth,
+                region=region,
+                band_names=get_band_names(classifier, class_names, output_format),
+            )
+
+    _write_report(
+        progress,
+        output_path,
+        "predict_with_model",
+        raster_path,
+        model_path=model_path,
+        compute_mode=compute_mode,
+        chunks=chunks,
+        chunk_overlap=chunk_overlap,
+        num_workers=num_workers,
+        output_format=output_format,
+        feature_precision=feature_precision,
+        queue_depth=queue_depth,
+        aoi=aoi is not None,
+        skip_nodata=skip_nodata,
+    )
+    return Path(output_path)
+
+
+@_run_compute_config()
+def predict_batch(
+    raster_paths,
+    model_path,
+    output_paths,
+    compute_mode="normal",
+    chunks=None,
+    chunk_overlap=None,
+    feature_cache=None,
+    num_workers=None,
+    output_format="geotiff",
+    feature_precision="float32",
+    queue_depth=DEFAULT_QUEUE_DEPTH,
+    aoi=None,
+    skip_nodata=False,
+    scheduler=None,
+    progress=None,
+):
+    """Predict a queue of rasters with one saved model.
+
+    Reading and feature extraction of the next raster run in a background thread,
+    while the current raster is predicted and written. A raster that fails is
+    logged and skipped, so one bad file does not stop the queue. Cancelling stops
+    the whole queue. Each prediction gets its own run report, the statistics of
+    the scheduler are of the whole queue and only logged.
+
+    :param raster_paths: paths to the input rasters
+    :param model_path: path of a model saved by train_and_predict
+    :param output_paths: paths of the prediction GeoTIFFs, one per raster
+    :param compute_mode: one of "normal", "parallel" or "safe"
+    :param chunks: chunk size used in "parallel" and "safe" mode
+    :param chunk_overlap: overlap between chunks for feature extraction, or "auto" to derive it
+        from the receptive field of the features, see planner.get_min_chunk_overlap
+    :param feature_cache: optional FeatureCache to reuse extracted features
+    :param num_workers: number of parallel chunks in "parallel" mode, defaults to dask's default
+    :param output_format: one of OUTPUT_FORMATS, see save_prediction
+    :param feature_precision: one of FEATURE_PRECISIONS to store the features in
+    :param queue_depth: number of chunks read ahead, and of computed chunks waiting to be
+        written, in the background, see prefetch
+    :param aoi: optional area of interest to predict in each raster, a path to a vector file
+        or a GeoSeries, see ValidRegion
+    :param skip_nodata: skip the chunks without data and write nodata where a raster has none
+    :param scheduler: optional SchedulerSettings of the local scheduler in "parallel" mode,
+        see use_scheduler
+    :param progress: optional Progress to report progress and check for cancellation
+    :return: paths of the predictions that were written
+    """
+    _check_feature_precision(feature_precision)
+    if progress is None:
+        progress = Progress()
+    classifier, feature_type, n_bands, class_names = load_model(model_path)
+    chunk_overlap = resolve_chunk_overlap(chunk_overlap, feature_type, chunks)
+
+    def prepare(raster_path, prepare_progress):
+        def prepare_raster():
+            region = _get_region(raster_path, aoi, skip_nodata)
+            return region, *_prepare_features(
+                raster_path,
+                feature_type,
+                n_bands,
+                compute_mode,
+                chunks,
+                chunk_overlap,
+                feature_cache,
+                num_workers,
+                prepare_progress,
+                feature_precision=feature_precision,
+                queue_depth=queue_depth,
+                region=region,
+            )
+
+        return submit(executor, prepare_raster)
+
+    with use_scheduler(scheduler if compute_mode == "parallel" else None, None, num_workers):
+        written = []
+        reports = [RunReport() for _ in raster_paths]
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            # Only the first raster is waited for, the others are prepared in the background
+            next_features = (
+                prepare(raster_paths[0], progress.with_report(reports[0])) if raster_paths else None
+            )
+            for i_raster, (raster_path, output_path) in enumerate(
+                zip(raster_paths, output_paths)
+            ):
+                logger.info(f"Batch {i_raster + 1}/{len(raster_paths)}: {raster_path}")
+                current_features = next_features
+                if i_raster + 1 < len(raster_paths):
+                    next_features = prepare(
+                        raster_paths[i_raster + 1], progress.background(reports[i_raster + 1])
+                    )
+                raster_progress = progress.with_report(reports[i_raster])
+                try:
+                    region, raster, features, cache_stack = current_features.result()
+                    with cache_stack:
+                        prediction = predict(classifier, features, output_format)
+                        save_prediction(
+                            raster,
+                            prediction,
+                            output_path,
+                            progress=raster_progress,
+                            resume_key=_resume_key(raster_path, model_path),
+                            stage=f"Predicting {i_raster + 1}/{len(raster_paths)}",
+                            output_format=output_format,
+                            queue_depth=queue_depth,
+                            region=region,
+                            band_names=get_band_names(classifier, class_names, output_format),
+                        )
+                    _write_report(
+                        raster_progress,
+                        output_path,
+                        "predict_batch",
+                        raster_path,
+                        model_path=model_path,
+                        compute_mode=compute_mode,
+                        chunks=chunks,
+                        chunk_overlap=chunk_overlap,
+                        num_workers=num_workers,
+                        output_format=output_format,
+                        feature_precision=feature_precision,
+                        queue_depth=queue_depth,
+                        aoi=aoi is not None,
+                        skip_nodata=skip_nodata,
+                    )
+                except ClassificationCancelled:
+                    raise
+                except Exception as e:
+                    logger.error(f"Failed to predict {raster_path}: {e}")
+                    continue
+                written.append(Path(output_path))
+
+    return written
+
+
+@_run_compute_config()
+def train_and_predict_preview(
+    raster_path,
+    pos_labels_path,
+    neg_labels_path,
+    output_path,
+    feature_type=FeatureType.FLAIR,
+    decimation=DEFAULT_PREVIEW_DECIMATION,
+    chunk_overlap=None,
+    num_workers=None,
+    class_labels=None,
+    max_samples_per_class=DEFAULT_MAX_SAMPLES_PER_CLASS,
+    progress=None,
+):
+    """Train and predict at a lower resolution, to check the labels quickly.
+
+    The raster is read at 1/decimation of its resolution, from its overviews when
+    it has them, and the labels are rasterized on the same grid. This is about
+    decimation**2 times less work than a full run. The model is not saved.
+
+    :param raster_path: path to the input raster
+    :param pos_labels_path: path to the vector file with positive labels, or a GeoSeries,
+        None with class_labels
+    :param neg_labels_path: path to the vector file with negative labels, or a GeoSeries,
+        None with class_labels
+    :param output_path: path of the preview GeoTIFF
+    :param feature_type: See pycoeus FeatureType enum for options
+    :param decimation: factor by which the resolution is reduced
+    :param chunk_overlap: overlap between chunks for feature extraction, or "auto" to derive it
+        from the receptive field of the features, see planner.get_min_chunk_overlap
+    :param num_workers: number of parallel chunks, defaults to dask's default
+    :param class_labels: optional labels of several classes, see get_class_labels
+    :param max_samples_per_class: maximum number of labelled pixels of the preview per class
+        to train on, None for all, see train_classifier
+    :param progress: optional Progress to report progress and check for cancellation
+    :return: path of the preview GeoTIFF
+    """
+    class_labels = get_class_labels(pos_labels_path, neg_labels_path, class_labels)
+    _check_max_samples(max_samples_per_class)
+
+    if progress is None:
+        progress = Progress()
+    chunk_overlap = resolve_chunk_overlap(chunk_overlap, feature_type, DEFAULT_CHUNKS["x"])
+
+    progress.start("Reading preview")
+    set_compute_mode("normal", num_workers=num_workers)
+    with progress.measure("Read raster"):
+        raster = read_raster_decimated(raster_path, decimation)
+
+    # The preview is in memory, extract the features per chunk to bound the FLAIR memory
+    progress.start("Extracting features")
+    with progress.measure("Extract features"), progress.dask_callback(
+        raster.sizes["x"] * raster.sizes["y"]
+    ):
+        features = extract_features_lazily(raster, feature_type, chunk_overlap).compute()
+
+    progress.start("Training")
+    with progress.measure("Rasterize labels"):
+        labels = read_labels(features, class_labels)
+    with progress.measure("Train"):
+        classifier = train_classifier(features.data, labels, max_samples_per_class)
+
+    prediction = predict(classifier, features)
+    save_prediction(
+        raster,
+        prediction,
+        output_path,
+        progress=progress,
+        stage="Predicting preview",
+        band_names=get_band_names(classifier, list(class_labels)),
+    )
+
+    _write_report(
+        progress,
+        output_path,
+        "train_and_predict_preview",
+        raster_path,
+        feature_type=feature_type,
+        decimation=decimation,
+        chunk_overlap=chunk_overlap,
+        num_workers=num_workers,
+        classes=list(class_labels),
+        max_samples_per_class=max_samples_per_class,
+    )
+    return Path(output_path)
+
+
+def train_on_label_windows(
+    raster_path,
+    pos_labels_path,
+    neg_labels_path,
+    feature_type=FeatureType.FLAIR,
+    chunks=None,
+    chunk_overlap=None,
+    progress=None,
+    features=None,
+    feature_precision="float32",
+    queue_depth=DEFAULT_QUEUE_DEPTH,
+    class_labels=None,
+    max_samples_per_class=DEFAULT_MAX_SAMPLES_PER_CLASS,
+):
+    """Train a classifier on the raster windows under the labels only.
+
+    The raster is divided in tiles of the chunk size, and a spatial index of the
+    label polygons finds the tiles they intersect. Per tile, only the bounding
+    window of its labels is read and featurized, with a halo of chunk_overlap
+    pixels for the feature extraction. The rest of the raster is not read.
+    The next queue_depth windows are read in the background while the features
+    of a window are extracted. With features, e.g. from a FeatureStore, the
+    windows are read from the features instead, and nothing is extracted.
+
+    With a reduced feature_precision, the classifier is trained on features
+    with the loss of precision of storing them, and a sample of the labelled
+    pixels is used to compare it to training in float32, which is recorded in
+    the run report of progress. The windows are then also extracted in float32.
+
+    A class with more than max_samples_per_class labelled pixels is trained on
+    a stratified random sample of them: the sample of the class is divided over
+    its polygons by their number of pixels, and drawn with TRAINING_SEED, so the
+    same labels give the same sample. The labels are rasterized once more to
+    draw it, before any features are extracted, and only the features of the
+    sampled pixels are kept. Windows without sampled pixels are not read.
+
+    A class without labelled pixels in the raster is left out of the classifier,
+    with a warning, so the classes it predicts are in classifier.classes_.
+
+    :param raster_path: path to the input raster
+    :param pos_labels_path: path to the vector file with positive labels, or a GeoSeries,
+        None with class_labels
+    :param neg_labels_path: path to the vector file with negative labels, or a GeoSeries,
+        None with class_labels
+    :param feature_type: See pycoeus FeatureType enum for options
+    :param chunks: chunk size to divide the raster in tiles
+    :param chunk_overlap: halo around the windows for feature extraction, or "auto"
+    :param progress: optional Progress to report progress and check for cancellation
+    :param features: optional features of the whole raster, with shape [features, y, x]
+    :param feature_precision: one of FEATURE_PRECISIONS, the precision of features
+    :param queue_depth: number of windows read ahead, see prefetch
+    :param class_labels: optional labels of several classes, see get_class_labels
+    :param max_samples_per_class: maximum number of labelled pixels per class to train on,
+        None for all
+    :return: trained classifier and the number of bands of the raster
+    """
+    class_labels = get_class_labels(pos_labels_path, neg_labels_path, class_labels)
+    _check_max_samples(max_samples_per_class)
+    chunk_overlap = resolve_chunk_overlap(chunk_overlap, feature_type, chunks)
+    if chunk_overlap is None:
+        chunk_overlap = DEFAULT_CHUNK_OVERLAP
+    if progress is None:
+        progress = Progress()
+    # IDENTITY features of a pixel do not depend on its neighbours
+    halo = 0 if feature_type == FeatureType.IDENTITY else chunk_overlap
+    # IDENTITY features are the raster, which is not stored in another precision
+    compare_precision = feature_precision != "float32" and feature_type != FeatureType.IDENTITY
+
+    with rasterio.open(Path(raster_path)) as dataset, ThreadLocalRaster(raster_path) as reader:
+        progress.start("Reading labels")
+        with progress.measure("Rasterize labels"):
+            crs = _gdal_crs(raster_path) or dataset.crs
+            class_geometries = [
+                read_label_geometries(labels, crs) for labels in class_labels.values()
+            ]
+            polygons = gpd.GeoSeries(
+                [g for geometries in class_geometries for g in geometries], crs=crs
+            )
+            # The class of each polygon
+            polygon_classes = np.repeat(
+                np.arange(len(class_geometries)), [len(g) for g in class_geometries]
+            )
+            windows = _label_windows(polygons, dataset, _tile_size(chunks))
+        if not windows:
+            msg = f"The label polygons do not overlap the raster {raster_path}."
+            raise ValueError(msg)
+
+        # Pixels to draw per polygon and window, for the polygons that are not drawn whole
+        window_samples = None
+        if max_samples_per_class is not None:
+            with progress.measure("Rasterize labels"):
+                windows, window_samples = _plan_sample(
+                    polygons, polygon_classes, windows, dataset, max_samples_per_class, progress
+                )
+
+        progress.start(
+            "Extracting features of labels" if features is None else "Reading features of labels",
+            len(windows),
+        )
+
+        def read(window):
+            if features is not None and not compare_precision:
+                return None
+            read_window = _with_halo(window, halo, dataset)
+            with progress.measure("Read raster"):
+                return read_window, reader.read(read_window)
+
+        train_data, train_labels, full_train_data = [], [], []
+        n_pixels_read = 0
+        for i_window, (window, read_result) in enumerate(
+            zip(windows, prefetch(read, windows, queue_depth))
+        ):
+            progress.check_cancelled()
+            if read_result is not None:
+                read_window, data = read_result
+                full_data = _window_features(data, read_window, window, feature_type, progress)
+                n_pixels_read += read_window.width * read_window.height
+            if features is not None:
+                with progress.measure("Read features"):
+                    feature_data = features.isel(
+                        y=slice(window.row_off, window.row_off + window.height),
+                        x=slice(window.col_off, window.col_off + window.width),
+                    ).values
+            elif compare_precision:
+                feature_data = reduce_precision(full_data, feature_precision)
+            else:
+                feature_data = full_data
+
+            window_transform = dataset.window_transform(window)
+            window_box = box(*rasterio.windows.bounds(window, dataset.transform))
+            with progress.measure("Rasterize labels"):
+                polygon_ids = _rasterize_polygons(
+                    polygons,
+                    polygon_classes,
+                    window_box,
+                    (window.height, window.width),
+                    window_transform,
+                )
+                labelled = polygon_ids >= 0
+                if window_samples is not None:
+                    labelled &= _sample_mask(
+                        polygon_ids,
+                        window_samples[i_window],
+                        np.random.default_rng((TRAINING_SEED, window.row_off, window.col_off)),
+                    )
+            train_data.append(feature_data[:, labelled])
+            train_labels.append(polygon_classes[polygon_ids[labelled]])
+            if compare_precision:
+                full_train_data.append(full_data[:, labelled])
+            progress.advance(1, window.width * window.height)
+        n_bands = dataset.count
+        logger.info(
+            f"Read {len(windows)} label windows of {raster_path}, "
+            f"{n_pixels_read / (dataset.width * dataset.height):.2%} of the raster"
+        )
+
+    train_labels = np.concatenate(train_labels)
+    _check_class_counts(train_labels, list(class_labels))
+
+    progress.start("Training")
+    with progress.measure("Train"):
+        train_data = np.concatenate(train_data, axis=1)
+        # Labelled pixels as a raster of one row
+        classifier = train_classifier(
+            train_data[:, None, :], train_labels[None, None, :], max_samples_per_class
+        )
+
+    if compare_precision:
+        progress.start("Comparing feature precision")
+        with progress.measure("Compare precision"):
+            comparison = _compare_precision(
+                np.concatenate(full_train_data, axis=1), train_data, train_labels, feature_precision
+            )
+        if comparison is not None:
+            logger.info(comparison["summary"])
+            progress.report.record("feature_precision", comparison)
+    return classifier, n_bands
+
+
+def get_batch_output_paths(output_path, raster_paths):
+    """Output paths for a batch, named after the output path and each raster."""
+    output_path = Path(output_path)
+    return [
+        output_path.with_name(f"{output_path.stem}_{Path(p).stem}{output_path.suffix}")
+        for p in raster_paths
+    ]
+
+
+def set_compute_mode(compute_mode, chunks=None, num_workers=None):
+    """Configure dask for the compute mode, and get the kwargs for reading raster data.
+
+    The dask configuration is process-wide, a run restores it when it ends, see
+    _run_compute_config.
+    """
+    if chunks is None:
+        chunks = DEFAULT_CHUNKS
+
+    match compute_mode:
+        case "normal":
+            # The raster is read in memory, only the prediction is computed in tiles
+            dask.config.set(scheduler="threads", num_workers=num_workers)
+            return {}
+        case "parallel":
+            # A scheduler of the run, see use_scheduler, replaces the default threads
+            if not scheduler_active():
+                dask.config.set(scheduler="threads", num_workers=num_workers)
+        case "safe":
+            dask.config.set(scheduler="synchronous")
+        case _:
+            msg = f"Invalid compute mode: {compute_mode}"
+            raise ValueError(msg)
+    return {"chunks": chunks}
+
+
+def read_raster(raster_path, compute_mode="normal", chunks=None, num_workers=None):
+    """Read the raster, lazily in chunks unless the compute mode is "normal"."""
+    dask_kwargs = set_compute_mode(compute_mode, chunks, num_workers)
+    raster = read_geotiff(raster_path, **dask_kwargs)
+    return _write_gdal_crs(raster, raster_path)
+
+
+def read_raster_decimated(raster_path, decimation):
+    """Read the raster in memory at 1/decimation of its resolution.
+
+    GDAL reads from the overview closest to that resolution when the raster has
+    overviews, otherwise it averages the full resolution pixels.
+    """
+    with rasterio.open(Path(raster_path)) as dataset:
+        height = max(1, dataset.height // decimation)
+        width = max(1, dataset.width // decimation)
+        overviews = dataset.overviews(1)
+        if overviews:
+            logger.info(f"Reading preview from the overviews of {raster_path}: {overviews}")
+        data = dataset.read(
+            out_shape=(dataset.count, height, width), resampling=Resampling.average
+        )
+        transform = dataset.transform * dataset.transform.scale(
+            dataset.width / width, dataset.height / height
+        )
+        crs = dataset.crs
+    logger.info(f"Read preview of {width} x {height} pixels, 1/{decimation} of the resolution")
+
+    raster = xr.DataArray(
+        data,
+        dims=("band", "y", "x"),
+        coords={
+            "band": np.arange(1, data.shape[0] + 1),
+            **affine_to_coords(transform, width, height),
+        },
+    )
+    raster = raster.rio.write_transform(transform).rio.write_crs(crs)
+    return _write_gdal_crs(raster, raster_path)
+
+
+def extract_features(
+    raster,
+    raster_path,
+    feature_type,
+    features_path=None,
+    compute_mode="normal",
+    chunk_overlap=None,
+    progress=None,
+):
+    """Extract features, or load them from features_path if they were extracted before."""
+    if chunk_overlap is None:
+        chunk_overlap = DEFAULT_CHUNK_OVERLAP
+    if progress is None:
+        progress = Progress()
+
+    progress.start("Extracting features")
+    n_pixels = raster.sizes["x"] * raster.sizes["y"]
+    with progress.measure("Extract features"), progress.dask_callback(n_pixels):
+        return get_features(
+            raster,
+            Path(raster_path),
+            feature_type,
+            features_path,
+            chunk_overlap=chunk_overlap,
+            compute_mode=compute_mode,
+        )
+
+
+def extract_features_lazily(raster, feature_type, chunk_overlap=None):
+    """Features as a lazy array, extracted chunk by chunk when the chunks are computed.
+
+    Unlike extract_features, nothing is extracted up front and nothing is saved,
+    so computing a part of the features only extracts the chunks of that part.
+    A raster in memory is split in chunks of the default size.
+    """
+    if feature_type == FeatureType.IDENTITY:
+        return raster
+    if chunk_overlap is None:
+        chunk_overlap = DEFAULT_CHUNK_OVERLAP
+
+    if not isinstance(raster.data, da.Array):
+        raster = raster.chunk(DEFAULT_CHUNKS)
+    # Same as map_overlap, but with known chunk sizes so they need not be computed:
+    # each band of a chunk gives NUM_FLAIR_CLASSES features of the same size
+    depth = {0: 0, 1: chunk_overlap, 2: chunk_overlap}
+    overlapped = da.overlap.overlap(raster.data, depth=depth, boundary="none")
+    features_data = overlapped.map_blocks(
+        extract_flair_features,
+        chunks=(tuple(c * NUM_FLAIR_CLASSES for c in overlapped.chunks[0]), *overlapped.chunks[1:]),
+        dtype=np.float32,
+    )
+    features_data = da.overlap.trim_internal(features_data, depth, boundary="none")
+    features = (
+        raster.isel(band=0)
+        .drop_vars(["band"])
+        .expand_dims(band=np.arange(1, features_data.shape[0] + 1))
+    )
+    features.data = features_data
+    return features
+
+
+def extract_features_to_store(
+    raster,
+    raster_path,
+    feature_type,
+    store_path=None,
+    chunks=None,
+    chunk_overlap=None,
+    progress=None,
+    feature_precision="float32",
+    compute_mode="safe",
+    num_workers=None,
+    queue_depth=DEFAULT_QUEUE_DEPTH,
+    region=None,
+):
+    """Extract features tile by tile into a FeatureStore, or open it if it exists.
+
+    Each tile of the chunk size is read with a halo of chunk_overlap pixels,
+    featurized and written to the store, so only one tile is in memory at a
+    time, or num_workers tiles in "parallel" mode. In "normal" mode the features
+    are extracted band by band from the whole raster instead, as pycoeus does,
+    and stored in tiles of the default chunk size. The features are returned as
+    a dask array that reads the store without copying, one chunk per tile.
+
+    :param raster: the raster as read by read_raster, used as geospatial template
+    :param raster_path: path to the input raster
+    :param feature_type: See pycoeus FeatureType enum for options
+    :param store_path: path of the store, defaults to next to the raster
+    :param chunks: chunk size, the tile size of the store
+    :param chunk_overlap: halo around the tiles for feature extraction
+    :param progress: optional Progress to report progress and check for cancellation
+    :param feature_precision: one of FEATURE_PRECISIONS to store the features in
+    :param compute_mode: one of "normal", "parallel" or "safe"
+    :param num_workers: number of tiles extracted in parallel in "parallel" mode,
+        defaults to the number of CPUs
+    :param queue_depth: number of tiles read ahead and waiting to be written, in "safe"
+        and "normal" mode
+    :param region: optional ValidRegion, the tiles without valid pixels are not extracted
+        and read as 0, except in "normal" mode
+    :return: features with shape [features, y, x]
+    """
+    if chunk_overlap is None:
+        chunk_overlap = DEFAULT_CHUNK_OVERLAP
+    if progress is None:
+        progress = Progress()
+    if store_path is None:
+        store_path = _get_store_path(raster_path, feature_type, feature_precision, region)
+    height, width = raster.sizes["y"], raster.sizes["x"]
+
+    if Path(store_path).exists():
+        logger.info(f"Reading features from feature store {store_path}")
+        store = FeatureStore.open(store_path, height, width)
+    else:
+        match compute_mode:
+            case "normal":
+                by_band, tile_size, num_workers = True, DEFAULT_CHUNKS["x"], 1
+            case "parallel":
+                by_band, tile_size = False, _tile_size(chunks)
+                num_workers = num_workers or os.cpu_count() or 1
+            case _:
+                by_band, tile_size, num_workers = False, _tile_size(chunks), 1
+        store = _write_feature_store(
+            raster_path,
+            store_path,
+            height,
+            width,
+            tile_size,
+            chunk_overlap,
+            progress,
+            feature_precision,
+            by_band,
+            num_workers,
+            queue_depth,
+            region,
+        )
+
+    features = (
+        raster.isel(band=0).drop_vars(["band"]).expand_dims(band=np.arange(1, store.shape[0] + 1))
+    )
+    features.data = store.to_dask()
+    return features
+
+
+def read_labels(features, class_labels):
+    """Rasterize the label polygons of each class on the grid of the features in memory.
+
+    :param features: features as xr.DataArray, with shape [features, y, x]
+    :param class_labels: labels of each class, see get_class_labels
+    :return: labels with shape [1, y, x], the class of each pixel or -1 for none
+    """
+    with log_duration("Read labels", logger):
+        class_geometries = [
+            read_label_geometries(labels, features.rio.crs) for labels in class_labels.values()
+        ]
+        labels = _rasterize_labels(
+            class_geometries,
+            (features.sizes["y"], features.sizes["x"]),
+            features.rio.transform(),
+        )
+    return labels[None]
+
+
+def get_class_labels(pos_labels_path=None, neg_labels_path=None, class_labels=None):
+    """Labels of each class, as a dict of class name to a vector file path or a GeoSeries.
+
+    The class of a pixel is the index of its class name, which is its value in a
+    class output. Positive and negative labels are the classes of BINARY_CLASSES,
+    negative 0 and positive 1. A pixel covered by labels of several classes gets
+    the first of these classes, so negative labels win over positive labels.
+
+    :param pos_labels_path: path to the vector file with positive labels, or a GeoSeries
+    :param neg_labels_path: path to the vector file with negative labels, or a GeoSeries
+    :param class_labels: labels of several classes instead of positive and negative labels,
+        a dict of class name to a path to a vector file or a GeoSeries
+    """
+    if class_labels is None:
+        _check_label_paths(pos_labels_path, neg_labels_path)
+        return dict(zip(BINARY_CLASSES, (neg_labels_path, pos_labels_path)))
+    if pos_labels_path is not None or neg_labels_path is not None:
+        msg = "Set either positive and negative labels or the labels of several classes."
+        raise ValueError(msg)
+    if not 2 <= len(class_labels) <= MAX_CLASSES:
+        msg = f"Set the labels of 2 to {MAX_CLASSES} classes, got {len(class_labels)}."
+        raise ValueError(msg)
+    return dict(class_labels)
+
+
+def read_label_geometries(labels, crs):
+    """Label polygons as a GeoSeries in crs.
+
+    :param labels: path to a vector file, or the geometries in memory as a GeoSeries
+        or GeoDataFrame with a CRS, e.g. read from a QGIS layer
+    :param crs: CRS of the raster
+    """
+    if not isinstance(labels, (gpd.GeoSeries, gpd.GeoDataFrame)):
+        labels = gpd.read_file(labels)
+    return labels.to_crs(crs).geometry
+
+
+def train_classifier(
+    feature_data, label_data, max_samples_per_class=DEFAULT_MAX_SAMPLES_PER_CLASS
+):
+    """Train a classifier on the labelled pixels of the features.
+
+    Like pycoeus prepare_training_data, for any number of classes: a class with
+    more than max_samples_per_class labelled pixels is trained on a random sample
+    of them. The sample and the classifier are seeded with TRAINING_SEED, so
+    training on the same pixels gives the same model.
+
+    :param feature_data: features with shape [features, y, x]
+    :param label_data: labels with shape [1, y, x], the class of each pixel or -1 for none,
+        e.g. 1 for positive and 0 for negative
+    :param max_samples_per_class: maximum number of labelled pixels per class to train on,
+        None for all
+    :return: trained classifier
+    """
+    with log_duration("Prepare train data", logger):
+        labels = np.asarray(label_data[0]).reshape(-1)
+        n_labelled = np.count_nonzero(labels >= 0)
+        if max_samples_per_class is not None:
+            labels = _sample_classes(labels, max_samples_per_class)
+        labelled = labels >= 0
+        train_data = feature_data.reshape((feature_data.shape[0], -1))[:, labelled].transpose()
+        train_labels = labels[labelled]
+        logger.debug(f"Labelled pixels: {n_labelled} of {labels.size}")
+        if train_labels.size < n_labelled:
+            logger.info(
+                f"Training on {train_labels.size} of {n_labelled} labelled pixels, "
+                f"at most {max_samples_per_class} per class"
+            )
+
+    classifier = get_classifier()
+    if "random_state" in classifier.get_params():
+        classifier.set_params(random_state=TRAINING_SEED)
+    with log_duration("Train model", logger):
+        classifier.fit(np.asarray(train_data), np.asarray(train_labels))
+    return classifier
+
+
+def predict(classifier, features, output_format="geotiff"):
+    """Predict class probabilities per pixel, with shape [classes, y, x].
+
+    Returns a lazy dask array that is predicted block by block, so the full
+    flattened feature array is never in memory. Features in memory are split in
+    tiles of the default chunk size.
+
+    For "cog_probability" the probabilities are scaled to uint8, with
+    PROBABILITY_SCALE for a probability of 1. For "cog_class" the result is the
+    most probable class per pixel, with shape [1, y, x] in uint8. For
+    "cog_class_probability" it is the class followed by the scaled probabilities,
+    with shape [1 + classes, y, x].
+    """
+    if output_format not in OUTPUT_FORMATS:
+        msg = f"Invalid output format: {output_format}"
+        raise ValueError(msg)
+    data = features.data
+    n_classes = len(classifier.classes_)
+    if isinstance(data, da.Array):
+        # All features of a pixel are needed in one block
+        data = data.rechunk({0: -1})
+    else:
+        data = da.from_array(
+            data, chunks=(-1, DEFAULT_CHUNKS["y"], DEFAULT_CHUNKS["x"])
+        )
+    match output_format:
+        case "geotiff":
+            return data.map_blocks(
+                _predict_block,
+                classifier,
+                chunks=((n_classes,), *data.chunks[1:]),
+                dtype=np.float64,
+            )
+        case "cog_probability":
+            return data.map_blocks(
+                _predict_probability_block,
+                classifier,
+                chunks=((n_classes,), *data.chunks[1:]),
+                dtype=np.uint8,
+            )
+        case "cog_class":
+            return data.map_blocks(
+                _predict_class_block,
+                classifier,
+                chunks=((1,), *data.chunks[1:]),
+                dtype=np.uint8,
+            )
+        case "cog_class_probability":
+            return data.map_blocks(
+                _predict_class_probability_block,
+                classifier,
+                chunks=((1 + n_classes,), *data.chunks[1:]),
+                dtype=np.uint8,
+            )
+
+
+def save_prediction(
+    raster,
+    prediction,
+    output_path,
+    progress=None,
+    resume_key=None,
+    stage="Predicting",
+    priority_bounds=None,
+    output_format="geotiff",
+    queue_depth=DEFAULT_QUEUE_DEPTH,
+    region=None,
+    band_names=None,
+):
+    """Compute the prediction chunk by chunk and write it to a GeoTIFF.
+
+    The raster is used as geospatial template. The chunks written so far are
+    recorded next to the output, so a cancelled run with the same resume_key
+    continues where it stopped, instead of starting over. Chunks that are not
+    written yet read as nodata.
+
+    With priority_bounds, the chunks in the bounds are written first and the
+    others in order of distance to the bounds. The output is then flushed every
+    REFRESH_INTERVAL seconds and reported with progress.output_updated, so it can
+    be shown while the rest is written.
+
+    Computing the chunks is measured as the "Predict" stage of the run report,
+    this includes extracting lazy features, and writing them as the "Write" stage.
+    Computed chunks are written in the background while the next chunks are
+    computed, at most queue_depth groups of chunks wait to be written.
+
+    With a region, the chunks without valid pixels are not computed and read as
+    nodata, and the pixels of the other chunks that are not valid are written
+    as nodata. The number of chunks skipped is recorded in the run report.
+
+    The COG output formats are streamed to a tiled, compressed GeoTIFF next to
+    the output, which is converted to a Cloud-Optimized GeoTIFF with internal
+    overviews when all chunks are written. The conversion also works block by
+    block, so memory stays bounded by the chunk size. A partial COG cannot be
+    shown, so it is not reported with progress.output_updated.
+
+    :param raster: input raster as xr.DataArray
+    :param prediction: lazy prediction with shape [classes, y, x]
+    :param output_path: path of the prediction GeoTIFF
+    :param progress: optional Progress to report progress and check for cancellation
+    :param resume_key: identifies the raster and model, None disables resuming
+    :param stage: name of the stage for the progress report
+    :param priority_bounds: optional (left, bottom, right, top) in the raster CRS to write first
+    :param output_format: one of OUTPUT_FORMATS, matching the format passed to predict
+    :param queue_depth: number of computed groups of chunks waiting to be written, see
+        AsyncWriter
+    :param region: optional ValidRegion of the raster to predict
+    :param band_names: optional description of each band of the output, see get_band_names
+    """
+    output_path = Path(output_path)
+    if progress is None:
+        progress = Progress()
+    resume_path = output_path.with_suffix(RESUME_SUFFIX)
+    cog = output_format != "geotiff"
+    write_path = output_path.with_suffix(PARTIAL_SUFFIX) if cog else output_path
+    refresh = priority_bounds is not None and not cog
+    nodata = UINT8_NODATA if cog else np.nan
+
+    row_starts, col_starts = (np.cumsum((0, *c[:-1])) for c in prediction.chunks[1:])
+    blocks = list(np.ndindex(*prediction.numblocks[1:]))
+    if region is not None and region.restricted:
+        n_blocks = len(blocks)
+        with progress.measure("Read mask"):
+            blocks = [
+                block
+                for block in blocks
+                if region.covers(_block_window(block, row_starts, col_starts, prediction.chunks))
+            ]
+        if not blocks:
+            msg = f"No chunk of {output_path} is in the area of interest and has data."
+            raise ValueError(msg)
+        skipped = {
+            "skipped_chunks": n_blocks - len(blocks),
+            "chunks": n_blocks,
+            "summary": (
+                f"Skipped {n_blocks - len(blocks)} of {n_blocks} chunks, "
+                "outside the area of interest or without data"
+            ),
+        }
+        logger.info(skipped["summary"])
+        progress.report.record("region", skipped)
+    if resume_key is not None:
+        region_key = region.key if region is not None else None
+        resume_key = f"{resume_key}|{prediction.chunks}|{output_format}|{region_key}"
+    done = _read_resume_state(resume_path, resume_key, write_path)
+    todo = [block for block in blocks if block not in done]
+    if priority_bounds is not None:
+        window = from_bounds(*priority_bounds, transform=raster.rio.transform())
+        todo = _order_blocks(todo, row_starts, col_starts, prediction.chunks[1:], window)
+    if done:
+        logger.info(f"Resuming {output_path}, {len(done)} of {len(blocks)} chunks already written")
+        dst = rasterio.open(write_path, "r+")
+    else:
+        compression = {"compress": "deflate", "predictor": 2} if cog else {}
+        dst = rasterio.open(
+            write_path,
+            "w",
+            driver="GTiff",
+            height=prediction.shape[1],
+            width=prediction.shape[2],
+            count=prediction.shape[0],
+            dtype=prediction.dtype,
+            crs=raster.rio.crs,
+            transform=raster.rio.transform(),
+            nodata=nodata,
+            tiled=True,
+            blockxsize=OUTPUT_BLOCK_SIZE,
+            blockysize=OUTPUT_BLOCK_SIZE,
+            # Tiles that are not written yet are not allocated and read as nodata
+            sparse_ok=True,
+            **compression,
+        )
+        # Let readers such as QGIS show the stored values as probabilities
+        match output_format:
+            case "cog_probability":
+                dst.scales = [1 / PROBABILITY_SCALE] * dst.count
+            case "cog_class_probability":
+                dst.scales = [1, *[1 / PROBABILITY_SCALE] * (dst.count - 1)]
+        if band_names is not None:
+            dst.descriptions = band_names
+
+    def write(dst, group, results):
+        n_pixels = 0
+        with progress.measure("Write"):
+            for (i_row, i_col), result in zip(group, results):
+                window = Window(
+                    col_starts[i_col], row_starts[i_row], result.shape[2], result.shape[1]
+                )
+                valid = region.mask(window) if region is not None else None
+                if valid is not None:
+                    result = np.where(valid, result, np.array(nodata, dtype=result.dtype))
+                dst.write(result, window=window)
+                done.add((i_row, i_col))
+                n_pixels += result.shape[1] * result.shape[2]
+            if resume_key is not None:
+                _write_resume_state(resume_path, resume_key, done)
+        progress.advance(len(group), n_pixels)
+
+    n_parallel = _chunks_per_compute()
+    progress.start(stage, len(blocks), len(done))
+    last_refresh = None
+    with log_duration("Make and save predictions", logger):
+        try:
+            with AsyncWriter(queue_depth) as writer:
+                for i_start in range(0, len(todo), n_parallel):
+                    progress.check_cancelled()
+                    group = todo[i_start : i_start + n_parallel]
+                    with progress.measure("Predict"):
+                        results = dask.compute(
+                            *[prediction.blocks[(0, *block)] for block in group]
+                        )
+                    writer.submit(write, dst, group, results)
+
+                    if refresh and (
+                        last_refresh is None
+                        or time.perf_counter() - last_refresh >= REFRESH_INTERVAL
+                    ):
+                        # Closing flushes the written chunks to the file, for readers such as QGIS
+                        writer.flush()
+                        with progress.measure("Write"):
+                            dst.close()
+                        progress.output_updated(output_path)
+                        dst = rasterio.open(output_path, "r+")
+                        last_refresh = time.perf_counter()
+        finally:
+            with progress.measure("Write"):
+                dst.close()
+
+    if cog:
+        progress.start("Writing Cloud-Optimized GeoTIFF")
+        with log_duration("Convert to Cloud-Optimized GeoTIFF", logger), progress.measure("Write"):
+            write_cog(write_path, output_path, output_format)
+        write_path.unlink()
+    if refresh:
+        progress.output_updated(output_path)
+    resume_path.unlink(missing_ok=True)
+
+
+def write_cog(src_path, output_path, output_format="cog_probability"):
+    """Convert a GeoTIFF to a compressed Cloud-Optimized GeoTIFF with internal overviews.
+
+    GDAL builds the overviews and copies the tiles block by block, so the
+    raster is never in memory as a whole.
+    """
+    # Averaging classes would make up classes that are not there
+    classes = output_format in ("cog_class", "cog_class_probability")
+    resampling = "NEAREST" if classes else "AVERAGE"
+    rasterio.shutil.copy(
+        src_path,
+        output_path,
+        driver="COG",
+        compress="DEFLATE",
+        predictor="YES",
+        blocksize=COG_BLOCK_SIZE,
+        resampling=resampling,
+        num_threads="ALL_CPUS",
+    )
+
+
+def get_model_path(output_path):
+    """Default path of the model saved next to the prediction."""
+    return Path(output_path).with_suffix(MODEL_SUFFIX)
+
+
+def save_model(classifier, model_path, feature_type, n_bands, class_names=BINARY_CLASSES):
+    """Save a trained classifier with the settings needed to apply it to another raster."""
+    model = {
+        "classifier": classifier,
+        "feature_type": feature_type.name,
+        "n_bands": n_bands,
+        "class_names": list(class_names),
+    }
+    with open(model_path, "wb") as f:
+        pickle.dump(model, f)
+    logger.info(f"Saved model to {model_path}")
+
+
+def load_model(model_path):
+    """Load a model saved by save_model.
+
+    :return: classifier, feature type, number of bands of the training raster and class names
+    """
+    with open(model_path, "rb") as f:
+        model = pickle.load(f)
+    logger.info(f"Loaded model from {model_path}")
+    return (
+        model["classifier"],
+        FeatureType.from_string(model["feature_type"]),
+        model["n_bands"],
+        # Models saved before multi-class support have positive and negative classes
+        model.get("class_names", list(BINARY_CLASSES)),
+    )
+
+
+def get_band_names(classifier, class_names, output_format="geotiff"):
+    """Description of each band of a prediction, from the class names of its model."""
+    names = [class_names[int(i)] for i in classifier.classes_]
+    match output_format:
+        case "cog_class":
+            return ["class"]
+        case "cog_class_probability":
+            return ["class", *names]
+        case _:
+            return names
+
+
+def _predict_block(block, classifier):
+    """Predict class probabilities of a [features, y, x] block."""
+    predictions = classifier.predict_proba(block.reshape((block.shape[0], -1)).transpose())
+    return predictions.transpose().reshape((predictions.shape[1], *block.shape[1:]))
+
+
+def _predict_probability_block(block, classifier):
+    """Predict class probabilities of a [features, y, x] block, scaled to uint8."""
+    probabilities = _predict_block(block, classifier)
+    return np.rint(probabilities * PROBABILITY_SCALE).astype(np.uint8)
+
+
+def _predict_class_block(block, classifier):
+    """Predict the most probable class of a [features, y, x] block, with shape [1, y, x]."""
+    probabilities = _predict_block(block, classifier)
+    classes = np.asarray(classifier.classes_)
+    return classes[np.argmax(probabilities, axis=0)][None].astype(np.uint8)
+
+
+def _predict_class_probability_block(block, classifier):
+    """Predict the class and the uint8 probabilities of a block, with shape [1 + classes, y, x]."""
+    probabilities = _predict_block(block, classifier)
+    classes = np.asarray(classifier.classes_)[np.argmax(probabilities, axis=0)]
+    return np.concatenate(
+        [classes[None], np.rint(probabilities * PROBABILITY_SCALE)]
+    ).astype(np.uint8)
+
+
+def _prepare_features(
+    raster_path,
+    feature_type,
+    n_bands,
+    compute_mode,
+    chunks,
+    chunk_overlap,
+    feature_cache,
+    num_workers=None,
+    progress=None,
+    lazy=False,
+    feature_precision="float32",
+    queue_depth=DEFAULT_QUEUE_DEPTH,
+    region=None,
+):
+    """Read a raster and extract its features, for predicting with a saved model.
+
+    With lazy, features that are not cached are extracted when the prediction is
+    computed, see extract_features_lazily. In "safe" mode, or with a reduced
+    feature_precision, features are extracted into a FeatureStore, see
+    extract_features_to_store. With a restricted region, only the features of
+    its chunks are extracted, lazily or into a store of its tiles only.
+
+    :param n_bands: number of bands the model was trained on, None to not check it
+    :param region: optional ValidRegion to predict, which is closed with the returned context
+    :return: raster, features and the open feature cache context, which should be
+        closed after the prediction is written
+    """
+    if progress is None:
+        progress = Progress()
+    use_store = _uses_feature_store(compute_mode, feature_type, feature_precision)
+    restricted = region is not None and region.restricted
+    with ExitStack() as stack:
+        if region is not None:
+            stack.callback(region.close)
+        features_path = stack.enter_context(
+            _cached_features(
+                feature_cache,
+                raster_path,
+                feature_type,
+                chunks,
+                chunk_overlap,
+                suffix=_store_suffix(feature_precision, region) if use_store else CACHE_SUFFIX,
+            )
+        )
+        if use_store and features_path is None:
+            features_path = _get_store_path(raster_path, feature_type, feature_precision, region)
+        with progress.measure("Read raster"):
+            raster = read_raster(raster_path, compute_mode, chunks, num_workers)
+        if n_bands is not None and raster.sizes["band"] != n_bands:
+            msg = (
+                f"The model was trained on a raster with {n_bands} bands, "
+                f"but {raster_path} has {raster.sizes['band']} bands."
+            )
+            raise ValueError(msg)
+        # pycoeus extracts the features of the whole raster, lazily only the chunks predicted
+        lazy = lazy or (restricted and not use_store)
+        if lazy and (features_path is None or not features_path.exists()):
+            features = extract_features_lazily(raster, feature_type, chunk_overlap)
+            return raster, features, stack.pop_all()
+        if use_store:
+            features = extract_features_to_store(
+                raster,
+                raster_path,
+                feature_type,
+                features_path,
+                chunks,
+                chunk_overlap,
+                progress,
+                feature_precision,
+                compute_mode,
+                num_workers,
+                queue_depth,
+                region,
+            )
+            # Predicting a tile from stored features takes far less memory than
+            # extracting its features, so the tiles can be predicted in parallel
+            set_compute_mode("parallel", chunks, num_workers)
+            return raster, features, stack.pop_all()
+        features = extract_features(
+            raster,
+            raster_path,
+            feature_type,
+            features_path,
+            compute_mode,
+            chunk_overlap,
+            progress,
+        )
+        return raster, features, stack.pop_all()
+
+
+def _uses_feature_store(compute_mode, feature_type, feature_precision="float32"):
+    """Whether features are extracted into a FeatureStore, IDENTITY features are the raster."""
+    if feature_type == FeatureType.IDENTITY:
+        return False
+    return compute_mode == "safe" or feature_precision != "float32"
+
+
+def _get_store_path(raster_path, feature_type, feature_precision="float32", region=None):
+    """Path of the FeatureStore of a raster when not caching, next to the raster."""
+    return get_features_path(Path(raster_path), feature_type).with_suffix(
+        _store_suffix(feature_precision, region)
+    )
+
+
+def _store_suffix(feature_precision="float32", region=None):
+    """Suffix of a FeatureStore, with the key of a restricted region, as it has its tiles only."""
+    suffix = get_store_suffix(feature_precision)
+    if region is not None and region.restricted:
+        return f".{region.key}{suffix}"
+    return suffix
+
+
+def _get_region(raster_path, aoi=None, skip_nodata=False):
+    """The ValidRegion of a raster, with the area of interest in the crs of the raster."""
+    if aoi is not None:
+        with rasterio.open(Path(raster_path)) as dataset:
+            crs = _gdal_crs(raster_path) or dataset.crs
+        aoi = read_label_geometries(aoi, crs)
+    return ValidRegion(raster_path, aoi, skip_nodata)
+
+
+def _check_feature_precision(feature_precision):
+    if feature_precision not in FEATURE_PRECISIONS:
+        msg = f"Invalid feature precision: {feature_precision}"
+        raise ValueError(msg)
+
+
+def _write_feature_store(
+    raster_path,
+    store_path,
+    height,
+    width,
+    tile_size,
+    chunk_overlap,
+    progress,
+    feature_precision="float32",
+    by_band=False,
+    num_workers=1,
+    queue_depth=DEFAULT_QUEUE_DEPTH,
+    region=None,
+):
+    """Extract the features of a raster into a new FeatureStore.
+
+    With by_band, the features of each band are extracted from the whole band,
+    otherwise tile by tile with a halo of chunk_overlap pixels, skipping the
+    tiles without valid pixels in region. With one worker,
+    the next queue_depth tiles are read in the background and the extracted
+    tiles are written in the background, while a tile is extracted. With more
+    workers, each thread reads, extracts and writes its own tiles, and reads of
+    one thread overlap extraction in the others.
+    """
+    with rasterio.open(Path(raster_path)) as dataset, ThreadLocalRaster(raster_path) as reader:
+        n_bands = dataset.count
+        if by_band:
+            windows = [
+                (Window(0, 0, width, height), [i_band + 1]) for i_band in range(n_bands)
+            ]
+        else:
+            windows = [
+                (
+                    Window(col, row, min(tile_size, width - col), min(tile_size, height - row)),
+                    None,
+                )
+                for row in range(0, height, tile_size)
+                for col in range(0, width, tile_size)
+            ]
+            if region is not None and region.restricted:
+                n_tiles = len(windows)
+                with progress.measure("Read mask"):
+                    windows = [job for job in windows if region.covers(job[0])]
+                logger.info(
+                    f"Extracting features of {len(windows)} of {n_tiles} tiles, "
+                    "the others are outside the area of interest or have no data"
+                )
+        progress.start("Extracting features", len(windows))
+        store = FeatureStore.create(
+            store_path, n_bands * NUM_FLAIR_CLASSES, height, width, tile_size, feature_precision
+        )
+
+        def read(job):
+            window, indexes = job
+            read_window = _with_halo(window, chunk_overlap, dataset)
+            with progress.measure("Read raster"):
+                return read_window, reader.read(read_window, indexes)
+
+        def extract(job, read_window, data):
+            window, indexes = job
+            progress.check_cancelled()
+            feature_data = _window_features(data, read_window, window, FeatureType.FLAIR, progress)
+            bands = (
+                slice(None)
+                if indexes is None
+                else slice((indexes[0] - 1) * NUM_FLAIR_CLASSES, indexes[0] * NUM_FLAIR_CLASSES)
+            )
+            return feature_data, window, bands
+
+        def write(feature_data, window, bands):
+            with progress.measure("Write features"):
+                store.write(feature_data, window.row_off, window.col_off, bands)
+            progress.advance(1, window.width * window.height)
+
+        try:
+            if num_workers > 1:
+                executor = ThreadPoolExecutor(max_workers=num_workers)
+                try:
+                    futures = [
+                        submit(executor, lambda job: write(*extract(job, *read(job))), job)
+                        for job in windows
+                    ]
+                    for future in futures:
+                        future.result()
+                finally:
+                    executor.shutdown(cancel_futures=True)
+            else:
+                with AsyncWriter(queue_depth) as writer:
+                    for job, read_result in zip(windows, prefetch(read, windows, queue_depth)):
+                        writer.submit(write, *extract(job, *read_result))
+            with progress.measure("Write features"):
+                store.complete()
+        except BaseException:
+            store.discard()
+            raise
+    logger.info(f"Saved features to feature store {store_path}")
+    return store
+
+
+def _window_features(data, read_window, window, feature_type, progress):
+    """Features of a window, from the data of the window with a halo around it."""
+    if feature_type == FeatureType.IDENTITY:
+        feature_data = data
+    else:
+        with progress.measure("Extract features"):
+            feature_data = extract_flair_features(data)
+    # Drop the halo
+    row, col = window.row_off - read_window.row_off, window.col_off - read_window.col_off
+    return feature_data[:, row : row + window.height, col : col + window.width]
+
+
+def _compare_precision(full_data, reduced_data, labels, feature_precision):
+    """Compare classifiers trained in float32 and in a reduced feature precision.
+
+    Both are trained on the same sample of the labelled pixels and tested on
+    held-out pixels of the sample. Both are seeded with TRAINING_SEED, so they
+    differ by the precision of the features only.
+
+    :param full_data: [features, pixels] labelled pixels in float32
+    :param reduced_data: the same pixels in the reduced precision, as read from a store
+    :param labels: labels of the pixels
+    :return: dict with the accuracies, their agreement and a summary, or None if there
+        are too few labelled pixels to compare
+    """
+    rng = np.random.default_rng(PRECISION_CHECK_SEED)
+    sample = rng.permutation(labels.size)[:PRECISION_CHECK_PIXELS]
+    n_test = int(sample.size * PRECISION_TEST_FRACTION)
+    test, train = sample[:n_test], sample[n_test:]
+    if n_test == 0 or np.unique(labels[train]).size < 2:
+        logger.info("Too few labelled pixels to compare the feature precision")
+        return None
+
+    predictions = []
+    for data in (full_data, reduced_data):
+        classifier = train_classifier(
+            data[:, None, train], labels[None, None, train], max_samples_per_class=None
+        )
+        predictions.append(classifier.predict(np.asarray(data[:, test], np.float32).T))
+    full_accuracy, accuracy = (np.mean(p == labels[test]) for p in predictions)
+    agreement = np.mean(predictions[0] == predictions[1])
+    return {
+        "feature_precision": feature_precision,
+        "test_pixels": int(n_test),
+        "accuracy": float(accuracy),
+        "float32_accuracy": float(full_accuracy),
+        "agreement": float(agreement),
+        "summary": (
+            f"Feature precision {feature_precision}: {accuracy:.1%} accuracy, "
+            f"{full_accuracy:.1%} in float32, {agreement:.1%} of predictions agree, "
+            f"on {n_test} held-out labelled pixels"
+        ),
+    }
+
+
+def _check_label_paths(pos_labels_path, neg_labels_path):
+    """Check that the positive and negative labels are not read from the same file."""
+    if isinstance(pos_labels_path, (gpd.GeoSeries, gpd.GeoDataFrame)) or isinstance(
+        neg_labels_path, (gpd.GeoSeries, gpd.GeoDataFrame)
+    ):
+        return
+    if Path(pos_labels_path) == Path(neg_labels_path):
+        msg = f'Positive and negative labels must be different files, both were set to "{pos_labels_path}".'
+        raise ValueError(msg)
+
+
+def _write_report(progress, output_path, function, raster_path, **run_info):
+    """Save the run report of progress next to the prediction."""
+    report_path = get_report_path(output_path)
+    try:
+        progress.report.write(
+            report_path,
+            function=function,
+            raster_path=raster_path,
+            output_path=output_path,
+            **run_info,
+        )
+    except OSError as e:
+        logger.warning(f"Could not save the run report {report_path}: {e}")
+        return
+    logger.info(f"Saved run report to {report_path}")
+
+
+def _write_gdal_crs(raster, raster_path):
+    """Set the crs of the raster as read by osgeo.gdal, when it is available."""
+    crs = _gdal_crs(raster_path)
+    if crs is not None:
+        raster = raster.rio.write_crs(crs, inplace=True)
+    return raster
+
+
+def _gdal_crs(raster_path):
+    """The crs of the raster as read by osgeo.gdal, or None when it is not available.
+
+    In QGIS environment, rasterio may not be able to read the crs correctly.
+    """
+    try:
+        from osgeo import gdal
+    except ImportError:
+        logger.info("Used rioxarray to read the crs")
+        return None
+    logger.info("Used osgeo.gdal to read the crs")
+    return gdal.Open(str(raster_path)).GetProjection()
+
+
+def _tile_size(chunks):
+    """Size of the tiles of a chunk size, which is an int or a dict as DEFAULT_CHUNKS."""
+    if chunks is None:
+        chunks = DEFAULT_CHUNKS
+    return chunks["x"] if isinstance(chunks, dict) else chunks
+
+
+def _label_windows(labels, dataset, tile_size):
+    """Windows covering the labels, at most one per tile of the raster.
+
+    :param labels: GeoSeries of the label polygons in the crs of the raster
+    :param dataset: open rasterio dataset
+    :param tile_size: size of the tiles in pixels
+    :return: list of Window, the bounding window of the labels in each tile they intersect
+    """
+    tiles = [
+        Window(col, row, min(tile_size, dataset.width - col), min(tile_size, dataset.height - row))
+        for row in range(0, dataset.height, tile_size)
+        for col in range(0, dataset.width, tile_size)
+    ]
+    tile_boxes = [box(*rasterio.windows.bounds(tile, dataset.transform)) for tile in tiles]
+    i_tiles, i_labels = labels.sindex.query(tile_boxes, predicate="intersects")
+
+    windows = []
+    for i_tile in np.unique(i_tiles):
+        tile = tiles[i_tile]
+        bounds = labels.iloc[i_labels[i_tiles == i_tile]].total_bounds
+        label_window = from_bounds(*bounds, transform=dataset.transform)
+        # Whole pixels covered by the labels, within the tile
+        row_start = max(math.floor(label_window.row_off), tile.row_off)
+        col_start = max(math.floor(label_window.col_off), tile.col_off)
+        row_stop = min(
+            math.ceil(label_window.row_off + label_window.height), tile.row_off + tile.height
+        )
+        col_stop = min(
+            math.ceil(label_window.col_off + label_window.width), tile.col_off + tile.width
+        )
+        if row_stop > row_start and col_stop > col_start:
+            windows.append(Window(col_start, row_start, col_stop - col_start, row_stop - row_start))
+    return windows
+
+
+def _with_halo(window, halo, dataset):
+    """The window grown by halo pixels on each side, within the raster."""
+    row_start, col_start = max(window.row_off - halo, 0), max(window.col_off - halo, 0)
+    row_stop = min(window.row_off + window.height + halo, dataset.height)
+    col_stop = min(window.col_off + window.width + halo, dataset.width)
+    return Window(col_start, row_start, col_stop - col_start, row_stop - row_start)
+
+
+def _rasterize_labels(class_geometries, shape, transform):
+    """Label array like pycoeus get_label_array: the class of each pixel, -1 unlabelled.
+
+    Pixels covered by polygons of several classes get the first of these classes,
+    e.g. pixels covered by both positive and negative polygons are negative.
+
+    :param class_geometries: GeoSeries of the label polygons of each class
+    """
+    labels = np.full(shape, -1, dtype=np.int32)
+    for value, geometries in reversed(list(enumerate(class_geometries))):
+        if len(geometries):
+            inside = geometry_mask(geometries, out_shape=shape, transform=transform, invert=True)
+            labels[inside] = value
+    return labels
+
+
+def _check_class_counts(labels, class_names):
+    """Log the training pixels per class, and check that two classes or more have pixels."""
+    counts = np.bincount(labels, minlength=len(class_names))
+    logger.info(
+        "Training pixels per class: "
+        + ", ".join(f"{name} {count}" for name, count in zip(class_names, counts))
+    )
+    missing = [name for name, count in zip(class_names, counts) if count == 0]
+    if missing:
+        logger.warning(f"No labelled pixels in the raster for the classes {', '.join(missing)}")
+    if np.count_nonzero(counts) < 2:
+        msg = "The labels of at least two classes must overlap the raster."
+        raise ValueError(msg)
+
+
+def _rasterize_polygons(polygons, polygon_classes, window_box, shape, transform):
+    """Polygon of each pixel of a window, -1 unlabelled, see _rasterize_labels.
+
+    Pixels covered by polygons of several classes get a polygon of the first of
+    these classes, like the classes of _rasterize_labels.
+
+    :param polygons: GeoSeries of the label polygons of all classes
+    :param polygon_classes: class of each polygon
+    :param window_box: box of the window, to find the polygons that intersect it
+    """
+    i_polygons = polygons.sindex.query(window_box)
+    if not len(i_polygons):
+        return np.full(shape, -1, dtype=np.int32)
+    # Later polygons are burned over earlier ones, so the polygons of the first class go last
+    i_polygons = i_polygons[np.argsort(-polygon_classes[i_polygons], kind="stable")]
+    return rasterize(
+        zip(polygons.iloc[i_polygons], i_polygons.tolist()),
+        out_shape=shape,
+        transform=transform,
+        fill=-1,
+        dtype=np.int32,
+    )
+
+
+def _plan_sample(polygons, polygon_classes, windows, dataset, max_samples_per_class, progress):
+    """Plan a stratified sample of at most max_samples_per_class labelled pixels per class.
+
+    The sample of a class with more labelled pixels is divided over its polygons
+    in proportion to their pixels, and the sample of a polygon over the windows
+    it is in at random, with TRAINING_SEED.
+
+    :return: the windows with pixels in the sample, and per window a dict of the
+        number of pixels to draw per polygon, for the polygons that are not drawn whole
+    """
+    window_counts = []  # Labelled pixels per polygon, per window
+    for window in windows:
+        progress.check_cancelled()
+        polygon_ids = _rasterize_polygons(
+            polygons,
+            polygon_classes,
+            box(*rasterio.windows.bounds(window, dataset.transform)),
+            (window.height, window.width),
+            dataset.window_transform(window),
+        )
+        ids, counts = np.unique(polygon_ids[polygon_ids >= 0], return_counts=True)
+        window_counts.append(dict(zip(ids.tolist(), counts.tolist())))
+
+    polygon_counts = np.zeros(len(polygons), dtype=np.int64)
+    polygon_windows = defaultdict(list)
+    for i_window, counts in enumerate(window_counts):
+        for i_polygon, count in counts.items():
+            polygon_counts[i_polygon] += count
+            polygon_windows[i_polygon].append(i_window)
+    draws = polygon_counts.copy()
+    for i_class in np.unique(polygon_classes):
+        in_class = polygon_classes == i_class
+        if polygon_counts[in_class].sum() > max_samples_per_class:
+            draws[in_class] = _allocate_samples(polygon_counts[in_class], max_samples_per_class)
+    logger.info(
+        f"Sampled {draws.sum()} of {polygon_counts.sum()} labelled pixels, "
+        f"at most {max_samples_per_class} per class"
+    )
+
+    rng = np.random.default_rng(TRAINING_SEED)
+    window_samples = [{} for _ in windows]
+    for i_polygon in np.flatnonzero(draws < polygon_counts):
+        i_windows = polygon_windows[i_polygon]
+        window_draws = rng.multivariate_hypergeometric(
+            [window_counts[i_window][i_polygon] for i_window in i_windows], draws[i_polygon]
+        )
+        for i_window, n_draws in zip(i_windows, window_draws):
+            window_samples[i_window][i_polygon] = int(n_draws)
+
+    sampled = [
+        i_window
+        for i_window, counts in enumerate(window_counts)
+        if any(window_samples[i_window].get(i, count) for i, count in counts.items())
+    ]
+    return [windows[i] for i in sampled], [window_samples[i] for i in sampled]
+
+
+def _allocate_samples(counts, n_samples):
+    """Divide n_samples, less than the sum of counts, over strata in proportion to their counts.
+
+    Each stratum with pixels gets one first when there are enough samples, so small
+    polygons are in the sample too, the rest is divided by largest remainder.
+    """
+    first = counts > 0
+    if n_samples < first.sum():
+        first[:] = False
+    counts, n_samples = counts - first, n_samples - first.sum()
+    quotas = counts * (n_samples / counts.sum())
+    draws = np.floor(quotas).astype(np.int64)
+    # The samples left go to the strata with the largest remainders
+    draws[np.argsort(draws - quotas, kind="stable")[: n_samples - draws.sum()]] += 1
+    return draws + first
+
+
+def _sample_mask(strata, n_draws, rng):
+    """Pixels drawn from strata, n_draws[stratum] random pixels of a stratum in n_draws.
+
+    All pixels are drawn of the strata that are not in n_draws.
+
+    :param strata: [y, x] stratum of each pixel, e.g. its polygon, -1 for none
+    :param n_draws: dict of the number of pixels to draw per stratum
+    :param rng: numpy Generator to draw with
+    :return: [y, x] bool array of the drawn pixels
+    """
+    mask = strata >= 0
+    if not n_draws:
+        return mask
+    sampled_strata = np.array(sorted(n_draws))
+    limits = np.array([n_draws[stratum] for stratum in sampled_strata])
+    pixels = np.flatnonzero(np.isin(strata, sampled_strata))
+    groups = np.searchsorted(sampled_strata, strata.flat[pixels])
+    # A random order of the pixels of each stratum, the first ones are drawn
+    order = np.lexsort((rng.random(pixels.size), groups))
+    groups = groups[order]
+    rank = np.arange(pixels.size) - np.searchsorted(groups, groups)
+    mask.flat[pixels[order[rank >= limits[groups]]]] = False
+    return mask
+
+
+def _sample_classes(labels, max_samples_per_class):
+    """Labels of at most max_samples_per_class random pixels per class, the others -1."""
+    classes, counts = np.unique(labels[labels >= 0], return_counts=True)
+    n_draws = {
+        int(c): max_samples_per_class
+        for c, count in zip(classes, counts)
+        if count > max_samples_per_class
+    }
+    drawn = _sample_mask(labels, n_draws, np.random.default_rng(TRAINING_SEED))
+    return np.where(drawn, labels, -1)
+
+
+def _check_max_samples(max_samples_per_class):
+    if max_samples_per_class is not None and max_samples_per_class < 1:
+        msg = f"The maximum number of pixels per class must be 1 or more: {max_samples_per_class}"
+        raise ValueError(msg)
+
+
+def _block_window(block, row_starts, col_starts, chunks):
+    """Window of a block of a [bands, y, x] dask array in the raster."""
+    i_row, i_col = block
+    return Window(col_starts[i_col], row_starts[i_row], chunks[2][i_col], chunks[1][i_row])
+
+
+def _order_blocks(blocks, row_starts, col_starts, chunks, window):
+    """Order blocks by distance to a pixel window, the blocks in the window first.
+
+    Blocks at the same distance are ordered from the center of the window outwards.
+    """
+    top, left = window.row_off, window.col_off
+    bottom, right = top + window.height, left + window.width
+    center_row, center_col = (top + bottom) / 2, (left + right) / 2
+
+    def distance(block):
+        i_row, i_col = block
+        row_start, col_start = row_starts[i_row], col_starts[i_col]
+        row_stop, col_stop = row_start + chunks[0][i_row], col_start + chunks[1][i_col]
+        d_row = max(top - row_stop, row_start - bottom, 0)
+        d_col = max(left - col_stop, col_start - right, 0)
+        d_center = math.hypot(
+            (row_start + row_stop) / 2 - center_row, (col_start + col_stop) / 2 - center_col
+        )
+        return math.hypot(d_row, d_col), d_center
+
+    return sorted(blocks, key=distance)
+
+
+def _chunks_per_compute():
+    """Number of chunks computed together, all dask workers are kept busy."""
+    if dask.config.get("scheduler", None) in ("synchronous", "sync", "single-threaded"):
+        return 1
+    return dask.config.get("num_workers", None) or os.cpu_count() or 1
+
+
+def _resume_key(raster_path, model_path):
+    """Identify a raster and model by path and modification time."""
+    parts = []
+    for path in (raster_path, model_path):
+        path = Path(path).resolve()
+        parts += [path.as_posix(), str(path.stat().st_mtime_ns)]
+    return "|".join(parts)
+
+
+def _read_resume_state(resume_path, resume_key, output_path):
+    """Get the chunks already written by a cancelled run with the same key."""
+    if resume_key is None or not resume_path.exists() or not Path(output_path).exists():
+        return set()
+    with open(resume_path) as f:
+        state = json.load(f)
+    if state.get("key") != resume_key:
+        return set()
+    return {tuple(block) for block in state["done"]}
+
+
+def _write_resume_state(resume_path, resume_key, done):
+    with open(resume_path, "w") as f:
+        json.dump({"key": resume_key, "done": sorted(done)}, f)
+
+
+@contextmanager
+def _cached_features(
+    feature_cache, raster_path, feature_type, chunks, chunk_overlap, suffix=CACHE_SUFFIX
+):
+    """Yield the cache path of the features, or None when not caching.
+
+    Newly written features are registered in the cache when the block succeeds,
+    and discarded when it fails, since they may be partially written.
+    """
+    # IDENTITY features are the raster itself, nothing to cache
+    if feature_cache is None or feature_type == FeatureType.IDENTITY:
+        yield None
+        return
+
+    features_path = feature_cache.get_path(
+        raster_path, feature_type, chunks, chunk_overlap, suffix=suffix
+    )
+    # Other runs sharing the cache do not evict the features while they are used
+    with feature_cache.use(features_path):
+        cache_hit = features_path.exists()
+        try:
+            yield features_path
+        except BaseException:
+            if not cache_hit:
+                feature_cache.discard(features_path)
+            raise
+        feature_cache.add(features_path)
@@ -0,0 +1,228 @@
+import functools
+import logging
+import os
+from pathlib import Path
+from typing import NamedTuple, Optional
+
+import numpy as np
+import rasterio
+from pycoeus.features import FeatureType, NUM_FLAIR_CLASSES, DEFAULT_CHUNK_OVERLAP
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZES = (512, 1024, 2048, 4096)  # Candidate chunk sizes, in pixels
+MEMORY_FRACTION = 0.7  # Fraction of the free memory the plan may use
+FALLBACK_MEMORY = 2 * 1024**3  # Assumed free memory when it cannot be read
+# Rough peak of the FLAIR UNet activations per pixel, for one band at a time
+FLAIR_ACTIVATION_BYTES = 2048
+# Copies of the features alive at the same time:
+# the features, the label array expanded to all feature bands and the flattened copy for prediction
+FEATURE_COPIES = 3
+PREDICTION_BYTES = 32  # Probabilities of two classes in float64, plus a copy
+AUTO_CHUNK_OVERLAP = "auto"  # Chunk overlap that is derived from the receptive field of the features
+RECEPTIVE_FIELD_PROBE_SIZE = 256  # Size of the input used to measure the FLAIR receptive field
+# Fraction of the influence on the features of a pixel that may come from outside the overlap
+RECEPTIVE_FIELD_TOLERANCE = 0.01
+
+
+class ComputePlan(NamedTuple):
+    """Compute mode, chunk size and number of workers chosen for a raster."""
+
+    compute_mode: str
+    chunk_size: Optional[int]
+    num_workers: Optional[int]
+    estimated_memory: int
+    available_memory: int
+
+
+def plan_compute(
+    raster_path,
+    feature_type,
+    chunk_overlap=None,
+    chunk_size=None,
+    available_memory=None,
+    n_cpus=None,
+    feature_precision="float32",
+):
+    """Choose the compute mode, chunk size and number of workers for a raster.
+
+    "normal" is chosen when the whole raster and its features fit in the free
+    memory. Otherwise the chunk size and number of parallel chunks with the best
+    throughput that still fit are chosen, where throughput is the number of
+    chunks in flight times the fraction of each chunk that is not overlap.
+
+    :param raster_path: path to the input raster
+    :param feature_type: See pycoeus FeatureType enum for options
+    :param chunk_overlap: overlap between chunks for feature extraction
+    :param chunk_size: fix the chunk size instead of choosing it
+    :param available_memory: free memory in bytes, read from the system by default
+    :param n_cpus: number of CPUs, read from the system by default
+    :param feature_precision: precision the features are kept in, see feature_store
+    :return: ComputePlan
+    """
+    if chunk_overlap is None or chunk_overlap == AUTO_CHUNK_OVERLAP:
+        # A derived overlap is only known after loading FLAIR, plan with the default
+        chunk_overlap = DEFAULT_CHUNK_OVERLAP
+    if available_memory is None:
+        available_memory = get_available_memory()
+    if n_cpus is None:
+        n_cpus = os.cpu_count() or 1
+    budget = int(available_memory * MEMORY_FRACTION)
+
+    with rasterio.open(Path(raster_path)) as dataset:
+        height, width = dataset.height, dataset.width
+        n_bands = dataset.count
+        itemsize = np.dtype(dataset.dtypes[0]).itemsize
+
+    bytes_per_pixel = _bytes_per_pixel(n_bands, itemsize, feature_type, feature_precision)
+    normal_memory = height * width * bytes_per_pixel
+    logger.info(
+        f"Planning compute for raster of {width} x {height} pixels, {n_bands} bands of "
+        f"{itemsize} bytes, {feature_type.name} features in {feature_precision}, "
+        f"{available_memory / 1024**3:.1f} GB free memory and {n_cpus} CPUs"
+    )
+
+    if normal_memory <= budget and chunk_size is None:
+        plan = ComputePlan("normal", None, None, normal_memory, available_memory)
+        _log_plan(plan)
+        return plan
+
+    best = None
+    chunk_sizes = CHUNK_SIZES if chunk_size is None else (chunk_size,)
+    for size in chunk_sizes:
+        if best is not None and size >= max(height, width):
+            break  # A larger chunk still holds the whole raster
+        chunk_memory = (size + 2 * chunk_overlap) ** 2 * bytes_per_pixel
+        n_chunks = -(-height // size) * -(-width // size)
+        num_workers = min(n_cpus, n_chunks, budget // chunk_memory)
+        if num_workers < 1:
+            continue
+        efficiency = (size / (size + 2 * chunk_overlap)) ** 2
+        score = num_workers * efficiency
+        if best is None or score >= best[0]:
+            best = (score, size, num_workers, chunk_memory)
+
+    if best is None:
+        # Even the smallest chunk does not fit, process one chunk at a time
+        size = chunk_sizes[0]
+        chunk_memory = (size + 2 * chunk_overlap) ** 2 * bytes_per_pixel
+        logger.warning(
+            f"A chunk of {size} pixels needs about {chunk_memory / 1024**3:.1f} GB, "
+            f"more than the {budget / 1024**3:.1f} GB available. The run may swap."
+        )
+        plan = ComputePlan("safe", size, 1, chunk_memory, available_memory)
+    else:
+        _, size, num_workers, chunk_memory = best
+        compute_mode = "parallel" if num_workers > 1 else "safe"
+        plan = ComputePlan(
+            compute_mode, size, num_workers, chunk_memory * num_workers, available_memory
+        )
+    _log_plan(plan)
+    return plan
+
+
+def resolve_chunk_overlap(chunk_overlap, feature_type, chunk_size=None):
+    """The chunk overlap to use, derived from the receptive field if it is AUTO_CHUNK_OVERLAP.
+
+    :param chunk_overlap: overlap in pixels, None for the pycoeus default, or AUTO_CHUNK_OVERLAP
+    :param feature_type: See pycoeus FeatureType enum for options
+    :param chunk_size: chunk size, to log the share of the feature extraction spent on the overlap
+    """
+    if chunk_overlap != AUTO_CHUNK_OVERLAP:
+        return chunk_overlap
+    chunk_overlap = get_min_chunk_overlap(feature_type)
+    text = f"Overlap derived from the receptive field of the {feature_type.name} features: {chunk_overlap}"
+    if isinstance(chunk_size, int):
+        redundant = 1 - (chunk_size / (chunk_size + 2 * chunk_overlap)) ** 2
+        text += f", {redundant:.0%} of the feature extraction of a chunk of {chunk_size} is overlap"
+    logger.info(text)
+    return chunk_overlap
+
+
+@functools.lru_cache(maxsize=None)
+def get_min_chunk_overlap(feature_type, tolerance=RECEPTIVE_FIELD_TOLERANCE):
+    """Smallest chunk overlap that holds nearly all of the influence on the features of a pixel.
+
+    The FLAIR UNet has a theoretical receptive field of about 200 pixels, but the
+    features of a pixel depend mostly on the pixels close to it. This measures the
+    effective receptive field: the gradient of the features of the centre pixel of
+    a random input to every input pixel. The overlap is the distance from the centre
+    within which all but tolerance of the absolute gradient lies.
+
+    Chunks with a smaller overlap get features that differ more from those of the
+    whole raster at their edges. Features do not depend on the neighbours of a pixel
+    for IDENTITY, so no overlap is needed.
+    """
+    if feature_type == FeatureType.IDENTITY:
+        return 0
+
+    import torch
+    from pycoeus.features import load_model
+
+    model, device = load_model(1.0)
+    size = RECEPTIVE_FIELD_PROBE_SIZE
+    generator = torch.Generator().manual_seed(0)
+    probe = torch.randn((1, 1, size, size), generator=generator).to(device).requires_grad_()
+    # Squared, so features of opposite signs do not cancel out
+    model(probe)[0, :, size // 2, size // 2].square().sum().backward()
+    influence = probe.grad[0, 0].abs().cpu().numpy()
+
+    rows, cols = np.indices(influence.shape)
+    distance = np.maximum(abs(rows - size // 2), abs(cols - size // 2))
+    cumulative = np.cumsum(np.bincount(distance.ravel(), weights=influence.ravel()))
+    return int(np.searchsorted(cumulative, (1 - tolerance) * cumulative[-1]))
+
+
+def largest_raster(raster_paths):
+    """The raster with the most values, to plan a batch that shares one plan."""
+
+    def n_values(raster_path):
+        with rasterio.open(Path(raster_path)) as dataset:
+            return dataset.height * dataset.width * dataset.count
+
+    return max(raster_paths, key=n_values)
+
+
+def get_available_memory():
+    """Free system memory in bytes."""
+    try:
+        import psutil
+
+        return psutil.virtual_memory().available
+    except ImportError:
+        pass
+    try:
+        return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+    except (AttributeError, ValueError, OSError):
+        logger.warning(
+            f"Could not read the free memory, assuming {FALLBACK_MEMORY / 1024**3:.0f} GB"
+        )
+        return FALLBACK_MEMORY
+
+
+def _bytes_per_pixel(n_bands, itemsize, feature_type, feature_precision="float32"):
+    """Estimated peak memory per pixel of the pipeline."""
+    if feature_type == FeatureType.FLAIR:
+        n_features = n_bands * NUM_FLAIR_CLASSES
+        activations = FLAIR_ACTIVATION_BYTES
+        feature_itemsize = np.dtype(feature_precision).itemsize
+    else:
+        n_features = n_bands
+        activations = 0
+        feature_itemsize = max(itemsize, 4)
+    return (
+        n_bands * itemsize
+        + FEATURE_COPIES * n_features * feature_itemsize
+        + activations
+        + PREDICTION_BYTES
+    )
+
+
+def _log_plan(plan):
+    chunk_text = "" if plan.chunk_size is None else f", chunk size {plan.chunk_size}"
+    workers_text = "" if plan.num_workers is None else f", {plan.num_workers} workers"
+    logger.info(
+        f"Compute plan: {plan.compute_mode} mode{chunk_text}{workers_text}, "
+        f"estimated peak memory {plan.estimated_memory / 1024**3:.2f} GB "
+        f"of {plan.available_memory / 1024**3:.2f} GB free"
+    )
@@ -0,0 +1,140 @@
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait
+from pathlib import Path
+
+from .run_logging import submit
+
+# Chunks read ahead, and chunks waiting to be written, by default: double buffering
+DEFAULT_QUEUE_DEPTH = 2
+
+
+def prefetch(function, items, queue_depth=DEFAULT_QUEUE_DEPTH):
+    """Yield function(item) for each item in order, computed ahead by background threads.
+
+    While the caller works on one result, up to queue_depth next results are
+    computed, e.g. read from disk, by queue_depth threads, so at most
+    queue_depth + 1 results are in memory. function must be thread safe, see
+    ThreadLocalRaster. With a queue_depth of 0, nothing is computed ahead.
+    """
+    if queue_depth < 1:
+        for item in items:
+            yield function(item)
+        return
+
+    items = iter(items)
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=queue_depth, thread_name_prefix="prefetch") as executor:
+        try:
+            for item in items:
+                pending.append(submit(executor, function, item))
+                if len(pending) > queue_depth:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+        finally:
+            # Results that are not used, e.g. after a cancel, are not waited for
+            for future in pending:
+                future.cancel()
+
+
+class AsyncWriter:
+    """Run writes in order in a background thread, while the caller computes the next chunk.
+
+    At most queue_depth writes wait at a time, submit blocks when the queue is
+    full, so memory stays bounded. An error of a write is raised by the next
+    submit or flush. With a queue_depth of 0, writes run right away.
+
+    Use as a context manager, leaving it waits for the queued writes.
+    """
+
+    def __init__(self, queue_depth=DEFAULT_QUEUE_DEPTH):
+        self.queue_depth = queue_depth
+        self._executor = None
+        self._slots = threading.Semaphore(max(queue_depth, 1))
+        self._futures = []
+
+    def __enter__(self):
+        if self.queue_depth > 0:
+            self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="writer")
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            if exc_type is None:
+                self.flush()
+            else:
+                # Finish the writes that are queued, but keep the original error
+                wait(self._futures)
+        finally:
+            if self._executor is not None:
+                self._executor.shutdown()
+
+    def submit(self, function, *args, **kwargs):
+        """Queue function(*args, **kwargs), e.g. a write of a finished chunk."""
+        self._raise_errors()
+        if self._executor is None:
+            function(*args, **kwargs)
+            return
+        self._slots.acquire()
+        future = submit(self._executor, function, *args, **kwargs)
+        future.add_done_callback(lambda _: self._slots.release())
+        self._futures.append(future)
+
+    def flush(self):
+        """Wait for all queued writes."""
+        wait(self._futures)
+        self._raise_errors()
+
+    def _raise_errors(self):
+        errors = [f.exception() for f in self._futures if f.done() and f.exception() is not None]
+        self._futures = [f for f in self._futures if not f.done()]
+        if errors:
+            raise errors[0]
+
+
+class ThreadLocalRaster:
+    """Read windows of a raster from several threads, with a dataset per thread.
+
+    A rasterio dataset must not be read from several threads at once, so each
+    thread opens its own. The datasets are closed with close().
+    """
+
+    def __init__(self, raster_path):
+        self.raster_path = Path(raster_path)
+        self._local = threading.local()
+        self._datasets = []
+        self._lock = threading.Lock()
+
+    def read(self, window, indexes=None):
+        """Read a window of the raster, all bands or the bands in indexes."""
+        return self._dataset().read(indexes, window=window)
+
+    def read_masks(self, window, indexes=None):
+        """Read the masks of a window, 0 where a band has no data, see rasterio read_masks."""
+        return self._dataset().read_masks(indexes, window=window)
+
+    def close(self):
+        with self._lock:
+            datasets, self._datasets = self._datasets, []
+        for dataset in datasets:
+            dataset.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _dataset(self):
+        """The dataset of this thread, opened on first use."""
+        dataset = getattr(self._local, "dataset", None)
+        if dataset is None:
+            # Imported on first use, the plugin imports this module when QGIS starts
+            import rasterio
+
+            dataset = rasterio.open(self.raster_path)
+            self._local.dataset = dataset
+            with self._lock:
+                self._datasets.append(dataset)
+        return dataset
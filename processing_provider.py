@@ -0,0 +1,434 @@
+import logging
+import os
+from contextlib import contextmanager
+from pathlib import Path
+
+from qgis.core import (
+    QgsProcessing,
+    QgsProcessingAlgorithm,
+    QgsProcessingException,
+    QgsProcessingOutputFile,
+    QgsProcessingParameterBoolean,
+    QgsProcessingParameterDefinition,
+    QgsProcessingParameterEnum,
+    QgsProcessingParameterFeatureSource,
+    QgsProcessingParameterNumber,
+    QgsProcessingParameterRasterDestination,
+    QgsProcessingParameterRasterLayer,
+    QgsProcessingProvider,
+)
+from qgis.PyQt.QtGui import QIcon
+from .feature_cache import FeatureCache, DEFAULT_CACHE_SIZE_GB
+from .feature_store import FEATURE_PRECISIONS
+from .prefetch import DEFAULT_QUEUE_DEPTH
+from .run_logging import run_logging
+from .run_report import get_report_path
+from .worker import WorkerProcess, WorkerError
+from .utils import (
+    HTEXT_INPUT_RSASTER,
+    HTEXT_INPUT_POS_VEC,
+    HTEXT_INPUT_NEG_VEC,
+    HTEXT_AOI,
+    HTEXT_SKIP_NODATA,
+    HTEXT_FEATURE_TYPE,
+    HTEXT_COMPUTE_MODE_AUTO,
+    HTEXT_COMPUTE_MODE_NORMAL,
+    HTEXT_COMPUTE_MODE_PARALLEL,
+    HTEXT_COMPUTE_MODE_SAFE,
+    HTEXT_CHUNK_SIZE,
+    HTEXT_OVERLAP_SIZE,
+    HTEXT_AUTO_OVERLAP,
+    HTEXT_OUTPUT_FORMAT_GEOTIFF,
+    HTEXT_OUTPUT_FORMAT_COG_PROBABILITY,
+    HTEXT_OUTPUT_FORMAT_COG_CLASS,
+    HTEXT_OUTPUT_FORMAT_COG_CLASS_PROBABILITY,
+    HTEXT_PROCESSING_NUM_WORKERS,
+    HTEXT_FEATURE_PRECISION,
+    HTEXT_QUEUE_DEPTH,
+    HTEXT_MAX_SAMPLES,
+    get_label_geometries,
+    get_plugin_data_dir,
+    get_raster_path,
+)
+
+cmd_folder = os.path.split(__file__)[0]
+
+# pycoeus and the pipeline are imported when an algorithm runs, not when QGIS loads the provider,
+# so the options of the parameters are the names the pipeline takes
+FEATURE_TYPES = ("FLAIR", "IDENTITY")  # Options of the feature type parameter, FeatureType names
+COMPUTE_MODES = ("auto", "normal", "parallel", "safe")  # Options of the compute mode parameter
+# Options of the output format parameter, the same as pipeline.OUTPUT_FORMATS
+OUTPUT_FORMATS = ("geotiff", "cog_probability", "cog_class", "cog_class_probability")
+MAX_SAMPLES_PER_CLASS = 10000  # The same as pipeline.DEFAULT_MAX_SAMPLES_PER_CLASS
+
+
+class CoeusAIProvider(QgsProcessingProvider):
+    """Processing provider with the CoeusAI algorithms."""
+
+    def loadAlgorithms(self):
+        self.addAlgorithm(TrainAndPredictAlgorithm())
+
+    def id(self):
+        return "coeusai"
+
+    def name(self):
+        return "CoeusAI"
+
+    def icon(self):
+        return QIcon(os.path.join(cmd_folder, "icon.png"))
+
+
+class TrainAndPredictAlgorithm(QgsProcessingAlgorithm):
+    """Train on label polygons and predict a raster, like a run of the dialog.
+
+    Each run starts a worker process of its own, not the shared worker of the
+    dialog, so runs in parallel threads, e.g. of the batch interface, do not wait
+    for each other, and each has its own dask configuration, see set_compute_mode.
+    """
+
+    INPUT = "INPUT"
+    POSITIVE_LABELS = "POSITIVE_LABELS"
+    NEGATIVE_LABELS = "NEGATIVE_LABELS"
+    AOI = "AOI"
+    SKIP_NODATA = "SKIP_NODATA"
+    FEATURE_TYPE = "FEATURE_TYPE"
+    COMPUTE_MODE = "COMPUTE_MODE"
+    CHUNK_SIZE = "CHUNK_SIZE"
+    OVERLAP = "OVERLAP"
+    AUTO_OVERLAP = "AUTO_OVERLAP"
+    NUM_WORKERS = "NUM_WORKERS"
+    QUEUE_DEPTH = "QUEUE_DEPTH"
+    FEATURE_PRECISION = "FEATURE_PRECISION"
+    MAX_SAMPLES = "MAX_SAMPLES"
+    OUTPUT_FORMAT = "OUTPUT_FORMAT"
+    OUTPUT = "OUTPUT"
+    MODEL = "MODEL"
+    REPORT = "REPORT"
+
+    def createInstance(self):
+        return TrainAndPredictAlgorithm()
+
+    def name(self):
+        return "trainandpredict"
+
+    def displayName(self):
+        return "Train and predict"
+
+    def shortHelpString(self):
+        return (
+            "Train a classifier on positive and negative label polygons and predict "
+            "the probability of each class for every pixel of the raster, as the CoeusAI "
+            "dialog does. The trained model is saved next to the prediction, as "
+            "<prediction>.model.pkl, and the run report as <prediction>.report.json.\n\n"
+            "Each run goes in a process of its own, so the runs of a batch go in parallel. "
+            "Limit the parallel chunks per run, so that all runs together fit in the cores "
+            "and memory."
+        )
+
+    def icon(self):
+        return QIcon(os.path.join(cmd_folder, "icon.png"))
+
+    def initAlgorithm(self, config=None):
+        self._add_parameter(
+            QgsProcessingParameterRasterLayer(self.INPUT, "Raster layer"),
+            HTEXT_INPUT_RSASTER,
+        )
+        self._add_parameter(
+            QgsProcessingParameterFeatureSource(
+                self.POSITIVE_LABELS, "Positive labels", [QgsProcessing.TypeVectorPolygon]
+            ),
+            HTEXT_INPUT_POS_VEC,
+        )
+        self._add_parameter(
+            QgsProcessingParameterFeatureSource(
+                self.NEGATIVE_LABELS, "Negative labels", [QgsProcessing.TypeVectorPolygon]
+            ),
+            HTEXT_INPUT_NEG_VEC,
+        )
+        self._add_parameter(
+            QgsProcessingParameterFeatureSource(
+                self.AOI,
+                "Area of interest",
+                [QgsProcessing.TypeVectorPolygon],
+                optional=True,
+            ),
+            HTEXT_AOI,
+        )
+        self._add_parameter(
+            QgsProcessingParameterBoolean(
+                self.SKIP_NODATA, "Skip areas without data", defaultValue=True
+            ),
+            HTEXT_SKIP_NODATA,
+        )
+        self._add_parameter(
+            QgsProcessingParameterEnum(
+                self.FEATURE_TYPE,
+                "Feature type",
+                options=list(FEATURE_TYPES),
+                defaultValue=0,
+            ),
+            HTEXT_FEATURE_TYPE,
+        )
+        self._add_parameter(
+            QgsProcessingParameterEnum(
+                self.COMPUTE_MODE,
+                "Compute mode",
+                options=[compute_mode.capitalize() for compute_mode in COMPUTE_MODES],
+                defaultValue=0,
+            ),
+            "\n".join(
+                (
+                    HTEXT_COMPUTE_MODE_AUTO,
+                    HTEXT_COMPUTE_MODE_NORMAL,
+                    HTEXT_COMPUTE_MODE_PARALLEL,
+                    HTEXT_COMPUTE_MODE_SAFE,
+                )
+            ),
+        )
+        self._add_parameter(
+            QgsProcessingParameterNumber(
+                self.CHUNK_SIZE,
+                "Chunk size",
+                type=QgsProcessingParameterNumber.Integer,
+                optional=True,
+                minValue=1,
+            ),
+            HTEXT_CHUNK_SIZE,
+            advanced=True,
+        )
+        self._add_parameter(
+            QgsProcessingParameterNumber(
+                self.OVERLAP,
+                "Overlap size",
+                type=QgsProcessingParameterNumber.Integer,
+                optional=True,
+                minValue=0,
+            ),
+            HTEXT_OVERLAP_SIZE,
+            advanced=True,
+        )
+        self._add_parameter(
+            QgsProcessingParameterBoolean(
+                self.AUTO_OVERLAP, "Derive the overlap from the receptive field", defaultValue=False
+            ),
+            HTEXT_AUTO_OVERLAP,
+            advanced=True,
+        )
+        self._add_parameter(
+            QgsProcessingParameterNumber(
+                self.NUM_WORKERS,
+                "Parallel chunks",
+                type=QgsProcessingParameterNumber.Integer,
+                optional=True,
+                minValue=1,
+            ),
+            HTEXT_PROCESSING_NUM_WORKERS,
+            advanced=True,
+        )
+        self._add_parameter(
+            QgsProcessingParameterEnum(
+                self.FEATURE_PRECISION,
+                "Feature precision",
+                options=list(FEATURE_PRECISIONS),
+                defaultValue=0,
+            ),
+            HTEXT_FEATURE_PRECISION,
+            advanced=True,
+        )
+        self._add_parameter(
+            QgsProcessingParameterNumber(
+                self.QUEUE_DEPTH,
+                "Prefetch queue depth",
+                type=QgsProcessingParameterNumber.Integer,
+                minValue=0,
+                defaultValue=DEFAULT_QUEUE_DEPTH,
+            ),
+            HTEXT_QUEUE_DEPTH,
+            advanced=True,
+        )
+        self._add_parameter(
+            QgsProcessingParameterNumber(
+                self.MAX_SAMPLES,
+                "Training pixels per class (0 for all)",
+                type=QgsProcessingParameterNumber.Integer,
+                minValue=0,
+                defaultValue=MAX_SAMPLES_PER_CLASS,
+            ),
+            HTEXT_MAX_SAMPLES,
+            advanced=True,
+        )
+        self._add_parameter(
+            QgsProcessingParameterEnum(
+                self.OUTPUT_FORMAT,
+                "Output format",
+                options=list(OUTPUT_FORMATS),
+                defaultValue=0,
+            ),
+            "\n".join(
+                (
+                    HTEXT_OUTPUT_FORMAT_GEOTIFF,
+                    HTEXT_OUTPUT_FORMAT_COG_PROBABILITY,
+                    HTEXT_OUTPUT_FORMAT_COG_CLASS,
+                    HTEXT_OUTPUT_FORMAT_COG_CLASS_PROBABILITY,
+                )
+            ),
+        )
+        self.addParameter(
+            QgsProcessingParameterRasterDestination(self.OUTPUT, "Prediction")
+        )
+        self.addOutput(QgsProcessingOutputFile(self.MODEL, "Model"))
+        self.addOutput(QgsProcessingOutputFile(self.REPORT, "Run report"))
+
+    def processAlgorithm(self, parameters, context, feedback):
+        from pycoeus.features import FeatureType
+        from .pipeline import get_model_path
+        from .planner import plan_compute, AUTO_CHUNK_OVERLAP
+        from .progress import ClassificationCancelled
+
+        raster_layer = self.parameterAsRasterLayer(parameters, self.INPUT, context)
+        if raster_layer is None:
+            raise QgsProcessingException(self.invalidRasterError(parameters, self.INPUT))
+        raster_path = get_raster_path(raster_layer)
+        pos_labels, neg_labels = (
+            get_label_geometries(
+                self.parameterAsSource(parameters, name, context), raster_layer.crs()
+            )
+            for name in (self.POSITIVE_LABELS, self.NEGATIVE_LABELS)
+        )
+        aoi_source = self.parameterAsSource(parameters, self.AOI, context)
+        aoi = (
+            get_label_geometries(aoi_source, raster_layer.crs())
+            if aoi_source is not None
+            else None
+        )
+        skip_nodata = self.parameterAsBoolean(parameters, self.SKIP_NODATA, context)
+        feature_type = FeatureType[
+            FEATURE_TYPES[self.parameterAsEnum(parameters, self.FEATURE_TYPE, context)]
+        ]
+        compute_mode = COMPUTE_MODES[self.parameterAsEnum(parameters, self.COMPUTE_MODE, context)]
+        output_format = OUTPUT_FORMATS[
+            self.parameterAsEnum(parameters, self.OUTPUT_FORMAT, context)
+        ]
+        # Optional numbers that are not set are read as 0
+        chunk_size = self.parameterAsInt(parameters, self.CHUNK_SIZE, context) or None
+        overlap_size = (
+            self.parameterAsInt(parameters, self.OVERLAP, context)
+            if parameters.get(self.OVERLAP) is not None
+            else None
+        )
+        if self.parameterAsBoolean(parameters, self.AUTO_OVERLAP, context):
+            overlap_size = AUTO_CHUNK_OVERLAP
+        num_workers = self.parameterAsInt(parameters, self.NUM_WORKERS, context) or None
+        feature_precision = FEATURE_PRECISIONS[
+            self.parameterAsEnum(parameters, self.FEATURE_PRECISION, context)
+        ]
+        queue_depth = self.parameterAsInt(parameters, self.QUEUE_DEPTH, context)
+        # 0 trains on all labelled pixels
+        max_samples_per_class = self.parameterAsInt(parameters, self.MAX_SAMPLES, context) or None
+        output_path = Path(self.parameterAsOutputLayer(parameters, self.OUTPUT, context))
+
+        if compute_mode == "auto":
+            # Plan for the CPUs given to this run, other runs may use the rest
+            plan = plan_compute(
+                raster_path,
+                feature_type,
+                chunk_overlap=overlap_size,
+                n_cpus=num_workers,
+                feature_precision=feature_precision,
+            )
+            compute_mode = plan.compute_mode
+            chunk_size = plan.chunk_size
+            num_workers = plan.num_workers or num_workers
+
+        progress = _get_progress(feedback)
+        feature_cache = FeatureCache(
+            get_plugin_data_dir() / "feature_cache", DEFAULT_CACHE_SIZE_GB * 1024**3
+        )
+        # The records the worker sends are logged in this thread, so they go to this run
+        with _log_to_feedback(feedback):
+            worker = WorkerProcess(get_plugin_data_dir() / "worker.log")
+            try:
+                worker.run(
+                    "train_and_predict",
+                    progress=progress,
+                    raster_path=raster_path,
+                    pos_labels_path=pos_labels,
+                    neg_labels_path=neg_labels,
+                    output_path=output_path,
+                    feature_type=feature_type,
+                    compute_mode=compute_mode,
+                    chunks=chunk_size,
+                    chunk_overlap=overlap_size,
+                    feature_cache=feature_cache,
+                    num_workers=num_workers,
+                    output_format=output_format,
+                    feature_precision=feature_precision,
+                    queue_depth=queue_depth,
+                    aoi=aoi,
+                    skip_nodata=skip_nodata,
+                    max_samples_per_class=max_samples_per_class,
+                )
+            except (ClassificationCancelled, RuntimeError, WorkerError) as e:
+                # Errors of the pipeline in the worker, e.g. invalid labels, are RuntimeErrors
+                raise QgsProcessingException(str(e)) from e
+            finally:
+                worker.stop()
+
+        return {
+            self.OUTPUT: str(output_path),
+            self.MODEL: str(get_model_path(output_path)),
+            self.REPORT: str(get_report_path(output_path)),
+        }
+
+    def _add_parameter(self, parameter, help_text, advanced=False):
+        parameter.setHelp(help_text)
+        if advanced:
+            parameter.setFlags(parameter.flags() | QgsProcessingParameterDefinition.FlagAdvanced)
+        self.addParameter(parameter)
+
+
+def _get_progress(feedback):
+    """A Progress that reports to the processing feedback and is cancelled with it.
+
+    The worker checks the Progress for cancellation while it waits for the run.
+    """
+    from .progress import Progress
+
+    stages = []
+
+    def callback(stage, done, total, pixels_per_second, eta):
+        if not stages or stages[-1] != stage:
+            stages.append(stage)
+            feedback.setProgressText(stage)
+        feedback.setProgress(100 * done / total if total else 0)
+
+    return Progress(callback, cancel_check=feedback.isCanceled)
+
+
+@contextmanager
+def _log_to_feedback(feedback):
+    """Show the log records of the plugin and pycoeus in the processing log."""
+    handler = _FeedbackLogHandler(feedback)
+    handler.setFormatter(logging.Formatter("%(message)s"))
+    handler.setLevel(logging.INFO)
+    with run_logging([handler]):
+        yield
+
+
+class _FeedbackLogHandler(logging.Handler):
+    """Pass log records of a run of an algorithm to its feedback.
+
+    run_logging only passes the records of the run, also those of its helper
+    threads, not those of runs in parallel threads.
+    """
+
+    def __init__(self, feedback):
+        super().__init__()
+        self.feedback = feedback
+
+    def emit(self, record):
+        text = self.format(record)
+        if record.levelno >= logging.WARNING:
+            self.feedback.reportError(text)
+        else:
+            self.feedback.pushInfo(text)
@@ -0,0 +1,146 @@
+import threading
+import time
+
+from dask.callbacks import Callback
+
+from .run_report import RunReport
+
+
+class ClassificationCancelled(Exception):
+    """Raised at a chunk boundary when a run is cancelled."""
+
+
+class Progress:
+    """Progress and cancellation channel between the pipeline and its caller.
+
+    The pipeline reports each stage with start() and advance(), and calls
+    check_cancelled() between chunks. The callback is called with the stage name,
+    the number of chunks done, the total number of chunks, the throughput in
+    pixels per second and the estimated time left in seconds, or -1 if unknown.
+    A total of 0 means the stage has no chunks to count. The optional
+    output_callback is called with the path of an output that was partially
+    written and can be shown already. The pipeline also measures its stages
+    with measure(), in the RunReport of the run. The optional cancel_check is
+    called to find out whether the caller cancelled the run, besides cancel().
+    """
+
+    def __init__(self, callback=None, output_callback=None, report=None, cancel_check=None):
+        self.callback = callback
+        self.output_callback = output_callback
+        self.report = report if report is not None else RunReport()
+        self.cancel_check = cancel_check
+        self._cancel_event = threading.Event()
+        self._lock = threading.Lock()
+        self.stage = None
+        self.done = 0
+        self.initial_done = 0
+        self.total = 0
+        self.pixels_done = 0
+        self.start_time = time.perf_counter()
+
+    def cancel(self):
+        """Request the run to stop at the next chunk boundary."""
+        self._cancel_event.set()
+
+    @property
+    def cancelled(self):
+        if self.cancel_check is not None and self.cancel_check():
+            self._cancel_event.set()
+        return self._cancel_event.is_set()
+
+    def background(self, report=None):
+        """A Progress that shares the cancellation of this one, but does not report.
+
+        :param report: RunReport for its measurements, by default the one of this Progress
+        """
+        background = Progress(
+            report=report if report is not None else self.report, cancel_check=self.cancel_check
+        )
+        background._cancel_event = self._cancel_event
+        return background
+
+    def with_report(self, report):
+        """A Progress with the callbacks and cancellation of this one, but its own RunReport."""
+        progress = Progress(self.callback, self.output_callback, report, self.cancel_check)
+        progress._cancel_event = self._cancel_event
+        return progress
+
+    def measure(self, stage):
+        """Context manager that measures the code in the with block as part of stage."""
+        return self.report.measure(stage)
+
+    def check_cancelled(self):
+        """Raise ClassificationCancelled if the run was cancelled."""
+        if self.cancelled:
+            raise ClassificationCancelled(f"Cancelled during {self.stage}")
+
+    def start(self, stage, total=0, done=0):
+        """Start a new stage of the run, with total chunks of which done are already done."""
+        self.check_cancelled()
+        with self._lock:
+            self.stage = stage
+            self.done = done
+            self.initial_done = done
+            self.total = total
+            self.pixels_done = 0
+            self.start_time = time.perf_counter()
+        self._report()
+
+    def advance(self, n_chunks=1, n_pixels=0):
+        """Mark n_chunks chunks, with n_pixels pixels in total, as done."""
+        with self._lock:
+            self.done += n_chunks
+            self.pixels_done += n_pixels
+        self._report()
+
+    def output_updated(self, path):
+        """Report that more of the output at path was written."""
+        if self.output_callback is not None:
+            self.output_callback(str(path))
+
+    def dask_callback(self, total_pixels=0):
+        """Dask callback that reports finished tasks of this thread and checks for cancellation."""
+        return _DaskProgress(self, total_pixels)
+
+    def _report(self):
+        if self.callback is None:
+            return
+        with self._lock:
+            elapsed = time.perf_counter() - self.start_time
+            pixels_per_second = self.pixels_done / elapsed if elapsed > 0 else 0.0
+            eta = -1.0
+            # Chunks that were already done when the stage started took no time
+            n_timed = self.done - self.initial_done
+            if self.total and n_timed > 0:
+                eta = elapsed / n_timed * (self.total - self.done)
+            args = (self.stage, self.done, self.total, pixels_per_second, eta)
+        self.callback(*args)
+
+
+class _DaskProgress(Callback):
+    """Report the tasks of a dask computation as chunks of the current stage.
+
+    Dask callbacks are global, so only computations started from the thread that
+    created the callback are reported. Every computation checks for cancellation.
+    """
+
+    def __init__(self, progress, total_pixels=0):
+        super().__init__()
+        self.progress = progress
+        self.total_pixels = total_pixels
+        self.thread_id = threading.get_ident()
+        self.n_tasks = 0
+
+    def _start_state(self, dsk, state):
+        if threading.get_ident() != self.thread_id:
+            return
+        self.n_tasks = sum(len(state[k]) for k in ("ready", "waiting", "running"))
+        self.progress.start(self.progress.stage, self.n_tasks)
+
+    def _pretask(self, key, dsk, state):
+        self.progress.check_cancelled()
+
+    def _posttask(self, key, result, dsk, state, worker_id):
+        if threading.get_ident() != self.thread_id or not self.n_tasks:
+            return
+        self.progress.advance(1, self.total_pixels // self.n_tasks)
@@ -0,0 +1,99 @@
+import hashlib
+import threading
+
+import numpy as np
+import rasterio
+from rasterio.enums import MaskFlags
+from rasterio.features import geometry_mask
+from shapely.geometry import box
+
+from .prefetch import ThreadLocalRaster
+
+
+class ValidRegion:
+    """The pixels of a raster to classify: inside an area of interest and with data.
+
+    A chunk without any of these pixels is skipped, its bands are not read and
+    its features are not extracted, and it is left as nodata in the prediction.
+    The area of interest is tested on the polygons, and the data on the mask of
+    the raster, e.g. its nodata value or alpha band, which is read for one band
+    per chunk only. Without an area of interest and with skip_nodata off, or for
+    a raster without nodata, every pixel is valid and nothing is read.
+
+    Use as a context manager, or close() it, to close the raster.
+    """
+
+    def __init__(self, raster_path, aoi=None, skip_nodata=False):
+        """
+        :param raster_path: path to the raster
+        :param aoi: optional GeoSeries of area of interest polygons, in the crs of the raster
+        :param skip_nodata: skip the pixels the mask of the raster marks as nodata
+        """
+        with rasterio.open(raster_path) as dataset:
+            self.transform = dataset.transform
+            has_mask = MaskFlags.all_valid not in dataset.mask_flag_enums[0]
+        self.aoi = aoi
+        self.skip_nodata = skip_nodata and has_mask
+        self._reader = ThreadLocalRaster(raster_path)
+        self._covers = {}  # Whether a window has valid pixels, per window
+        self._lock = threading.Lock()
+
+    @property
+    def restricted(self):
+        """Whether some pixels may not be valid, else all chunks are classified."""
+        return self.aoi is not None or self.skip_nodata
+
+    @property
+    def key(self):
+        """Identifies the area of interest and nodata setting, None when not restricted."""
+        if not self.restricted:
+            return None
+        digest = hashlib.sha256(str(self.skip_nodata).encode())
+        if self.aoi is not None:
+            for geometry in self.aoi:
+                digest.update(geometry.wkb)
+        return digest.hexdigest()[:12]
+
+    def mask(self, window):
+        """Valid pixels of a window as a [y, x] bool array, or None when all are valid."""
+        valid = None
+        if self.aoi is not None:
+            window_box = box(*rasterio.windows.bounds(window, self.transform))
+            # A window within one polygon is inside the area of interest as a whole
+            if not len(self.aoi.sindex.query(window_box, predicate="within")):
+                polygons = self.aoi.iloc[self.aoi.sindex.query(window_box)]
+                valid = np.zeros((window.height, window.width), dtype=bool)
+                if len(polygons):
+                    valid = geometry_mask(
+                        polygons,
+                        out_shape=(window.height, window.width),
+                        transform=rasterio.windows.transform(window, self.transform),
+                        invert=True,
+                    )
+        if self.skip_nodata and (valid is None or valid.any()):
+            data = self._reader.read_masks(window, 1) > 0
+            valid = data if valid is None else valid & data
+        return valid
+
+    def covers(self, window):
+        """Whether a window has any valid pixels."""
+        if not self.restricted:
+            return True
+        key = (window.row_off, window.col_off, window.height, window.width)
+        with self._lock:
+            if key in self._covers:
+                return self._covers[key]
+        valid = self.mask(window)
+        covers = valid is None or bool(valid.any())
+        with self._lock:
+            self._covers[key] = covers
+        return covers
+
+    def close(self):
+        self._reader.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -0,0 +1,95 @@
+import contextvars
+import logging
+import queue
+import threading
+from contextlib import contextmanager
+from logging.handlers import QueueHandler, QueueListener
+
+LOG_FORMAT = "%(asctime)s - %(name)s - %(levelname)s - %(message)s"  # Format of the log files
+RUN_LOGGERS = (__package__, "pycoeus")  # Loggers of the plugin and pycoeus, handled per run
+DEBUG_INTERVAL = 1.0  # Seconds between DEBUG records logged from the same line of code
+
+_run = contextvars.ContextVar("run", default=None)  # The run the code in this context belongs to
+
+
+@contextmanager
+def run_logging(handlers, logger_names=RUN_LOGGERS):
+    """Handle the log records of the loggers with handlers during a run, in a listener thread.
+
+    Logging a record only puts it in a queue, so the threads of the run do not
+    wait for the log files or the QGIS log. The handlers are closed at the end
+    of the with block, after the records in the queue are handled, so each run
+    has its own handlers and no record is handled twice.
+
+    The run is set in a context variable, and only records logged in its context
+    are handled, so runs in parallel threads of one process, e.g. the dialog and
+    a processing algorithm, do not get each other's records. Dask passes the
+    context to its threads, the threads of the plugin get it from submit.
+
+    :param handlers: handlers of the run, e.g. file handlers, with their own levels
+    """
+    records = queue.SimpleQueue()
+    queue_handler = QueueHandler(records)
+    run = object()
+    queue_handler.addFilter(RunFilter(run))
+    queue_handler.addFilter(DebugRateLimit())
+    listener = QueueListener(records, *handlers, respect_handler_level=True)
+    loggers = [logging.getLogger(name) for name in logger_names]
+    listener.start()
+    for logger in loggers:
+        logger.addHandler(queue_handler)
+    token = _run.set(run)
+    try:
+        yield
+    finally:
+        _run.reset(token)
+        for logger in loggers:
+            logger.removeHandler(queue_handler)
+        listener.stop()
+        for handler in handlers:
+            handler.close()
+
+
+def submit(executor, function, *args, **kwargs):
+    """executor.submit in the context of the caller, so the records of function go to its run.
+
+    A ThreadPoolExecutor does not pass the context to its threads.
+    """
+    return executor.submit(contextvars.copy_context().run, function, *args, **kwargs)
+
+
+class RunFilter(logging.Filter):
+    """Let through the records logged in the context of a run only, see run_logging."""
+
+    def __init__(self, run):
+        super().__init__()
+        self.run = run
+
+    def filter(self, record):
+        return _run.get() is self.run
+
+
+class DebugRateLimit(logging.Filter):
+    """Let through at most one DEBUG record per DEBUG_INTERVAL from each line of code.
+
+    DEBUG records logged in a loop over chunks, e.g. the array shapes pycoeus
+    logs for each chunk, would otherwise take more time than the chunks.
+    Records of other levels are all let through.
+    """
+
+    def __init__(self, interval=DEBUG_INTERVAL):
+        super().__init__()
+        self.interval = interval
+        self._last_logged = {}  # Time of the last record let through, per file and line
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        if record.levelno > logging.DEBUG:
+            return True
+        key = (record.pathname, record.lineno)
+        with self._lock:
+            last_logged = self._last_logged.get(key)
+            if last_logged is not None and record.created - last_logged < self.interval:
+                return False
+            self._last_logged[key] = record.created
+        return True
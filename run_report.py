@@ -0,0 +1,220 @@
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from enum import Enum
+from pathlib import Path
+
+REPORT_SUFFIX = ".report.json"  # Suffix of the run report saved next to the prediction
+MEMORY_SAMPLE_INTERVAL = 0.05  # Seconds between samples of the memory use
+# A stage that uses less CPU time than this fraction of its wall time mostly waits, e.g. for I/O
+WAITING_CPU_FRACTION = 0.5
+
+
+class RunReport:
+    """Wall time, CPU time, bytes read and written and peak memory per stage of a run.
+
+    Stages are measured with measure(). Measuring the same stage again adds to
+    it, so a stage that is done chunk by chunk, interleaved with other stages,
+    is reported as a whole. CPU time, bytes and memory are of the whole process,
+    so stages that run at the same time, as in batch mode, are counted in both.
+    """
+
+    def __init__(self):
+        self.started = datetime.now(timezone.utc)
+        self.start_time = time.perf_counter()
+        self.stages = {}
+        self.results = {}
+        self._active = {}  # Number of running measurements per stage
+        self._lock = threading.Lock()
+        self._sampler = None
+
+    @contextmanager
+    def measure(self, stage):
+        """Measure the code in the with block as part of stage."""
+        with self._lock:
+            self.stages.setdefault(
+                stage,
+                {
+                    "wall_time": 0.0,
+                    "cpu_time": 0.0,
+                    "bytes_read": None,
+                    "bytes_written": None,
+                    "peak_memory": None,
+                    "calls": 0,
+                },
+            )
+            self._active[stage] = self._active.get(stage, 0) + 1
+            if self._sampler is None:
+                self._sampler = threading.Thread(target=self._sample_memory, daemon=True)
+                self._sampler.start()
+        self._update_peak_memory()
+        io_start = _io_counters()
+        cpu_start = time.process_time()
+        wall_start = time.perf_counter()
+        try:
+            yield
+        finally:
+            wall_time = time.perf_counter() - wall_start
+            cpu_time = time.process_time() - cpu_start
+            io_stop = _io_counters()
+            self._update_peak_memory()
+            with self._lock:
+                measured = self.stages[stage]
+                measured["wall_time"] += wall_time
+                measured["cpu_time"] += cpu_time
+                measured["calls"] += 1
+                if io_start is not None and io_stop is not None:
+                    measured["bytes_read"] = (
+                        (measured["bytes_read"] or 0) + io_stop[0] - io_start[0]
+                    )
+                    measured["bytes_written"] = (
+                        (measured["bytes_written"] or 0) + io_stop[1] - io_start[1]
+                    )
+                self._active[stage] -= 1
+                if not self._active[stage]:
+                    del self._active[stage]
+
+    def record(self, name, result):
+        """Record a result of the run, a dict with a "summary" text for format_summary."""
+        with self._lock:
+            self.results[name] = result
+
+    def to_dict(self, **run_info):
+        """The report as a dict, with run_info describing the run."""
+        with self._lock:
+            stages = {name: dict(measured) for name, measured in self.stages.items()}
+            results = {name: _to_json(result) for name, result in self.results.items()}
+        peaks = [s["peak_memory"] for s in stages.values() if s["peak_memory"] is not None]
+        return {
+            "started": self.started.isoformat(),
+            "wall_time": time.perf_counter() - self.start_time,
+            "peak_memory": max(peaks, default=None),
+            "run": {key: _to_json(value) for key, value in run_info.items()},
+            "stages": stages,
+            "results": results,
+        }
+
+    def write(self, path, **run_info):
+        """Write the report as JSON to path, with run_info describing the run."""
+        with open(path, "w") as f:
+            json.dump(self.to_dict(**run_info), f, indent=2)
+
+    def _sample_memory(self):
+        """Track the peak memory of the running stages, until none are running."""
+        while True:
+            time.sleep(MEMORY_SAMPLE_INTERVAL)
+            with self._lock:
+                if not self._active:
+                    self._sampler = None
+                    return
+            self._update_peak_memory()
+
+    def _update_peak_memory(self):
+        rss = _rss()
+        if rss is None:
+            return
+        with self._lock:
+            for stage in self._active:
+                peak = self.stages[stage]["peak_memory"]
+                self.stages[stage]["peak_memory"] = rss if peak is None else max(peak, rss)
+
+
+def get_report_path(output_path):
+    """Path of the run report of a prediction."""
+    return Path(output_path).with_suffix(REPORT_SUFFIX)
+
+
+def read_report(path):
+    """Read a run report written by RunReport.write."""
+    with open(path) as f:
+        return json.load(f)
+
+
+def format_summary(report):
+    """A short text summary of a run report, one line per stage."""
+    lines = [
+        f"Total {_format_seconds(report['wall_time'])}, "
+        f"peak memory {_format_bytes(report['peak_memory'])}"
+    ]
+    for name, stage in report["stages"].items():
+        line = (
+            f"{name}: {_format_seconds(stage['wall_time'])} wall, "
+            f"{_format_seconds(stage['cpu_time'])} CPU"
+        )
+        if stage["bytes_read"] is not None:
+            line += (
+                f", {_format_bytes(stage['bytes_read'])} read, "
+                f"{_format_bytes(stage['bytes_written'])} written"
+            )
+        line += f", peak {_format_bytes(stage['peak_memory'])}"
+        if stage["wall_time"] > 0 and stage["cpu_time"] < WAITING_CPU_FRACTION * stage["wall_time"]:
+            line += " (mostly waiting, e.g. for I/O)"
+        lines.append(line)
+    # Reports written before results were recorded have none
+    for result in report.get("results", {}).values():
+        lines.append(result["summary"])
+    return "\n".join(lines)
+
+
+def _format_seconds(seconds):
+    return f"{seconds:.1f} s"
+
+
+def _format_bytes(n_bytes):
+    if n_bytes is None:
+        return "unknown"
+    if n_bytes < 1024**3:
+        return f"{n_bytes / 1024**2:.0f} MB"
+    return f"{n_bytes / 1024**3:.2f} GB"
+
+
+def _to_json(value):
+    """Values of the run info that JSON does not know, as text."""
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    if isinstance(value, Enum):
+        return value.name
+    if isinstance(value, (list, tuple)):
+        return [_to_json(v) for v in value]
+    if isinstance(value, dict):
+        return {str(k): _to_json(v) for k, v in value.items()}
+    return str(value)
+
+
+def _rss():
+    """Resident memory of this process in bytes, or None if it cannot be read."""
+    try:
+        import psutil
+
+        return psutil.Process().memory_info().rss
+    except ImportError:
+        pass
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+def _io_counters():
+    """Bytes read and written by this process, including from the file cache, or None."""
+    try:
+        import psutil
+
+        counters = psutil.Process().io_counters()
+        # read_chars includes reads served from the file cache, on Linux only
+        return (
+            getattr(counters, "read_chars", counters.read_bytes),
+            getattr(counters, "write_chars", counters.write_bytes),
+        )
+    except (ImportError, AttributeError, NotImplementedError):
+        pass
+    try:
+        with open("/proc/self/io") as f:
+            counters = dict(line.split(": ") for line in f.read().splitlines())
+        return int(counters["rchar"]), int(counters["wchar"])
+    except (OSError, KeyError, ValueError):
+        return None
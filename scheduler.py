@@ -0,0 +1,203 @@
+import contextvars
+import logging
+import os
+import sys
+import time
+from collections import defaultdict
+from contextlib import ExitStack, contextmanager
+from pathlib import Path
+from typing import NamedTuple, Optional
+
+logger = logging.getLogger(__name__)
+
+SCHEDULER_TYPES = ("threads", "processes")  # Workers of the local scheduler of "parallel" mode
+SETTINGS_GROUP = "coeusai/scheduler"  # QGIS settings group the dialog remembers them in
+TOP_TASK_GROUPS = 3  # Task groups with the most compute time in the summary
+
+# Settings of the scheduler of the run in this context, see use_scheduler
+_active = contextvars.ContextVar("scheduler", default=None)
+
+
+class SchedulerSettings(NamedTuple):
+    """Local scheduler of "parallel" mode, see use_scheduler."""
+
+    scheduler_type: str = "threads"  # One of SCHEDULER_TYPES
+    n_workers: Optional[int] = None  # None for the planned number of chunks, or all CPUs
+    memory_limit: Optional[int] = None  # Bytes per worker, None for no limit
+    spill_directory: Optional[str] = None  # None for the temporary directory of dask
+
+
+def scheduler_active():
+    """Whether this run uses a scheduler of use_scheduler, instead of the default threads."""
+    return _active.get() is not None
+
+
+@contextmanager
+def use_scheduler(settings, progress=None, num_workers=None):
+    """Compute with a local scheduler built from settings in the with block.
+
+    With dask.distributed installed, a LocalCluster is started: n_workers
+    processes with a thread each, or one worker with n_workers threads. A
+    worker spills data to the spill directory as it nears its memory limit,
+    and pauses above it. Without dask.distributed, dask's own scheduler of
+    threads or processes is used, which has no memory limit.
+
+    The task stream is recorded, and its statistics are logged and recorded in
+    the run report of progress: the number of tasks, the compute time per task
+    group, the use of the workers and the time spent transferring and spilling.
+
+    A with block within another one uses the scheduler of the outer block. The
+    scheduler is set in the dask configuration, which is process-wide, so runs
+    in parallel threads of one process must not use it.
+
+    :param settings: SchedulerSettings, or None to leave the scheduler as it is
+    :param progress: optional Progress to record the statistics in its run report
+    :param num_workers: number of workers when settings has none, e.g. from the plan
+    """
+    if settings is None or scheduler_active():
+        yield
+        return
+    if settings.scheduler_type not in SCHEDULER_TYPES:
+        msg = f"Invalid scheduler type: {settings.scheduler_type}"
+        raise ValueError(msg)
+    # Imported on first use, the plugin imports this module when QGIS starts
+    import dask
+    from dask.diagnostics import Profiler
+
+    n_workers = settings.n_workers or num_workers or os.cpu_count() or 1
+    if settings.scheduler_type == "processes" and not _can_start_processes():
+        logger.warning("Cannot start worker processes from this program, using threads instead")
+        settings = settings._replace(scheduler_type="threads")
+    config = {}
+    if settings.spill_directory:
+        Path(settings.spill_directory).mkdir(parents=True, exist_ok=True)
+        config["temporary-directory"] = settings.spill_directory
+
+    try:
+        import distributed
+    except ImportError:
+        distributed = None
+    start_time = time.perf_counter()
+    with ExitStack() as stack:
+        stack.enter_context(dask.config.set(config))
+        if distributed is None:
+            if settings.memory_limit:
+                logger.info("The memory limit per worker needs dask.distributed, not applied")
+            stack.enter_context(
+                dask.config.set(scheduler=settings.scheduler_type, num_workers=n_workers)
+            )
+            profiler = stack.enter_context(Profiler())
+        else:
+            processes = settings.scheduler_type == "processes"
+            cluster = stack.enter_context(
+                distributed.LocalCluster(
+                    n_workers=n_workers if processes else 1,
+                    threads_per_worker=1 if processes else n_workers,
+                    processes=processes,
+                    memory_limit=settings.memory_limit or 0,  # 0 is no limit
+                    local_directory=settings.spill_directory,
+                    dashboard_address=None,
+                )
+            )
+            client = stack.enter_context(distributed.Client(cluster))
+            task_stream = stack.enter_context(distributed.get_task_stream(client))
+            stack.enter_context(dask.config.set(num_workers=n_workers))
+            logger.info(f"Started a local dask cluster of {n_workers} {settings.scheduler_type}")
+        token = _active.set(settings)
+        try:
+            yield
+        finally:
+            _active.reset(token)
+
+    if distributed is None:
+        tasks, other_time = _profiler_tasks(profiler.results), {}
+    else:
+        tasks, other_time = _cluster_tasks(task_stream.data)
+    statistics = _task_stream_statistics(
+        tasks, other_time, time.perf_counter() - start_time, settings, n_workers
+    )
+    logger.info(statistics["summary"])
+    if progress is not None:
+        progress.report.record("scheduler", statistics)
+
+
+def _profiler_tasks(results):
+    """Compute seconds of each task of a dask Profiler, as (key, seconds).
+
+    The profiler starts timing a task when it is submitted, and processes are
+    submitted tasks in batches, so a task is timed from the end of the previous
+    task of its worker instead.
+    """
+    tasks, worker_end = [], {}
+    for task in sorted(results, key=lambda task: task.end_time):
+        start_time = max(task.start_time, worker_end.get(task.worker_id, task.start_time))
+        worker_end[task.worker_id] = task.end_time
+        tasks.append((task.key, task.end_time - start_time))
+    return tasks
+
+
+def _cluster_tasks(task_stream_data):
+    """Compute seconds of each task of a distributed task stream, and seconds of other actions."""
+    tasks, other_time = [], defaultdict(float)
+    for task in task_stream_data:
+        for startstop in task["startstops"]:
+            duration = startstop["stop"] - startstop["start"]
+            if startstop["action"] == "compute":
+                tasks.append((task["key"], duration))
+            else:
+                # e.g. transfer, and disk-write and disk-read when spilling
+                other_time[startstop["action"]] += duration
+    return tasks, dict(other_time)
+
+
+def _task_stream_statistics(tasks, other_time, wall_time, settings, n_workers):
+    """Statistics of a task stream of (key, compute seconds), as recorded in the run report."""
+    from dask.utils import key_split
+
+    groups = defaultdict(lambda: {"tasks": 0, "compute_time": 0.0})
+    for key, duration in tasks:
+        group = groups[key_split(key)]
+        group["tasks"] += 1
+        group["compute_time"] += duration
+    compute_time = sum(group["compute_time"] for group in groups.values())
+    utilization = compute_time / (wall_time * n_workers) if wall_time > 0 else 0.0
+    top_groups = dict(
+        sorted(groups.items(), key=lambda item: item[1]["compute_time"], reverse=True)[
+            :TOP_TASK_GROUPS
+        ]
+    )
+
+    summary = (
+        f"Scheduler: {n_workers} {settings.scheduler_type}, {len(tasks)} tasks, "
+        f"{compute_time:.1f} s compute in {wall_time:.1f} s, {utilization:.0%} of the workers used"
+    )
+    if top_groups:
+        summary += ", most in " + ", ".join(
+            f"{name} {group['compute_time']:.1f} s" for name, group in top_groups.items()
+        )
+    if other_time:
+        summary += ", " + ", ".join(
+            f"{action} {seconds:.1f} s" for action, seconds in sorted(other_time.items())
+        )
+    return {
+        "scheduler_type": settings.scheduler_type,
+        "workers": n_workers,
+        "memory_limit": settings.memory_limit,
+        "spill_directory": settings.spill_directory,
+        "tasks": len(tasks),
+        "compute_time": compute_time,
+        "wall_time": wall_time,
+        "utilization": utilization,
+        "task_groups": top_groups,
+        "other_time": other_time,
+        "summary": summary,
+    }
+
+
+def _can_start_processes():
+    """Whether worker processes can be started, which runs sys.executable as Python.
+
+    In the QGIS process sys.executable is QGIS itself on some platforms, the
+    worker process of the plugin is always Python.
+    """
+    return Path(sys.executable).stem.lower().startswith("python")
@@ -0,0 +1,11 @@
+import sys
+import types
+from pathlib import Path
+
+# The plugin __init__ imports QGIS, so the modules are imported as the coeusai
+# package without running it
+PLUGIN_DIR = Path(__file__).resolve().parents[1]
+package = types.ModuleType("coeusai")
+package.__path__ = [str(PLUGIN_DIR)]
+sys.modules.setdefault("coeusai", package)
+
@@ -0,0 +1,66 @@
+import os
+
+import pytest
+
+from coeusai import feature_cache
+from coeusai.feature_cache import FeatureCache
+
+
+def write_entry(cache, name, last_used, size=100):
+    path = cache.cache_dir / name
+    path.write_bytes(b"0" * size)
+    os.utime(path, (last_used, last_used))
+    return path
+
+
+def entry_names(cache):
+    return sorted(p.name for p in cache.cache_dir.iterdir() if p.suffix != ".lock")
+
+
+def test_evict_removes_least_recently_used(tmp_path):
+    cache = FeatureCache(tmp_path, 250)
+    write_entry(cache, "a.tif", 1)
+    write_entry(cache, "b.npy", 2)
+    write_entry(cache, "c.float16.npy", 3)
+
+    cache.evict()
+
+    assert entry_names(cache) == ["b.npy", "c.float16.npy"]
+    assert cache.size() == 200
+
+
+def test_evict_keeps_new_entry(tmp_path):
+    cache = FeatureCache(tmp_path, 150)
+    keep = write_entry(cache, "a.tif", 1)
+    write_entry(cache, "b.tif", 2)
+
+    cache.evict(keep=keep)
+
+    assert entry_names(cache) == ["a.tif"]
+
+
+def test_evict_removes_partial_entries(tmp_path):
+    cache = FeatureCache(tmp_path, 1000)
+    write_entry(cache, "a.tif", 1)
+    write_entry(cache, "b.npy.partial", 2)
+    assert cache.size() == 200
+
+    cache.evict()
+
+    assert entry_names(cache) == ["a.tif"]
+
+
+@pytest.mark.skipif(feature_cache.fcntl is None, reason="Windows does not remove open files")
+def test_evict_skips_entries_in_use(tmp_path):
+    cache = FeatureCache(tmp_path, 0)
+    in_use = write_entry(cache, "a.tif", 1)
+    write_entry(cache, "b.npy.partial", 2)
+    write_entry(cache, "c.tif", 3)
+
+    with cache.use(in_use), cache.use(tmp_path / "b.npy"):
+        cache.evict()
+        assert entry_names(cache) == ["a.tif", "b.npy.partial"]
+
+    cache.evict()
+    assert entry_names(cache) == []
+    assert list(tmp_path.iterdir()) == []
@@ -0,0 +1,98 @@
+import numpy as np
+import pytest
+
+from coeusai.feature_store import (
+    UINT8_LEVELS,
+    FeatureStore,
+    dequantize,
+    quantize,
+    reduce_precision,
+)
+
+
+@pytest.fixture
+def features():
+    rng = np.random.default_rng(0)
+    # Features of different ranges, as FLAIR features have
+    scales = np.array([1, 10, 1000], dtype=np.float32)[:, None, None]
+    return (rng.standard_normal((3, 50, 70)) * scales).astype(np.float32)
+
+
+def test_quantize_maps_range_to_uint8(features):
+    codes, offset, scale = quantize(features)
+
+    assert codes.dtype == np.uint8
+    np.testing.assert_array_equal(offset, features.min(axis=(1, 2)))
+    np.testing.assert_allclose(scale, np.ptp(features, axis=(1, 2)) / UINT8_LEVELS, rtol=1e-6)
+    np.testing.assert_array_equal(codes.min(axis=(1, 2)), 0)
+    np.testing.assert_array_equal(codes.max(axis=(1, 2)), UINT8_LEVELS)
+
+
+def test_dequantize_is_within_half_a_step(features):
+    codes, offset, scale = quantize(features)
+
+    restored = dequantize(codes, offset, scale)
+
+    assert restored.dtype == np.float32
+    error = np.abs(restored - features).max(axis=(1, 2))
+    assert np.all(error <= scale / 2 * (1 + 1e-3))
+
+
+def test_quantize_constant_feature():
+    features = np.full((1, 4, 4), 7.5, dtype=np.float32)
+
+    codes, offset, scale = quantize(features)
+
+    np.testing.assert_array_equal(codes, 0)
+    assert scale[0] == 1
+    np.testing.assert_array_equal(dequantize(codes, offset, scale), features)
+
+
+def stored_features(features, feature_precision, tile_size):
+    """Features as read from a store, uint8 features are quantized per tile."""
+    if feature_precision != "uint8":
+        return reduce_precision(features, feature_precision)
+    stored = np.empty_like(features)
+    for row in range(0, features.shape[1], tile_size):
+        for col in range(0, features.shape[2], tile_size):
+            tile = (slice(None), slice(row, row + tile_size), slice(col, col + tile_size))
+            stored[tile] = reduce_precision(features[tile], feature_precision)
+    return stored
+
+
+@pytest.mark.parametrize("feature_precision", ["float32", "float16", "uint8"])
+def test_feature_store_round_trip(tmp_path, features, feature_precision):
+    path = tmp_path / "features.npy"
+    height, width = features.shape[1:]
+    # Tiles that do not divide the raster, so the edge tiles are padded
+    store = FeatureStore.create(path, 3, height, width, 32, feature_precision)
+    store.write(features[:, :32], 0, 0)
+    store.write(features[:, 32:], 32, 0)
+    store.complete()
+
+    store = FeatureStore.open(path, height, width)
+
+    assert store.feature_precision == feature_precision
+    assert store.shape == features.shape
+    assert store.n_tiles == (2, 3)
+    expected = stored_features(features, feature_precision, 32)
+    np.testing.assert_allclose(store[:, :, :], expected, rtol=1e-6)
+    np.testing.assert_allclose(store[1:, 10:40, 20:50], expected[1:, 10:40, 20:50], rtol=1e-6)
+    np.testing.assert_allclose(store.to_dask().compute(), expected, rtol=1e-6)
+
+
+def test_feature_store_is_partial_until_complete(tmp_path, features):
+    path = tmp_path / "features.npy"
+    store = FeatureStore.create(path, 3, 50, 70, 32)
+    assert not path.exists()
+
+    store.discard()
+
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_feature_store_write_must_start_at_tile_corner(tmp_path, features):
+    store = FeatureStore.create(tmp_path / "features.npy", 3, 50, 70, 32)
+
+    with pytest.raises(ValueError, match="tile corner"):
+        store.write(features[:, 10:], 10, 0)
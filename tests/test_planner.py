@@ -0,0 +1,28 @@
+import logging
+
+import pytest
+from pycoeus.features import FeatureType
+
+from coeusai import planner
+from coeusai.planner import AUTO_CHUNK_OVERLAP, resolve_chunk_overlap
+
+
+@pytest.mark.parametrize("chunk_overlap", [None, 0, 25])
+def test_resolve_chunk_overlap_keeps_given_overlap(chunk_overlap):
+    assert resolve_chunk_overlap(chunk_overlap, FeatureType.FLAIR) == chunk_overlap
+
+
+def test_resolve_chunk_overlap_identity_needs_no_overlap():
+    assert resolve_chunk_overlap(AUTO_CHUNK_OVERLAP, FeatureType.IDENTITY) == 0
+
+
+def test_resolve_chunk_overlap_from_receptive_field(monkeypatch, caplog):
+    # Measuring the receptive field of FLAIR needs its weights
+    monkeypatch.setattr(planner, "get_min_chunk_overlap", lambda feature_type: 32)
+
+    with caplog.at_level(logging.INFO, logger=planner.__name__):
+        chunk_overlap = resolve_chunk_overlap(AUTO_CHUNK_OVERLAP, FeatureType.FLAIR, 448)
+
+    assert chunk_overlap == 32
+    # (448 / 512)^2 of the features of a chunk of 448 with an overlap of 32 are its own
+    assert "23% of the feature extraction of a chunk of 448 is overlap" in caplog.text
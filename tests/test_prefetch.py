@@ -0,0 +1,86 @@
+import threading
+
+import pytest
+
+from coeusai.prefetch import AsyncWriter, prefetch
+
+
+@pytest.mark.parametrize("queue_depth", [0, 1, 3])
+def test_prefetch_yields_in_order(queue_depth):
+    assert list(prefetch(lambda item: item * 2, range(10), queue_depth)) == list(range(0, 20, 2))
+
+
+def test_prefetch_raises_error_of_item():
+    def read(item):
+        if item == 3:
+            raise OSError(f"Cannot read {item}")
+        return item
+
+    results = prefetch(read, range(10), queue_depth=2)
+
+    assert [next(results) for _ in range(3)] == [0, 1, 2]
+    with pytest.raises(OSError, match="Cannot read 3"):
+        next(results)
+
+
+def test_prefetch_reads_ahead_at_most_queue_depth():
+    started = []
+    lock = threading.Lock()
+
+    def read(item):
+        with lock:
+            started.append(item)
+        return item
+
+    results = prefetch(read, range(10), queue_depth=2)
+    assert next(results) == 0
+    # Item 0 is used, items 1 and 2 are read ahead
+    assert max(started) <= 2
+    results.close()
+
+
+@pytest.mark.parametrize("queue_depth", [0, 1, 2])
+def test_async_writer_writes_in_order(queue_depth):
+    written = []
+
+    with AsyncWriter(queue_depth) as writer:
+        for item in range(10):
+            writer.submit(written.append, item)
+
+    assert written == list(range(10))
+
+
+def test_async_writer_raises_error_on_next_submit():
+    def write():
+        raise OSError("Disk full")
+
+    with AsyncWriter(queue_depth=1) as writer:
+        writer.submit(write)
+        with pytest.raises(OSError, match="Disk full"):
+            # The first submit waits for the slot of the failed write, if it does not raise
+            writer.submit(lambda: None)
+            writer.submit(lambda: None)
+
+
+def test_async_writer_raises_error_on_exit():
+    def write():
+        raise OSError("Disk full")
+
+    with pytest.raises(OSError, match="Disk full"):
+        with AsyncWriter(queue_depth=2) as writer:
+            writer.submit(write)
+
+
+def test_async_writer_keeps_error_of_caller():
+    written = []
+
+    def write(item):
+        written.append(item)
+        raise OSError("Disk full")
+
+    with pytest.raises(ValueError, match="Cancelled"):
+        with AsyncWriter(queue_depth=2) as writer:
+            writer.submit(write, 0)
+            raise ValueError("Cancelled")
+    # The queued write was finished before leaving
+    assert written == [0]
@@ -0,0 +1,85 @@
+import numpy as np
+import pytest
+
+from coeusai import pipeline
+from coeusai.pipeline import _allocate_samples, _sample_classes, _sample_mask
+
+
+def test_allocate_samples_in_proportion():
+    counts = np.array([600, 300, 100, 0])
+
+    draws = _allocate_samples(counts, 100)
+
+    assert draws.sum() == 100
+    assert draws[3] == 0
+    # Within one of the proportional share, after one of each stratum first
+    assert np.all(np.abs(draws - counts / 10) <= 1)
+
+
+def test_allocate_samples_one_per_stratum_first():
+    counts = np.array([10000, 5, 1, 0])
+
+    draws = _allocate_samples(counts, 10)
+
+    assert draws.sum() == 10
+    np.testing.assert_array_equal(draws, [8, 1, 1, 0])
+
+
+def test_allocate_samples_fewer_than_strata():
+    counts = np.array([50, 1, 30, 1, 20])
+
+    draws = _allocate_samples(counts, 3)
+
+    # Not every stratum can get one, the largest strata get them
+    np.testing.assert_array_equal(draws, [1, 0, 1, 0, 1])
+
+
+@pytest.mark.parametrize("n_samples", [0, 1, 7, 123, 999])
+def test_allocate_samples_sum_and_bounds(n_samples):
+    counts = np.random.default_rng(0).integers(0, 100, 20)
+
+    draws = _allocate_samples(counts, n_samples)
+
+    assert draws.sum() == n_samples
+    assert np.all(draws >= 0)
+    assert np.all(draws <= counts)
+
+
+def test_sample_mask_draws_exact_counts():
+    rng = np.random.default_rng(0)
+    strata = rng.integers(-1, 4, (60, 80))
+    n_draws = {0: 10, 2: 1, 3: 0}
+
+    mask = _sample_mask(strata, n_draws, rng)
+
+    for stratum, n in n_draws.items():
+        assert mask[strata == stratum].sum() == n
+    # Strata that are not sampled are drawn completely, pixels without a stratum never
+    assert mask[strata == 1].all()
+    assert not mask[strata == -1].any()
+
+
+def test_sample_classes_caps_pixels_per_class():
+    labels = np.full((100, 100), -1)
+    labels[:50] = 0
+    labels[50:55] = 1
+    labels[55:56, :20] = 2
+
+    sampled = _sample_classes(labels, 100)
+
+    assert (sampled == 0).sum() == 100
+    assert (sampled == 1).sum() == 100
+    # A class with fewer pixels is kept as a whole
+    assert (sampled == 2).sum() == 20
+    assert np.all(labels[sampled >= 0] == sampled[sampled >= 0])
+
+
+def test_sample_classes_is_deterministic(monkeypatch):
+    labels = np.random.default_rng(0).integers(-1, 3, (100, 100))
+
+    sampled = _sample_classes(labels, 50)
+
+    np.testing.assert_array_equal(_sample_classes(labels, 50), sampled)
+    # The sample is drawn with TRAINING_SEED
+    monkeypatch.setattr(pipeline, "TRAINING_SEED", pipeline.TRAINING_SEED + 1)
+    assert np.any(_sample_classes(labels, 50) != sampled)
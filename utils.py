@@ -1,9 +1,56 @@
+import hashlib
 import logging
-from qgis.core import QgsMessageLog, Qgis
+import os
+import re
+import shutil
+import tempfile
+from pathlib import Path
+
+from qgis.core import (
+    QgsApplication,
+    QgsFeatureRequest,
+    QgsGeometry,
+    QgsMessageLog,
+    QgsProject,
+    QgsRasterFileWriter,
+    QgsRasterPipe,
+    QgsWkbTypes,
+    Qgis,
+    NULL,
+)
 from qgis.PyQt import QtWidgets
 
+logger = logging.getLogger(__name__)
+
+RASTER_COPIES_DIR = "raster_copies"  # Folder in the plugin data folder of rasters without a file
+
 # Help text for the dialog
 HTEXT_OUTPUT_PATH = "The output path where the prediction will be saved."
+HTEXT_OUTPUT_FORMAT = "The file format and the values of the prediction."
+HTEXT_OUTPUT_FORMAT_GEOTIFF = (
+    "GeoTIFF: the probability of each class as 64-bit floats, one band per class.\n"
+    "Can be shown while it is written, see Predict the map view first."
+)
+HTEXT_OUTPUT_FORMAT_COG_PROBABILITY = (
+    "COG probability: a compressed Cloud-Optimized GeoTIFF with internal overviews,\n"
+    "with the probability of each class stored in 8 bits, from 0 to 254, one band per class.\n"
+    "About 8 times smaller and shows instantly at any zoom level."
+)
+HTEXT_OUTPUT_FORMAT_COG_CLASS = (
+    "COG class: a compressed Cloud-Optimized GeoTIFF with internal overviews,\n"
+    "with the most probable class of each pixel in a single 8-bit band: 1 for positive, 0 for negative,\n"
+    "or with several classes the number of the class, from 0, in the order of the classes."
+)
+HTEXT_OUTPUT_FORMAT_COG_CLASS_PROBABILITY = (
+    "COG class + probability: a compressed Cloud-Optimized GeoTIFF with internal overviews,\n"
+    "with the most probable class in the first band, as COG class,\n"
+    "followed by the probability of each class, as COG probability."
+)
+HTEXT_MODEL_PATH = (
+    "Predict with a model saved by an earlier run, without training.\n"
+    "Every run saves its model next to the prediction, as <prediction>.model.pkl.\n"
+    "The raster must have the same number of bands as the raster the model was trained on."
+)
 HTEXT_INPUT_RSASTER = "The input raster layer in your QGIS project that will be used for training the model."
 HTEXT_INPUT_POS_VEC = (
     "The input vector layer in your QGIS project for positive labels.\n"
@@ -13,11 +60,43 @@ HTEXT_INPUT_NEG_VEC = (
     "The input vector layer in your QGIS project for negative labels.\n"
     "Should be polygon or multi-polygons."
 )
+HTEXT_MULTI_CLASS = (
+    "Train one model on the labels of several classes, instead of positive and negative labels.\n"
+    "The features are extracted once for all classes. The prediction has a probability band per class,\n"
+    "or with a COG class output the number of the most probable class, from 0."
+)
+HTEXT_CLASS_LAYERS = (
+    "The vector layers with the labels of the classes. Should be polygon or multi-polygons.\n"
+    "Without a class field each layer is a class, named after the layer, in the order of the list."
+)
+HTEXT_CLASS_FIELD = (
+    "Optional field of the selected layers with the class of each label, e.g. a land cover name.\n"
+    "The classes are the values of the field, in sorted order. Labels without a value are not used."
+)
+HTEXT_SELECTED_FEATURES = (
+    "Only use the selected features of the label layers.\n"
+    "Without a selection in a layer, none of its features are used."
+)
+HTEXT_AOI = (
+    "Optional polygon layer of the area to predict, e.g. a field boundary.\n"
+    "Chunks outside it are skipped: their features are not extracted and they are left as nodata,\n"
+    "as are the pixels outside it. The labels are used wherever they are."
+)
+HTEXT_SKIP_NODATA = (
+    "Skip the chunks of the raster that have no data, e.g. the borders of an orthomosaic,\n"
+    "and leave the pixels without data as nodata in the prediction.\n"
+    "Pixels without data are found from the nodata value, alpha band or mask of the raster."
+)
 HTEXT_FEATURE_TYPE = (
     "The feature type of the input vector layer. By default FLAIR.\n"
     "IDENTITY means use the original raster layer as the feature."
 )
 HTEXT_COMPUTE_MODE = "The mode of computation."
+HTEXT_COMPUTE_MODE_AUTO = (
+    "Auto: choose Normal, Parallel or Safe mode, the chunk size and the number of parallel chunks\n"
+    "from the raster size, the number of features and the free memory. The chosen plan is logged.\n"
+    "The chunk size in the Advanced Options is not used in this mode."
+)
 HTEXT_COMPUTE_MODE_NORMAL = (
     "Normal: read in all the data and perform the computation.\n"
     "Suitable for small datasets that fits in memory."
@@ -28,14 +107,97 @@ HTEXT_COMPUTE_MODE_PARALLEL = (
 )
 HTEXT_COMPUTE_MODE_SAFE = (
     "Safe: read in data in chunks, perform the computation with one chunk at a time.\n"
-    "Suitable for large datasets that do not fit in memory."
+    "Suitable for large datasets that do not fit in memory.\n"
+    "FLAIR features are extracted once into a feature store on disk, training and prediction read them from it."
+)
+HTEXT_MAP_VIEW_FIRST = (
+    "Predict the chunks in the current map view first, then the others in order of distance to the view.\n"
+    "The prediction layer is added right away and refreshes as chunks are written.\n"
+    "In predict only mode the features are also extracted chunk by chunk, unless they are cached.\n"
+    "Only available for GeoTIFF output, a Cloud-Optimized GeoTIFF is written at the end of the run."
+)
+HTEXT_PREVIEW = (
+    "Train and predict on the raster at a lower resolution, to check quickly if the labels work.\n"
+    "A preview at 1/8 is about 64 times less work. The raster overviews are used when it has them.\n"
+    "The preview is added as a temporary layer, no model is saved and the output path is not written."
+)
+HTEXT_BATCH_RASTERS = (
+    "Raster layers in your QGIS project to predict with the model trained on the raster layer for training.\n"
+    "Each prediction is saved next to the output path, as <output name>_<raster name>.tif.\n"
+    "Reading and feature extraction of the next raster overlap with the prediction of the current one."
+)
+HTEXT_BATCH_FOLDER = (
+    "A folder with GeoTIFF files (.tif or .tiff) to predict with the same model,\n"
+    "in addition to the selected raster layers."
+)
+HTEXT_PROCESSING_NUM_WORKERS = (
+    "The number of chunks of this run that are processed in parallel, all CPUs by default.\n"
+    "When several runs go in parallel, give each a share of the CPUs.\n"
+    "In Auto mode this is the maximum, fewer are used when the chunks do not fit in the free memory."
 )
 HTEXT_CHUNK_SIZE = (
-    "The size of the chunk to be read in. Only used in Parallel and Safe mode."
+    "The size of the chunk to be read in. Only used in Parallel and Safe mode.\n"
+    "In Auto mode the chunk size is chosen automatically."
 )
 HTEXT_OVERLAP_SIZE = (
     "The overlap between chunks when performing feature extraction. Only used in Parallel and Safe mode.\n"
-    "Because of possible edge effects, a minimum overlap of 20 is recommended."
+    "Because of possible edge effects, a minimum overlap of 20 is recommended.\n"
+    "Auto (below 0) derives the smallest overlap from the receptive field of the FLAIR model,\n"
+    "the distance within which 99% of the influence on the features of a pixel lies."
+)
+HTEXT_AUTO_OVERLAP = (
+    "Use the smallest overlap that holds 99% of the influence on the features of a pixel,\n"
+    "measured on the FLAIR model, instead of the overlap size."
+)
+HTEXT_FEATURE_CACHE = (
+    "The maximum size of the on-disk feature cache in GB. Set to 0 to disable the cache.\n"
+    "Extracted features are reused when the raster, feature type, chunk size and overlap did not change,\n"
+    "so retraining after editing the labels skips feature extraction."
+)
+HTEXT_FEATURE_PRECISION = (
+    "The precision the FLAIR features are kept in, from extraction to prediction.\n"
+    "Float16 halves and Uint8 quarters the memory and disk space of the features, compared to Float32,\n"
+    "so larger rasters fit in Normal mode. Uint8 quantizes each feature per chunk to 256 levels.\n"
+    "The run report compares the accuracy to Float32 on held-out labelled pixels."
+)
+HTEXT_MAX_SAMPLES = (
+    "Maximum number of labelled pixels per class to train on. A class with more is trained on a\n"
+    "random sample, divided over its polygons by their size, so large label polygons do not make\n"
+    "training slow or run out of memory. The sample is the same in each run.\n"
+    "10000 by default, as pycoeus. 0 trains on all pixels, which can take long for large labels."
+)
+HTEXT_QUEUE_DEPTH = (
+    "Number of chunks read ahead, and of finished chunks waiting to be written, in the chunked modes.\n"
+    "Reading and writing then overlap with feature extraction and prediction, which helps most\n"
+    "for rasters on a slow or network disk. Each chunk in the queue takes memory. 0 turns it off."
+)
+HTEXT_SCHEDULER = (
+    "Workers of the local dask scheduler in Parallel mode. Threads share the memory of the run,\n"
+    "which suits FLAIR and other extraction that releases the GIL. Processes each have their own memory,\n"
+    "which helps for Python-heavy steps, but chunks are copied between them. Processes need the\n"
+    "separate worker process, in the QGIS process threads are used. Remembered between sessions."
+)
+HTEXT_SCHEDULER_WORKERS = (
+    "Number of threads or processes of the Parallel mode scheduler.\n"
+    "0 uses the number the Auto mode plans, or all CPUs."
+)
+HTEXT_MEMORY_LIMIT = (
+    "Memory per worker of the Parallel mode scheduler. Near the limit a worker writes data to the\n"
+    "spill directory, above it the worker pauses. Needs dask.distributed, 0 is no limit."
+)
+HTEXT_SPILL_DIRECTORY = (
+    "Folder the Parallel mode scheduler writes temporary and spilled data to, e.g. on a fast local disk.\n"
+    "Leave empty for the temporary folder of the system."
+)
+HTEXT_WORKER = (
+    "Run the classification in a separate Python process that stays running between runs.\n"
+    "pycoeus and the FLAIR weights are loaded only once, memory of big runs is given back to the system,\n"
+    "and a crash or out-of-memory error in the worker does not take down QGIS."
+)
+HTEXT_CANCEL = (
+    "Stop the classification after the current chunk. The prediction chunks written so far are kept.\n"
+    "Running again in predict only mode, with the model saved next to the prediction\n"
+    "and the same output path, resumes the prediction."
 )
 
 
@@ -57,3 +219,183 @@ class DialogLoggerHandler(logging.Handler):
     def emit(self, record):
         msg = self.format(record)
         self.widget.appendPlainText(msg)
+
+
+def get_plugin_data_dir():
+    """Folder for data of the plugin in the QGIS profile, e.g. the feature cache."""
+    data_dir = Path(QgsApplication.qgisSettingsDirPath()) / "coeusai"
+    data_dir.mkdir(parents=True, exist_ok=True)
+    return data_dir
+
+
+def get_label_geometries(source, crs, selected_only=False):
+    """Geometries of a vector layer or processing feature source, as a GeoSeries in crs.
+
+    The features are read through QGIS, so this works for layers in memory,
+    layers with a filter and layers in multi-layer files, and only the features
+    that are used are read.
+
+    :param source: QgsVectorLayer or QgsProcessingFeatureSource
+    :param crs: QgsCoordinateReferenceSystem of the raster
+    :param selected_only: only read the selected features of a layer
+    """
+    # Imported on first use, the plugin imports this module when QGIS starts
+    import geopandas as gpd
+
+    geometries = [geometry for _, geometry in _read_geometries(source, crs, selected_only)]
+    return gpd.GeoSeries(geometries, crs=crs.toWkt())
+
+
+def get_class_geometries(layers, crs, class_field=None, selected_only=False):
+    """Label geometries of several classes, as a dict of class name to GeoSeries in crs.
+
+    Without class_field each layer is a class, named after the layer. With
+    class_field the classes are the values of the field in the layers, in sorted
+    order, and features without a value are left out.
+
+    :param layers: QgsVectorLayer of the labels
+    :param crs: QgsCoordinateReferenceSystem of the raster
+    :param class_field: optional name of the field with the class of each feature
+    :param selected_only: only read the selected features of the layers
+    """
+    # Imported on first use, the plugin imports this module when QGIS starts
+    import geopandas as gpd
+
+    if not class_field:
+        return {layer.name(): get_label_geometries(layer, crs, selected_only) for layer in layers}
+
+    classes = {}
+    for layer in layers:
+        if layer.fields().lookupField(class_field) < 0:
+            msg = f"The layer {layer.name()} has no field {class_field}"
+            raise ValueError(msg)
+        for feature, geometry in _read_geometries(layer, crs, selected_only, class_field):
+            value = feature[class_field]
+            if value is None or value == NULL:
+                continue
+            classes.setdefault(value, []).append(geometry)
+    return {
+        str(value): gpd.GeoSeries(classes[value], crs=crs.toWkt()) for value in sorted(classes)
+    }
+
+
+def _read_geometries(source, crs, selected_only=False, field=None):
+    """Yield the features of a source with a geometry, and their geometry in crs in shapely.
+
+    :param field: name of the only field to read, no fields are read by default
+    """
+    # Imported on first use, the plugin imports this module when QGIS starts
+    import shapely.wkb
+
+    request = QgsFeatureRequest()
+    request.setDestinationCrs(crs, QgsProject.instance().transformContext())
+    if field is None:
+        request.setNoAttributes()
+    else:
+        request.setSubsetOfAttributes([field], source.fields())
+    features = source.getSelectedFeatures(request) if selected_only else source.getFeatures(request)
+    for feature in features:
+        geometry = feature.geometry()
+        if geometry.isNull() or geometry.isEmpty():
+            continue
+        # shapely does not read curved geometries
+        if QgsWkbTypes.isCurvedType(geometry.wkbType()):
+            geometry = QgsGeometry(geometry.constGet().segmentize())
+        yield feature, shapely.wkb.loads(bytes(geometry.asWkb()))
+
+
+def get_raster_path(raster_layer):
+    """Path of a raster layer that GDAL can read.
+
+    A raster without a file, e.g. a layer in memory or a virtual raster, is
+    written to a GeoTIFF in the plugin data folder first. The copy is reused as
+    long as the source, extent and size of the layer do not change, so the
+    features of the copy stay in the feature cache. Copies are removed with
+    remove_raster_copies.
+    """
+    if raster_layer.providerType() == "gdal":
+        return Path(raster_layer.source())
+
+    provider = raster_layer.dataProvider()
+    if provider.xSize() == 0 or provider.ySize() == 0:
+        msg = f"The raster layer {raster_layer.name()} has no pixel size, e.g. a web map, and cannot be classified."
+        raise ValueError(msg)
+    copies_dir = _get_raster_copies_dir(raster_layer.id())
+    path = copies_dir / f"{_raster_layer_digest(raster_layer)}.tif"
+    if path.exists():
+        logger.info(f"Using the copy of the raster layer {raster_layer.name()} at {path}")
+        return path
+
+    # Written to a partial file first, so a copy that exists is complete
+    fd, partial_path = tempfile.mkstemp(suffix=".partial.tif", dir=copies_dir)
+    os.close(fd)
+    pipe = QgsRasterPipe()
+    pipe.set(provider.clone())
+    writer = QgsRasterFileWriter(partial_path)
+    writer.setOutputFormat("GTiff")
+    error = writer.writeRaster(
+        pipe,
+        provider.xSize(),
+        provider.ySize(),
+        provider.extent(),
+        provider.crs(),
+        QgsProject.instance().transformContext(),
+    )
+    if error != QgsRasterFileWriter.NoError:
+        Path(partial_path).unlink(missing_ok=True)
+        msg = f"Could not write the raster layer {raster_layer.name()} to {path} (error {error})."
+        raise ValueError(msg)
+    os.replace(partial_path, path)
+    logger.info(f"Wrote the raster layer {raster_layer.name()} to {path}")
+
+    # Copies of the layer before it changed
+    for old_path in copies_dir.glob("*.tif"):
+        if old_path != path and not old_path.name.endswith(".partial.tif"):
+            try:
+                old_path.unlink()
+            except OSError:
+                # Still open in another run on Windows, removed with the layer
+                pass
+    return path
+
+
+def remove_raster_copies(layer_ids=None):
+    """Remove the copies of raster layers written by get_raster_path.
+
+    :param layer_ids: ids of the layers, e.g. of layers removed from the project, None for all
+    """
+    copies_dir = get_plugin_data_dir() / RASTER_COPIES_DIR
+    if layer_ids is None:
+        shutil.rmtree(copies_dir, ignore_errors=True)
+        return
+    for layer_id in layer_ids:
+        shutil.rmtree(copies_dir / _safe_name(layer_id), ignore_errors=True)
+
+
+def _get_raster_copies_dir(layer_id):
+    copies_dir = get_plugin_data_dir() / RASTER_COPIES_DIR / _safe_name(layer_id)
+    copies_dir.mkdir(parents=True, exist_ok=True)
+    return copies_dir
+
+
+def _raster_layer_digest(raster_layer):
+    """Hash of the source, extent, size, CRS and bands of a raster layer, see get_raster_path."""
+    provider = raster_layer.dataProvider()
+    key = "|".join(
+        str(part)
+        for part in (
+            raster_layer.source(),
+            provider.extent().toString(),
+            provider.xSize(),
+            provider.ySize(),
+            provider.crs().authid(),
+            provider.bandCount(),
+            provider.dataTimestamp().toString(),
+        )
+    )
+    return hashlib.sha1(key.encode("utf-8")).hexdigest()[:16]
+
+
+def _safe_name(name):
+    """A name that can be used as a file name, e.g. of a layer id."""
+    return re.sub(r"[^\w.-]", "_", name)
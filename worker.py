@@ -0,0 +1,309 @@
+import functools
+import importlib
+import logging
+import os
+import secrets
+import subprocess
+import sys
+import threading
+import types
+from multiprocessing.connection import Client, Listener
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+AUTHKEY_ENV = "COEUSAI_WORKER_AUTHKEY"  # Environment variable passing the authkey to the worker
+POLL_INTERVAL = 0.2  # Seconds between checks for cancellation while waiting for the worker
+# Pipeline functions the worker may run
+WORKER_FUNCTIONS = (
+    "train_and_predict",
+    "train_and_predict_preview",
+    "predict_with_model",
+    "predict_batch",
+)
+
+
+class WorkerError(Exception):
+    """Raised when the worker process fails to start or crashes."""
+
+
+class WorkerProcess:
+    """A long-lived local Python process that runs pipeline functions.
+
+    pycoeus and the FLAIR weights are loaded once in the worker and stay loaded
+    between runs. The worker has its own memory and its own GIL, so a big run does
+    not slow down or grow QGIS, and a crash or out-of-memory error in the worker
+    does not take down QGIS. Messages are pickled tuples over a local socket.
+    """
+
+    def __init__(self, log_path=None):
+        self.log_path = log_path
+        self.process = None
+        self.connection = None
+        self._lock = threading.Lock()
+
+    def is_alive(self):
+        return self.process is not None and self.process.poll() is None
+
+    def start(self):
+        """Start the worker process and connect to it."""
+        authkey = secrets.token_bytes(32)
+        env = dict(os.environ)
+        env[AUTHKEY_ENV] = authkey.hex()
+        # Let the worker find the same modules as QGIS, e.g. pycoeus in the user site-packages
+        env["PYTHONPATH"] = os.pathsep.join(p for p in sys.path if p and Path(p).exists())
+        stderr = open(self.log_path, "a") if self.log_path is not None else subprocess.DEVNULL
+        try:
+            self.process = subprocess.Popen(
+                [str(_python_executable()), str(Path(__file__))],
+                stdin=subprocess.DEVNULL,
+                stdout=subprocess.PIPE,
+                stderr=stderr,
+                env=env,
+                creationflags=getattr(subprocess, "CREATE_NO_WINDOW", 0),
+            )
+        finally:
+            if stderr is not subprocess.DEVNULL:
+                stderr.close()
+
+        # The worker writes the port it listens on as the first line
+        port = self.process.stdout.readline().strip()
+        self.process.stdout.close()
+        if not port:
+            self.stop()
+            raise WorkerError(
+                f"The worker process failed to start, see {self.log_path} for details"
+            )
+        self.connection = Client(("localhost", int(port)), authkey=authkey)
+        logger.info(f"Started worker process {self.process.pid}")
+
+    def run(self, function_name, progress=None, **kwargs):
+        """Run a pipeline function in the worker and wait for its result.
+
+        Progress reported by the worker is passed to progress, and cancelling
+        progress cancels the run in the worker.
+        """
+        from .progress import ClassificationCancelled
+
+        with self._lock:
+            if not self.is_alive():
+                self.start()
+            try:
+                self.connection.send(("run", function_name, kwargs))
+                cancel_sent = False
+                while True:
+                    if progress is not None and progress.cancelled and not cancel_sent:
+                        self.connection.send(("cancel",))
+                        cancel_sent = True
+                    if not self.connection.poll(POLL_INTERVAL):
+                        continue
+                    message = self.connection.recv()
+                    match message:
+                        case ("progress", *args):
+                            if progress is not None and progress.callback is not None:
+                                progress.callback(*args)
+                        case ("output_updated", path):
+                            if progress is not None:
+                                progress.output_updated(path)
+                        case ("log", level, name, text, pathname, lineno):
+                            _log_record(level, name, text, pathname, lineno)
+                        case ("result", value):
+                            return value
+                        case ("cancelled", text):
+                            raise ClassificationCancelled(text)
+                        case ("error", text):
+                            raise RuntimeError(text)
+            except (EOFError, OSError) as e:
+                self.stop()
+                raise WorkerError(
+                    f"The worker process stopped unexpectedly ({e}), "
+                    "possibly out of memory. It is restarted for the next run."
+                ) from e
+
+    def stop(self):
+        """Stop the worker process."""
+        if self.connection is not None:
+            try:
+                self.connection.send(("shutdown",))
+            except OSError:
+                pass
+            self.connection.close()
+            self.connection = None
+        if self.process is not None:
+            try:
+                self.process.wait(timeout=5)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+            self.process = None
+
+
+_worker = None
+
+
+def get_worker(log_path=None):
+    """Get the shared worker process, which is started on first use."""
+    global _worker
+    if _worker is None:
+        _worker = WorkerProcess(log_path)
+    return _worker
+
+
+def stop_worker():
+    """Stop the shared worker process, e.g. when the plugin is unloaded."""
+    global _worker
+    if _worker is not None:
+        _worker.stop()
+        _worker = None
+
+
+def _log_record(level, name, text, pathname, lineno):
+    """Log a record sent by the worker, from the code in the worker that logged it."""
+    logger = logging.getLogger(name)
+    if logger.isEnabledFor(level):
+        logger.handle(
+            logging.makeLogRecord(
+                {
+                    "name": name,
+                    "levelno": level,
+                    "levelname": logging.getLevelName(level),
+                    "msg": text,
+                    "pathname": pathname,
+                    "lineno": lineno,
+                }
+            )
+        )
+
+
+def _python_executable():
+    """The Python executable of QGIS, sys.executable is QGIS itself on some platforms."""
+    executable = Path(sys.executable)
+    if executable.stem.lower().startswith("python"):
+        return executable
+    for folder in (executable.parent, Path(sys.exec_prefix), Path(sys.exec_prefix) / "bin"):
+        for name in ("python3.exe", "python.exe", "python3", "python"):
+            if (folder / name).exists():
+                return folder / name
+    raise WorkerError("Could not find the Python executable of QGIS")
+
+
+def serve(connection):
+    """Run pipeline functions sent over the connection, until it is shut down."""
+    from . import pipeline
+    from .progress import Progress
+    from .run_logging import DebugRateLimit, RUN_LOGGERS
+
+    send_lock = threading.Lock()
+
+    def send(message):
+        with send_lock:
+            connection.send(message)
+
+    # Stream the log records of the plugin and pycoeus back to QGIS, which handles them per run
+    handler = _ConnectionLogHandler(send)
+    handler.setFormatter(logging.Formatter("%(message)s"))
+    handler.addFilter(DebugRateLimit())
+    for name in RUN_LOGGERS:
+        logging.getLogger(name).addHandler(handler)
+
+    job = None
+    progress = None
+    while True:
+        try:
+            message = connection.recv()
+        except EOFError:
+            break
+        match message:
+            case ("run", function_name, kwargs):
+                if function_name not in WORKER_FUNCTIONS:
+                    send(("error", f"Unknown function: {function_name}"))
+                    continue
+                progress = Progress(
+                    lambda *args: send(("progress", *args)),
+                    lambda path: send(("output_updated", path)),
+                )
+                job = threading.Thread(
+                    target=_run_job,
+                    args=(send, getattr(pipeline, function_name), kwargs, progress),
+                    daemon=True,
+                )
+                job.start()
+            case ("cancel",):
+                if progress is not None:
+                    progress.cancel()
+            case ("shutdown",):
+                if progress is not None:
+                    progress.cancel()
+                break
+
+    if job is not None:
+        job.join()
+
+
+def _run_job(send, function, kwargs, progress):
+    from .progress import ClassificationCancelled
+
+    try:
+        send(("result", function(progress=progress, **kwargs)))
+    except ClassificationCancelled as e:
+        send(("cancelled", str(e)))
+    except Exception as e:
+        logger.exception("Worker job failed")
+        send(("error", str(e)))
+
+
+def _keep_flair_weights_loaded():
+    """Load the FLAIR weights once, instead of once per chunk."""
+    import pycoeus.features
+
+    pycoeus.features.load_model = functools.lru_cache(maxsize=None)(
+        pycoeus.features.load_model
+    )
+    try:
+        pycoeus.features.load_model(1.0)
+    except Exception as e:
+        logger.warning(f"Could not preload the FLAIR weights: {e}")
+
+
+class _ConnectionLogHandler(logging.Handler):
+    """Send log records to the QGIS process."""
+
+    def __init__(self, send):
+        super().__init__()
+        self.send = send
+
+    def emit(self, record):
+        try:
+            self.send(
+                (
+                    "log",
+                    record.levelno,
+                    record.name,
+                    self.format(record),
+                    record.pathname,
+                    record.lineno,
+                )
+            )
+        except OSError:
+            pass
+
+
+def main():
+    authkey = bytes.fromhex(os.environ.pop(AUTHKEY_ENV))
+    with Listener(("localhost", 0), authkey=authkey) as listener:
+        print(listener.address[1], flush=True)
+        # Nothing reads stdout after the port, keep output of pycoeus and torch from blocking on it
+        devnull = os.open(os.devnull, os.O_WRONLY)
+        os.dup2(devnull, sys.stdout.fileno())
+        with listener.accept() as connection:
+            _keep_flair_weights_loaded()
+            serve(connection)
+
+
+if __name__ == "__main__":
+    # Started as a script by WorkerProcess. Register the plugin folder as a package
+    # without running its __init__, which needs QGIS, so relative imports work
+    plugin_dir = Path(__file__).resolve().parent
+    package = types.ModuleType(plugin_dir.name)
+    package.__path__ = [str(plugin_dir)]
+    sys.modules[plugin_dir.name] = package
+    importlib.import_module(f"{plugin_dir.name}.worker").main()